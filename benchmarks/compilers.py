@@ -0,0 +1,122 @@
+"""
+Benchmarks for the pure compilers and the subnet allocator.
+
+Run it from the top of the repo:
+
+    python -m benchmarks.compilers
+    python -m benchmarks.compilers --scales 10,1000 --threshold 0.5
+    python -m benchmarks.compilers --update
+
+It exits non-zero if anything regressed against the stored baseline.  The
+baseline is only meaningful on the machine and python it was recorded with,
+so rerun with --update after changing either.
+"""
+
+import argparse
+import os
+import sys
+
+from deployment_experiments import netgraph
+from deployment_experiments import routegraph
+from deployment_experiments.fragmentation import AddressSpace
+from deployment_experiments.subnet_generator import generate_subnets
+
+from benchmarks import harness
+from benchmarks import synthetic
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines",
+                        "compilers.json")
+SCALES = [10, 1000, 100000]
+
+
+def generate_subnets_setup(scale):
+    parent, existing, prefix = synthetic.crowded_space(scale, prefix=28)
+    return lambda: next(generate_subnets(parent, existing, prefix))
+
+
+def net_to_firewalls_setup(scale):
+    net = synthetic.synthetic_net(scale)
+    return lambda: netgraph.net_to_firewalls(net)
+
+
+def firewalls_to_net_setup(scale):
+    firewalls = netgraph.net_to_firewalls(synthetic.synthetic_net(scale))
+    return lambda: netgraph.firewalls_to_net(firewalls)
+
+
+def net_to_routes_setup(scale):
+    paths = synthetic.synthetic_paths(scale)
+    return lambda: routegraph.net_to_routes(paths)
+
+
+def routes_to_net_setup(scale):
+    routes = routegraph.net_to_routes(synthetic.synthetic_paths(scale))
+    return lambda: routegraph.routes_to_net(routes)
+
+
+def fragmentation_setup(scale):
+    parent, existing, _ = synthetic.crowded_space(scale, prefix=28,
+                                                  holes=0.3)
+    space = AddressSpace("bench", parent, [
+        {"id": cidr, "cidr": cidr, "zone": "a", "network": cidr}
+        for cidr in existing])
+    return lambda: space.report()
+
+
+BENCHMARKS = [
+        ("generate_subnets", generate_subnets_setup),
+        ("net_to_firewalls", net_to_firewalls_setup),
+        ("firewalls_to_net", firewalls_to_net_setup),
+        ("net_to_routes", net_to_routes_setup),
+        ("routes_to_net", routes_to_net_setup),
+        ("fragmentation", fragmentation_setup)
+        ]
+
+
+def log(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        "\n")[0])
+    parser.add_argument("--scales", default=",".join(str(scale)
+                                                     for scale in SCALES))
+    parser.add_argument("--only", default=None,
+                        help="comma separated benchmark names to run")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fraction worse than baseline that fails")
+    parser.add_argument("--budget", type=float, default=10.0,
+                        help="seconds a single run is allowed to take")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update", action="store_true",
+                        help="record these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    benchmarks = BENCHMARKS
+    if args.only:
+        benchmarks = [benchmark for benchmark in BENCHMARKS
+                      if benchmark[0] in args.only.split(",")]
+    scales = [int(scale) for scale in args.scales.split(",")]
+    results = harness.run(benchmarks, scales, budget=args.budget, log=log)
+
+    if args.update:
+        baseline, _ = harness.load_baseline(args.baseline)
+        baseline.update(results)
+        harness.save_baseline(args.baseline, baseline)
+        log("Saved baseline to %s" % args.baseline)
+        return 0
+
+    baseline, environment = harness.load_baseline(args.baseline)
+    if environment and environment != harness.environment():
+        log("Warning: baseline was recorded on %s, this is %s" %
+            (environment, harness.environment()))
+    regressions = harness.compare(results, baseline, args.threshold)
+    for key, metric, base, result in regressions:
+        log("REGRESSION %s %s: %s -> %s" % (key, metric, base, result))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
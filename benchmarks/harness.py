@@ -0,0 +1,171 @@
+"""
+Timing, memory measurement and baseline comparison for the benchmarks.
+
+Results are keyed by "name@scale", and look like {"seconds": ..., "peak_bytes":
+...}.  A result is a regression when it's more than the threshold (as a
+fraction) worse than the stored baseline.
+"""
+
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def time_call(function, min_seconds=0.2, max_repeats=5):
+    """
+    Best wall time of a few calls.  Anything slow only runs once, since the
+    noise doesn't matter as much there.
+    """
+    times = []
+    while len(times) < max_repeats:
+        gc.collect()
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+        if sum(times) > min_seconds:
+            break
+    return min(times)
+
+
+def peak_memory(function):
+    """
+    Peak bytes allocated during one call.  tracemalloc gives the real number
+    on python 3.  Python 2 doesn't have it, so there the call runs in a forked
+    child, and the number is how far the child's high water mark grew past
+    where it started.
+    """
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on linux, and bytes on mac
+        scale = 1 if sys.platform == "darwin" else 1024
+        os.write(write_end, str((after - before) * scale).encode())
+        os._exit(0)
+    os.close(write_end)
+    output = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return int(output)
+
+
+def run(benchmarks, scales, budget=10.0, log=None):
+    """
+    Runs every benchmark at every scale, smallest first.  benchmarks is a list
+    of (name, setup) where setup(scale) builds the input and returns the
+    function to measure, so input generation isn't part of the timing.
+
+    Once a benchmark looks like it would blow through the time budget at the
+    next scale (assuming it's linear, which is optimistic), the larger scales
+    are skipped and recorded as such.  That's what keeps a quadratic path
+    from hanging the whole suite.
+    """
+    results = {}
+    for name, setup in benchmarks:
+        previous = None
+        for scale in sorted(scales):
+            key = "%s@%s" % (name, scale)
+            if previous and previous[1] * scale / previous[0] > budget:
+                results[key] = {"skipped": True}
+                if log:
+                    log("%-40s skipped, over the %ss budget" % (key, budget))
+                continue
+            function = setup(scale)
+            seconds = time_call(function)
+            results[key] = {
+                    "seconds": seconds,
+                    "peak_bytes": peak_memory(function)
+                    }
+            previous = (scale, seconds)
+            if log:
+                log("%-40s %10.4fs %12d bytes" % (key, seconds,
+                                                  results[key]["peak_bytes"]))
+    return results
+
+
+def compare(results, baseline, threshold=0.25, noise_seconds=0.001,
+            noise_bytes=1 << 20):
+    """
+    Returns a list of (key, metric, baseline, result) for every metric that
+    got more than threshold worse.  Tiny absolute numbers are all noise, so
+    anything under noise_seconds or noise_bytes never counts.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base or base.get("skipped") or result.get("skipped"):
+            continue
+        for metric, noise in [("seconds", noise_seconds),
+                              ("peak_bytes", noise_bytes)]:
+            if result[metric] <= noise:
+                continue
+            if result[metric] > max(base[metric], noise) * (1 + threshold):
+                regressions.append((key, metric, base[metric],
+                                    result[metric]))
+    return regressions
+
+
+def compare_counts(results, baseline, metric):
+    """
+    Like compare, but for counters like API calls, where any increase in any
+    count is a regression.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base or metric not in base or metric not in result:
+            continue
+        for name, count in sorted(result[metric].items()):
+            if count > base[metric].get(name, 0):
+                regressions.append((key, "%s %s" % (metric, name),
+                                    base[metric].get(name, 0), count))
+    return regressions
+
+
+def environment():
+    return {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine()
+            }
+
+
+def load_baseline(path):
+    """
+    Returns (results, environment) from a baseline file, or empty ones if
+    there isn't a baseline yet.
+    """
+    try:
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+    except IOError:
+        return {}, {}
+    return baseline["results"], baseline["environment"]
+
+
+def save_baseline(path, results):
+    with open(path, "w") as baseline_file:
+        json.dump({"environment": environment(), "results": results},
+                  baseline_file, indent=2, sort_keys=True,
+                  separators=(",", ": "))
+        baseline_file.write("\n")
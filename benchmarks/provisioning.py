@@ -0,0 +1,147 @@
+"""
+Benchmarks full provision/discover/destroy cycles against moto.
+
+Run it from the top of the repo:
+
+    python -m benchmarks.provisioning
+    python -m benchmarks.provisioning --scales 1,10 --update
+
+Every cycle provisions a load balancer (with its network, datacenter and DNS)
+and a service behind it for each of N services, discovers them all, and then
+destroys them all.  For each cycle it records wall time per phase, peak
+memory, and how many AWS API calls of each kind it took (counted with
+deployment_experiments.instrumentation).
+
+API calls are what get us throttled in production, so any increase in the
+count of any call fails, no matter the threshold.  Times and memory use the
+threshold like the compiler benchmarks do.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import boto3
+from moto import mock_ec2, mock_autoscaling, mock_elb, mock_route53
+
+from deployment_experiments.instrumentation import ApiRecorder
+from deployment_experiments.network import Network
+from deployment_experiments.service import LoadBalancer, Service
+from deployment_experiments.virtual_machine import VirtualMachine
+from deployment_experiments.virtual_machine import VirtualMachinePlugin
+
+from benchmarks import harness
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines",
+                        "provisioning.json")
+# moto gets slower per call the more it holds, so 100 services takes hours
+# with the memory tracking on top.  Pass --scales for bigger runs.
+SCALES = [1, 10]
+
+
+def make_services(count):
+    image = VirtualMachine(plugins=[VirtualMachinePlugin(
+        "https://github.com/cloud-deployer/plugins/nginx-build",
+        "https://github.com/cloud-deployer/plugins/nginx-runtime")])
+    services = []
+    for index in range(count):
+        load_balancer = LoadBalancer("svc%d-lb" % index,
+                                     "svc%d.example.com" % index)
+        services.append((load_balancer,
+                         Service("svc%d" % index, image, load_balancer)))
+    return services
+
+
+def cycle(count):
+    """
+    One full provision/discover/destroy cycle for count services.  Returns
+    the seconds each phase took and the API calls it made.
+    """
+    services = make_services(count)
+    phases = {}
+    recorder = ApiRecorder(warn=False)
+    with mock_ec2(), mock_elb(), mock_autoscaling(), mock_route53(), \
+            recorder:
+        start = timeit.default_timer()
+        for load_balancer, service in services:
+            load_balancer.provision()
+            service.provision(colocated_service=load_balancer.name)
+        phases["provision"] = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        network = Network()
+        for load_balancer, service in services:
+            load_balancer.discover()
+            service.discover()
+            network.discover(service.name)
+        phases["discover"] = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        for load_balancer, service in services:
+            load_balancer.destroy()
+            service.destroy()
+        phases["destroy"] = timeit.default_timer() - start
+    boto3.DEFAULT_SESSION = None
+    return phases, dict((name, operation["calls"]) for name, operation
+                        in recorder.report()["operations"].items())
+
+
+def run(scales, log):
+    results = {}
+    for scale in sorted(scales):
+        key = "cycle@%s" % scale
+        phases, api_calls = cycle(scale)
+        results[key] = {
+                "seconds": sum(phases.values()),
+                "phases": phases,
+                "peak_bytes": harness.peak_memory(lambda: cycle(scale)),
+                "api_calls": api_calls
+                }
+        log("%-12s %8.3fs %12d bytes %6d calls (%s)" % (
+            key, results[key]["seconds"], results[key]["peak_bytes"],
+            sum(api_calls.values()),
+            ", ".join("%s %.3fs" % (phase, seconds)
+                      for phase, seconds in sorted(phases.items()))))
+    return results
+
+
+def log(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        "\n")[0])
+    parser.add_argument("--scales", default=",".join(str(scale)
+                                                     for scale in SCALES))
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fraction worse than baseline that fails")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update", action="store_true",
+                        help="record these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    results = run([int(scale) for scale in args.scales.split(",")], log)
+
+    if args.update:
+        baseline, _ = harness.load_baseline(args.baseline)
+        baseline.update(results)
+        harness.save_baseline(args.baseline, baseline)
+        log("Saved baseline to %s" % args.baseline)
+        return 0
+
+    baseline, environment = harness.load_baseline(args.baseline)
+    if environment and environment != harness.environment():
+        log("Warning: baseline was recorded on %s, this is %s" %
+            (environment, harness.environment()))
+    regressions = (harness.compare(results, baseline, args.threshold) +
+                   harness.compare_counts(results, baseline, "api_calls"))
+    for key, metric, base, result in regressions:
+        log("REGRESSION %s %s: %s -> %s" % (key, metric, base, result))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
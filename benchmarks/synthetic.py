@@ -0,0 +1,67 @@
+"""
+Synthetic inputs for the benchmarks, at whatever scale is asked for.
+
+Everything is seeded, so the same scale always gives the same input and the
+numbers stay comparable between runs.
+"""
+
+import random
+
+PROTOCOLS = ["tcp", "udp"]
+PORTS = ["80", "443", "5432", "6379", "8000-8080", "9000"]
+
+
+def synthetic_net(size, fanout=3, seed=0):
+    """
+    A netgraph net with size services, each depending on a handful of
+    others, plus a few that are open to the outside.
+    """
+    rng = random.Random(seed)
+    net = {}
+    for service in range(size):
+        targets = net.setdefault(str(service), {})
+        for _ in range(min(fanout, size - 1)):
+            target = str(rng.randrange(size))
+            targets.setdefault(target, []).append({
+                "protocol": rng.choice(PROTOCOLS),
+                "port": rng.choice(PORTS)
+                })
+    external = net.setdefault("external", {})
+    for service in range(0, size, 10):
+        external[str(service)] = [{"protocol": "tcp", "port": "443"}]
+    return net
+
+
+def synthetic_paths(size, gateways=None, seed=0):
+    """
+    A routegraph net with size paths, each going from a service out through
+    one of a smaller number of gateways and a shared core to "external".
+    """
+    rng = random.Random(seed)
+    gateways = gateways or max(1, size // 100)
+    return [[str(service), "gw%d" % rng.randrange(gateways), "core",
+             "external"] for service in range(size)]
+
+
+def crowded_space(size, prefix=24, parent="10.0.0.0/8", holes=0.0, seed=0):
+    """
+    A parent block with size subnets of the given prefix already allocated,
+    packed from the start, like a VPC that's been around for a while.  holes
+    is the chance of leaving a gap before each one.  Returns (parent,
+    existing cidrs, prefix).
+    """
+    rng = random.Random(seed)
+    octets = [int(octet) for octet in parent.split("/")[0].split(".")]
+    base = (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+    block = 1 << (32 - prefix)
+    existing = []
+    index = 0
+    while len(existing) < size:
+        if rng.random() >= holes:
+            address = base + index * block
+            existing.append("%d.%d.%d.%d/%d" % (address >> 24 & 255,
+                                                address >> 16 & 255,
+                                                address >> 8 & 255,
+                                                address & 255, prefix))
+        index += 1
+    return parent, existing, prefix
@@ -0,0 +1,130 @@
+"""
+asyncio versions of the resource classes, for orchestrating from an event
+loop.  This module is python 3 only.
+
+    network = AsyncNetwork(deployment_name="prod")
+    await network.provision(network_name="web")
+
+    await asyncio.gather(*[AsyncLoadBalancer("%s-lb" % name, dns).provision()
+                           for name, dns in services])
+
+Every method of the wrapped class comes back as a coroutine.  There's no
+asyncio AWS SDK to build on (aiobotocore isn't a dependency, and it doesn't
+cover the rate limiter or moto), so the blocking calls run on a shared pool
+of worker threads instead.  A Runner owns that pool, so there's at most
+max_concurrency calls in flight no matter how many coroutines are waiting.
+There's never a thread per call, and the event loop itself never blocks.
+Everything the sync classes do still applies: the rate limiter and retries
+from clients, the allocation lock that keeps concurrent creates from picking
+the same CIDR block, and tracing spans (each call gets parented to the span
+that was open when it was awaited).
+
+So this is a thread pool under an asyncio face, not an event loop all the
+way down, and the limits are the pool's.  At most max_concurrency calls run
+at once, whatever the number of coroutines.  Picking CIDR blocks (the reads
+that find what's taken, and choosing a free block) is serialized by the
+allocation lock.  Only the creates run side by side.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+
+from .datacenter import Datacenter, DatacenterInventory
+from .network import Network
+from .service import LoadBalancer, Service, ServiceDns
+from .tracing import wrap
+
+
+@attr.s
+class Runner(object):
+    """
+    Runs blocking calls for coroutines, at most max_concurrency at a time.
+    """
+    max_concurrency = attr.ib(default=32)
+    _executor = attr.ib(default=None)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix="deployment-experiments")
+        return self._executor
+
+    async def run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+                self.executor, wrap(functools.partial(function, *args,
+                                                      **kwargs)))
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+default_runner = Runner()
+
+
+class AsyncResource(object):
+    """
+    Wraps a resource object so every method is a coroutine.  Subclasses set
+    wraps to the class they wrap, and get built with the same arguments.
+    Anything that isn't a method (like name or provider) comes straight
+    through.
+    """
+    wraps = None
+
+    def __init__(self, *args, **kwargs):
+        self.runner = kwargs.pop("runner", None) or default_runner
+        self.resource = self.wraps(*[unwrap(arg) for arg in args],
+                                   **dict((key, unwrap(value))
+                                          for key, value in kwargs.items()))
+
+    def __getattr__(self, name):
+        attribute = getattr(self.resource, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def method(*args, **kwargs):
+            return await self.runner.run(attribute, *args, **kwargs)
+        return method
+
+    def __repr__(self):
+        return "Async%r" % (self.resource,)
+
+
+def unwrap(value):
+    """
+    Async resources can be passed in anywhere the sync ones go, like an
+    AsyncLoadBalancer into an AsyncService.
+    """
+    return value.resource if isinstance(value, AsyncResource) else value
+
+
+class AsyncDatacenterInventory(AsyncResource):
+    wraps = DatacenterInventory
+
+
+class AsyncDatacenter(AsyncResource):
+    wraps = Datacenter
+
+
+class AsyncNetwork(AsyncResource):
+    wraps = Network
+
+
+class AsyncServiceDns(AsyncResource):
+    wraps = ServiceDns
+
+
+class AsyncLoadBalancer(AsyncResource):
+    wraps = LoadBalancer
+
+
+class AsyncService(AsyncResource):
+    wraps = Service
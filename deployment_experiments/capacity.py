@@ -0,0 +1,159 @@
+"""
+Sizes a service's autoscaling group from how much load it has to handle,
+instead of always running three instances.
+
+A service declares what one instance can do and what it has to serve:
+
+    capacity = CapacityModel(throughput=200, latency=0.05, load=1500,
+                             peak_load=4000, cpus=2, memory=4)
+    web = Service("web", image, lb, capacity=capacity)
+
+throughput is requests per second one instance handles flat out, measured on
+an instance with at least cpus and memory (GiB), which is what InstanceFitter
+uses to pick the type.  latency is the mean response time to stay under, in
+seconds.
+
+How hard each instance can be driven comes from treating it as a single
+queue: with a service time of 1/throughput, the mean response time at
+utilization u is (1/throughput) / (1 - u), so staying under the latency
+target means u <= 1 - 1 / (throughput * latency).  That gets capped at
+target_utilization, to leave headroom for bursts while the group scales out.
+
+Everything gets sized N+1 across availability zones: with any one zone down,
+the rest still have enough capacity.  So with three zones, each zone gets
+enough for half the load.  One zone isn't allowed at all, that's a single
+point of failure.
+
+- min covers min_load, and never goes below one instance per zone.
+- desired covers load, which is where the group starts.
+- max covers peak_load.
+
+The group then gets a target tracking policy that keeps average CPU at the
+planned utilization, so it moves between min and max with the load.
+"""
+
+import math
+
+import attr
+
+from .instance_fitter import InstanceFitter
+
+
+class CapacityException(Exception):
+    pass
+
+
+def instances_for(load, instance_throughput):
+    """
+    How many instances it takes to serve load.  Anything within rounding
+    error of a whole number of instances counts as that many.
+    """
+    return int(math.ceil(float(load) / instance_throughput - 1e-9))
+
+
+@attr.s
+class CapacityPlan(object):
+    instance_type = attr.ib()
+    zones = attr.ib()
+    utilization = attr.ib()
+    instance_throughput = attr.ib()
+    # Instances per zone, as {"min": ..., "desired": ..., "max": ...}
+    per_zone = attr.ib(default=attr.Factory(dict))
+
+    @property
+    def min_size(self):
+        return self.per_zone["min"] * self.zones
+
+    @property
+    def desired_capacity(self):
+        return self.per_zone["desired"] * self.zones
+
+    @property
+    def max_size(self):
+        return self.per_zone["max"] * self.zones
+
+    def capacity_for(self, load):
+        """
+        Where target tracking should settle for a given load, still N+1 and
+        kept between min and max.
+        """
+        per_zone = instances_for(load, (self.zones - 1) *
+                                 self.instance_throughput)
+        per_zone = max(self.per_zone["min"], min(self.per_zone["max"],
+                                                 per_zone))
+        return per_zone * self.zones
+
+    def scaling_policy(self):
+        """
+        Target tracking on average CPU.  CPU is the metric that works for
+        classic ELBs; request count per target needs an ALB target group.
+        """
+        return {
+                "PredefinedMetricSpecification": {
+                    "PredefinedMetricType": "ASGAverageCPUUtilization"},
+                "TargetValue": round(self.utilization * 100, 1)
+                }
+
+
+@attr.s
+class CapacityModel(object):
+    throughput = attr.ib()
+    latency = attr.ib()
+    load = attr.ib()
+    peak_load = attr.ib(default=None)
+    min_load = attr.ib(default=0.0)
+    target_utilization = attr.ib(default=0.7)
+    cpus = attr.ib(default=None)
+    memory = attr.ib(default=None)
+    storage = attr.ib(default=None)
+
+    def instance_type(self):
+        return InstanceFitter().get_fitting_instance(
+                memory=self.memory, cpus=self.cpus, storage=self.storage)
+
+    def utilization(self):
+        """
+        The highest utilization that still meets the latency target, capped
+        at target_utilization.
+        """
+        utilization = min(self.target_utilization,
+                          1.0 - 1.0 / (self.throughput * self.latency))
+        if utilization <= 0:
+            raise CapacityException(
+                "An instance that serves %s requests a second takes %.3f "
+                "seconds per request even when idle, so it can never meet a "
+                "latency target of %s seconds.  Each instance needs to be "
+                "faster, not more of them." % (
+                    self.throughput, 1.0 / self.throughput, self.latency))
+        return utilization
+
+    def per_zone(self, load, zones, instance_throughput):
+        """
+        Instances per zone so that zones - 1 of them can serve load.
+        """
+        return max(1, instances_for(load, (zones - 1) * instance_throughput))
+
+    def plan(self, zones=3):
+        if zones < 2:
+            raise CapacityException(
+                "A service in %s availability zone goes down with that zone. "
+                "Spread it across at least two, so there's somewhere for "
+                "the load to go." % zones)
+        utilization = self.utilization()
+        instance_throughput = self.throughput * utilization
+        peak_load = self.peak_load if self.peak_load is not None else self.load
+        if peak_load < self.load:
+            raise CapacityException("Peak load %s is less than the expected "
+                                    "load %s" % (peak_load, self.load))
+        return CapacityPlan(
+                instance_type=self.instance_type(),
+                zones=zones,
+                utilization=utilization,
+                instance_throughput=instance_throughput,
+                per_zone={
+                    "min": self.per_zone(min(self.min_load, self.load), zones,
+                                         instance_throughput),
+                    "desired": self.per_zone(self.load, zones,
+                                             instance_throughput),
+                    "max": self.per_zone(peak_load, zones,
+                                         instance_throughput)})
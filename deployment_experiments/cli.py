@@ -0,0 +1,165 @@
+"""
+Command line entry point, run as:
+
+    python -m deployment_experiments subnets 10.0.0.0/16 --prefix 24 --count 3
+    python -m deployment_experiments firewalls net.json --minimize
+    python -m deployment_experiments routes paths.json --cidrs cidrs.json
+    python -m deployment_experiments plan desired.json snapshot.json
+    python -m deployment_experiments snapshot --deployment prod desired.json
+    python -m deployment_experiments daemon --socket /run/deployer.sock
+    python -m deployment_experiments request --socket /run/deployer.sock \
+        plan params.json
+
+Everything but snapshot and the daemon is offline, and every command only
+imports the modules it uses, so the offline ones start without ever loading
+boto3.  Input files are JSON in the same formats the python functions take,
+and the output is JSON on stdout.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+SOCKET = os.path.join(tempfile.gettempdir(), "deployment-experiments.sock")
+
+
+def load(path):
+    if path == "-":
+        return json.load(sys.stdin)
+    with open(path) as input_file:
+        return json.load(input_file)
+
+
+def subnets(args):
+    from .subnet_generator import generate_subnets
+    existing = args.existing.split(",") if args.existing else []
+    allocated = []
+    for subnet in generate_subnets(args.parent, existing, args.prefix):
+        allocated.append(str(subnet))
+        if len(allocated) == args.count:
+            return allocated
+    raise SystemExit("Only %d /%d subnets fit in %s" % (
+        len(allocated), args.prefix, args.parent))
+
+
+def firewalls(args):
+    from .netgraph import minimize_firewalls, net_to_firewalls
+    compiled = net_to_firewalls(load(args.net))
+    if args.minimize:
+        compiled, _ = minimize_firewalls(compiled)
+    return compiled
+
+
+def routes(args):
+    from .routegraph import compress_routes, net_to_routes
+    compiled = net_to_routes(load(args.paths))
+    if args.cidrs:
+        compiled, _ = compress_routes(compiled, load(args.cidrs))
+    return compiled
+
+
+def plan(args):
+    from .plan import Planner
+    return Planner(deployment_name=args.deployment).plan(
+            load(args.desired), load(args.snapshot), prune=not args.no_prune)
+
+
+def snapshot(args):
+    from .plan import Planner
+    desired = load(args.desired) if args.desired else None
+    return Planner(deployment_name=args.deployment).snapshot(desired)
+
+
+def daemon(args):
+    from .daemon import Daemon
+    daemon = Daemon(provider=args.provider, deployment_name=args.deployment,
+                    refresh_interval=args.refresh,
+                    max_concurrency=args.concurrency)
+    try:
+        daemon.serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    return daemon.status({})
+
+
+def request(args):
+    from .daemon import request
+    params = load(args.params) if args.params else {}
+    return request(args.socket, args.method, **params)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog="deployment_experiments")
+    commands = parser.add_subparsers(dest="command")
+
+    command = commands.add_parser("subnets", help="allocate subnets")
+    command.add_argument("parent", help="CIDR block to allocate from")
+    command.add_argument("--prefix", type=int, default=24)
+    command.add_argument("--count", type=int, default=1)
+    command.add_argument("--existing", help="comma separated CIDRs in use")
+    command.set_defaults(run=subnets)
+
+    command = commands.add_parser("firewalls",
+                                  help="compile a net into firewall rules")
+    command.add_argument("net", help="netgraph net as JSON, or - for stdin")
+    command.add_argument("--minimize", action="store_true")
+    command.set_defaults(run=firewalls)
+
+    command = commands.add_parser("routes",
+                                  help="compile paths into route tables")
+    command.add_argument("paths", help="list of paths as JSON, or - for "
+                         "stdin")
+    command.add_argument("--cidrs", help="{node: [cidrs]} as JSON, to "
+                         "compress the tables to CIDR destinations")
+    command.set_defaults(run=routes)
+
+    command = commands.add_parser("plan", help="plan changes offline")
+    command.add_argument("desired", help="desired deployment as JSON")
+    command.add_argument("snapshot", help="saved snapshot as JSON")
+    command.add_argument("--deployment", default="default")
+    command.add_argument("--no-prune", action="store_true",
+                         help="don't delete anything that isn't desired")
+    command.set_defaults(run=plan)
+
+    command = commands.add_parser("snapshot",
+                                  help="snapshot a deployment from AWS")
+    command.add_argument("desired", nargs="?",
+                         help="desired deployment as JSON, for the DNS "
+                         "zones to read")
+    command.add_argument("--deployment", default="default")
+    command.set_defaults(run=snapshot)
+
+    command = commands.add_parser("daemon", help="serve requests on a Unix "
+                                  "socket, with everything kept warm")
+    command.add_argument("--socket", default=SOCKET)
+    command.add_argument("--provider", default="aws",
+                         choices=["aws", "memory"])
+    command.add_argument("--deployment", default="default")
+    command.add_argument("--refresh", type=float, default=60.0,
+                         help="seconds between snapshot refreshes")
+    command.add_argument("--concurrency", type=int, default=16,
+                         help="most requests to run at once")
+    command.set_defaults(run=daemon)
+
+    command = commands.add_parser("request", help="send a request to a "
+                                  "running daemon")
+    command.add_argument("method", help="provision, discover, destroy, plan, "
+                         "snapshot, status or ping")
+    command.add_argument("params", nargs="?", help="the method's params as "
+                         "JSON, or - for stdin")
+    command.add_argument("--socket", default=SOCKET)
+    command.set_defaults(run=request)
+    return parser
+
+
+def main(argv=None, output=None):
+    args = parser().parse_args(argv)
+    if not getattr(args, "run", None):
+        parser().print_usage()
+        return 2
+    json.dump(args.run(args), output or sys.stdout, indent=2,
+              sort_keys=True)
+    (output or sys.stdout).write("\n")
+    return 0
@@ -0,0 +1,49 @@
+"""
+Where every AWS client comes from.
+
+All the resource classes get their clients here instead of calling
+boto3.client themselves, so every client shares one rate limiter (see
+ratelimit) and does its retries the same way.
+
+This is also the only place boto3 gets imported, and only on the first call,
+since importing it takes hundreds of milliseconds.  Anything that never
+talks to AWS (the compilers, the allocator, the CLI's offline commands) never
+pays for it.
+"""
+
+import threading
+
+from .ratelimit import RateLimiter
+
+limiter = RateLimiter()
+
+# Clients are thread safe, but creating them from boto3's default session
+# isn't.
+_lock = threading.Lock()
+
+# Clients copy the session's event handlers when they're created, so normally
+# every call gets a fresh one, and ApiRecorder (or moto) sees every client
+# made while it's installed.  Something long running, like the daemon, can
+# keep them instead with keep_warm().
+_cache = None
+
+
+def keep_warm(enabled=True):
+    global _cache
+    with _lock:
+        _cache = {} if enabled else None
+
+
+def client(service_name):
+    import boto3
+    from botocore.config import Config
+    with _lock:
+        if _cache is not None and service_name in _cache:
+            return _cache[service_name]
+        # The limiter does the retrying, so botocore's own retries are off.
+        config = Config(retries={"max_attempts": 0})
+        new_client = limiter.attach(boto3.client(service_name,
+                                                 config=config))
+        if _cache is not None:
+            _cache[service_name] = new_client
+    return new_client
@@ -0,0 +1,300 @@
+"""
+Works out which services should share a datacenter, from how much they talk
+to each other.
+
+Traffic between VPCs goes over peering (or worse), which costs money per
+gigabyte and adds latency, so chatty services want to be in the same VPC.
+But a VPC only has so much address space and so many subnets, so they can't
+all go in one.  This reads the traffic off a netgraph net, where each rule can
+say how much traffic it carries:
+
+    {"web": {"api": [{"protocol": "tcp", "port": "443", "traffic": 900}]}}
+
+(rules without one count as 1), and splits the services into datacenters so
+that as little traffic as possible crosses between them:
+
+    colocation = Colocator().optimize(net)
+    colocation.colocated_with    # {"web": None, "api": "web", ...}
+
+1. Every service starts as its own datacenter (together groups start
+   merged), and the pair of datacenters with the most traffic between them
+   gets merged, as long as the result still fits in a VPC.  Merging adds up
+   their traffic to everything else, so a datacenter that talks to both
+   halves gets pulled in next.  A heap keeps that O(E log E).
+2. Datacenters with no traffic left between them get packed together, first
+   fit decreasing, so there aren't more VPCs than there need to be.
+3. Then single moves: any service with more traffic to another datacenter
+   than to its own moves there if it fits, until nothing improves.
+
+That isn't guaranteed to be optimal (graph partitioning with capacities is
+NP hard), but it gets the clusters that matter, which are the heavy ones.
+
+Services don't get partitioned into availability zones, only into VPCs.
+Every network spans all of its datacenter's zones (see Network.provision),
+and zonal routes (routegraph.zonal_routes) keep traffic inside a VPC in the
+zone it started in.  The traffic that still crosses zones is what falls
+back when a zone's target is missing, which depends on where instances are
+and isn't known here.  Putting a service in fewer zones to save on cross
+zone traffic would make it a single point of failure anyway.
+
+colocated_with is in the format Network.provision and the planner's desired
+"networks" take: one service in each datacenter (the one with the most
+traffic inside it) gets None, meaning a new datacenter, and the rest name
+that one.
+"""
+
+import heapq
+
+import attr
+
+
+class ColocationException(Exception):
+    pass
+
+
+def traffic_edges(net, external=()):
+    """
+    {(a, b): traffic} for every pair of services with rules between them,
+    in either direction, with a < b.
+    """
+    edges = {}
+    for source, targets in net.items():
+        for target, rules in targets.items():
+            if source == target or source in external or target in external:
+                continue
+            traffic = sum(rule.get("traffic", 1) for rule in rules)
+            pair = (source, target) if source < target else (target, source)
+            edges[pair] = edges.get(pair, 0) + traffic
+    return edges
+
+
+@attr.s
+class Colocation(object):
+    datacenters = attr.ib()
+    colocated_with = attr.ib()
+    total_traffic = attr.ib()
+    cross_vpc_traffic = attr.ib()
+    zones = attr.ib()
+
+    def networks(self):
+        """
+        The planner's desired "networks" section.
+        """
+        return dict((name, {"colocated_with": anchor})
+                    for name, anchor in self.colocated_with.items())
+
+
+@attr.s
+class Colocator(object):
+    """
+    The limits are per VPC: addresses from vpc_prefix (AWS allows /16 at
+    most), and max_subnets (AWS's default quota is 200).  Each service is one
+    network, which is a subnet of subnet_prefix in each of the zones, unless
+    prefixes says otherwise for it.
+
+    together is a list of groups of services that have to share a
+    datacenter no matter what, like a service and its load balancer.
+    external names nodes in the net that aren't services, like "external".
+    """
+    vpc_prefix = attr.ib(default=16)
+    max_subnets = attr.ib(default=200)
+    subnet_prefix = attr.ib(default=28)
+    zones = attr.ib(default=3)
+    prefixes = attr.ib(default=attr.Factory(dict))
+    together = attr.ib(default=attr.Factory(list))
+    external = attr.ib(default=attr.Factory(lambda: ["external"]))
+    passes = attr.ib(default=10)
+
+    def addresses(self, service):
+        """
+        Addresses a service's network takes: one subnet per zone.
+        """
+        prefix = self.prefixes.get(service, self.subnet_prefix)
+        return self.zones * 2 ** (32 - prefix)
+
+    def fits(self, addresses, subnets):
+        # Subnets have to be aligned, so a VPC that's nearly full on paper
+        # can still be out of room for one more.  Keeping an eighth of the
+        # space spare leaves room for that.
+        limit = 2 ** (32 - self.vpc_prefix)
+        return (addresses <= limit - limit // 8 and
+                subnets <= self.max_subnets)
+
+    def optimize(self, net):
+        edges = traffic_edges(net, self.external)
+        services = set(service for pair in edges for service in pair)
+        services.update(name for name in net if name not in self.external)
+        for group in self.together:
+            services.update(group)
+        services = sorted(services)
+
+        parent = dict((service, service) for service in services)
+        usage = dict((service, (self.addresses(service), self.zones))
+                     for service in services)
+        # Traffic between each pair of datacenters, keyed by their roots
+        links = dict((service, {}) for service in services)
+        for (first, second), traffic in edges.items():
+            links[first][second] = traffic
+            links[second][first] = traffic
+
+        def find(service):
+            while parent[service] != service:
+                parent[service] = parent[parent[service]]
+                service = parent[service]
+            return service
+
+        def merged_usage(first, second):
+            return (usage[first][0] + usage[second][0],
+                    usage[first][1] + usage[second][1])
+
+        def union(first, second):
+            """
+            Merges two roots, and returns the new root along with every
+            datacenter whose traffic to it changed.
+            """
+            # The smaller set of links gets folded into the bigger one
+            if len(links[first]) < len(links[second]):
+                first, second = second, first
+            parent[second] = first
+            usage[first] = merged_usage(first, second)
+            links[first].pop(second, None)
+            changed = []
+            for other, traffic in links.pop(second).items():
+                if other == first:
+                    continue
+                del links[other][second]
+                links[first][other] = links[first].get(other, 0) + traffic
+                links[other][first] = links[first][other]
+                changed.append(other)
+            return first, changed
+
+        for service in services:
+            if not self.fits(*usage[service]):
+                raise ColocationException(
+                    "%s needs more address space than a /%d VPC has" %
+                    (service, self.vpc_prefix))
+        for group in self.together:
+            group = sorted(group)
+            for other in group[1:]:
+                if find(group[0]) != find(other):
+                    union(find(group[0]), find(other))
+        for root in set(find(service) for service in services):
+            if not self.fits(*usage[root]):
+                raise ColocationException(
+                    "Services that have to be together don't fit in one "
+                    "VPC: %s" % ", ".join(service for service in services
+                                          if find(service) == root))
+
+        heap = [(-traffic, first, second)
+                for first in links for second, traffic in links[first].items()
+                if first < second]
+        heapq.heapify(heap)
+        while heap:
+            traffic, first, second = heapq.heappop(heap)
+            # Entries go stale when either end gets merged into something
+            # else, or when the traffic between them goes up.  The up to
+            # date one is in the heap too.
+            if (parent[first] != first or parent[second] != second or
+                    links[first].get(second) != -traffic):
+                continue
+            if not self.fits(*merged_usage(first, second)):
+                continue
+            root, changed = union(first, second)
+            for other in changed:
+                heapq.heappush(heap, (-links[root][other], min(root, other),
+                                      max(root, other)))
+
+        self.pack(sorted(set(find(service) for service in services),
+                         key=lambda root: (-usage[root][0], root)),
+                  usage, union)
+        clusters = dict((service, find(service)) for service in services)
+        self.refine(clusters, edges, services)
+        return self.colocation(clusters, edges)
+
+    def pack(self, roots, usage, union):
+        """
+        Whatever's left with no traffic between them still goes into as few
+        datacenters as fit, first fit decreasing, since an account only gets
+        so many VPCs.
+        """
+        bins = []
+        for root in roots:
+            for index, packed in enumerate(bins):
+                if self.fits(usage[packed][0] + usage[root][0],
+                             usage[packed][1] + usage[root][1]):
+                    bins[index], _ = union(packed, root)
+                    break
+            else:
+                bins.append(root)
+
+    def refine(self, clusters, edges, services):
+        """
+        Moves single services to the datacenter they talk to most, when it
+        fits and it's better than where they are.  Services in a together
+        group stay put, since they'd have to move as a group.
+        """
+        pinned = set(service for group in self.together for service in group)
+        neighbours = dict((service, {}) for service in services)
+        for (first, second), traffic in edges.items():
+            neighbours[first][second] = traffic
+            neighbours[second][first] = traffic
+        usage = {}
+        for service, cluster in clusters.items():
+            used = usage.setdefault(cluster, [0, 0])
+            used[0] += self.addresses(service)
+            used[1] += self.zones
+
+        for _ in range(self.passes):
+            moved = False
+            for service in services:
+                if service in pinned:
+                    continue
+                current = clusters[service]
+                traffic = {}
+                for neighbour, weight in neighbours[service].items():
+                    cluster = clusters[neighbour]
+                    traffic[cluster] = traffic.get(cluster, 0) + weight
+                best = current
+                for cluster, weight in sorted(traffic.items()):
+                    if weight <= traffic.get(best, 0):
+                        continue
+                    if self.fits(usage[cluster][0] + self.addresses(service),
+                                 usage[cluster][1] + self.zones):
+                        best = cluster
+                if best != current:
+                    usage[current][0] -= self.addresses(service)
+                    usage[current][1] -= self.zones
+                    usage[best][0] += self.addresses(service)
+                    usage[best][1] += self.zones
+                    clusters[service] = best
+                    moved = True
+            if not moved:
+                return
+
+    def colocation(self, clusters, edges):
+        members = {}
+        for service, cluster in clusters.items():
+            members.setdefault(cluster, []).append(service)
+        internal = dict((service, 0) for service in clusters)
+        cross = 0
+        for (first, second), traffic in edges.items():
+            if clusters[first] == clusters[second]:
+                internal[first] += traffic
+                internal[second] += traffic
+            else:
+                cross += traffic
+
+        colocated_with = {}
+        datacenters = []
+        for cluster in members.values():
+            anchor = min(cluster, key=lambda service: (-internal[service],
+                                                       service))
+            for service in cluster:
+                colocated_with[service] = (None if service == anchor
+                                           else anchor)
+            datacenters.append(sorted(cluster))
+        return Colocation(datacenters=sorted(datacenters),
+                          colocated_with=colocated_with,
+                          total_traffic=sum(edges.values()),
+                          cross_vpc_traffic=cross,
+                          zones=self.zones)
@@ -0,0 +1,167 @@
+"""
+A compact, integer indexed version of the paths routegraph works with, plus
+the port parsing and interning the other compilers share.
+
+The dict formats are nice to read and write by hand, but a real service graph
+has tens of thousands of paths.  So here node ids get interned into integers
+once, paths live in one flat array, and route tables are stored CSR style (an
+offsets array indexed by node into flat arrays of rows).
+
+The dict formats are still the way in and out, through the from_*/to_*
+functions.  Firewalls don't go through here: every rule has to come out as a
+dict anyway, so netgraph building them straight from the net dicts is
+cheaper than interning on the way in.
+
+There's no numpy dependency, so "vectorized" here means flat array passes and
+counting sorts instead of per edge dict allocation.
+"""
+
+from array import array
+
+import attr
+
+
+def parse_ports(port):
+    """
+    Ports show up as strings, either a single port like "443" or a range like
+    "8000-8080".  Returns an inclusive (start, end) tuple.
+
+    AWS uses "-1" for all ports (protocol -1, and icmp), so a leading "-" is
+    a sign, not a range.
+    """
+    port = str(port)
+    sign = ""
+    if port.startswith("-"):
+        sign, port = "-", port[1:]
+    start, _, end = port.partition("-")
+    start = int(sign + start)
+    return start, int(end) if end else start
+
+
+def format_ports(start, end):
+    if start == end:
+        return str(start)
+    return "%s-%s" % (start, end)
+
+
+@attr.s
+class Interner(object):
+    """
+    Maps names to small integers and back.
+    """
+    names = attr.ib(default=attr.Factory(list))
+    index = attr.ib(default=attr.Factory(dict))
+
+    def intern(self, name):
+        try:
+            return self.index[name]
+        except KeyError:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            return self.index[name]
+
+    def __len__(self):
+        return len(self.names)
+
+
+def group_by(keys, count):
+    """
+    Stable counting sort.  Given a key per row and the number of distinct
+    keys, returns CSR offsets and the row order that groups rows by key.
+    """
+    offsets = array("l", [0]) * (count + 1)
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+    cursor = array("l", offsets)
+    order = array("l", [0]) * len(keys)
+    for row, key in enumerate(keys):
+        order[cursor[key]] = row
+        cursor[key] += 1
+    return offsets, order
+
+
+@attr.s
+class CompactPaths(object):
+    """
+    A routegraph net (a list of paths) as one flat array of node ids, with
+    path p being path_nodes[path_offsets[p]:path_offsets[p + 1]].
+    """
+    nodes = attr.ib(default=attr.Factory(Interner))
+    path_offsets = attr.ib(default=attr.Factory(lambda: array("l", [0])))
+    path_nodes = attr.ib(default=attr.Factory(lambda: array("l")))
+
+    @classmethod
+    def from_paths(cls, paths):
+        compact = cls()
+        for path in paths:
+            assert len(path) > 1
+            compact.path_nodes.extend(compact.nodes.intern(node)
+                                      for node in path)
+            compact.path_offsets.append(len(compact.path_nodes))
+        return compact
+
+    def to_paths(self):
+        names = self.nodes.names
+        return [[names[node_id] for node_id
+                 in self.path_nodes[self.path_offsets[p]:
+                                    self.path_offsets[p + 1]]]
+                for p in range(len(self.path_offsets) - 1)]
+
+    def compile_routes(self):
+        """
+        Every hop in every path turns into two route rows, one forward towards
+        the end of the path and one back towards the start.  Rows get emitted
+        path by path and then grouped by node with a stable sort, so each
+        node's table keeps the order the paths were given in.
+        """
+        route_nodes = array("l")
+        destinations = array("l")
+        targets = array("l")
+        for p in range(len(self.path_offsets) - 1):
+            start = self.path_offsets[p]
+            end = self.path_offsets[p + 1]
+            src = self.path_nodes[start]
+            dest = self.path_nodes[end - 1]
+            for hop in range(start, end - 1):
+                first = self.path_nodes[hop]
+                second = self.path_nodes[hop + 1]
+                route_nodes.append(first)
+                destinations.append(dest)
+                targets.append(second)
+                route_nodes.append(second)
+                destinations.append(src)
+                targets.append(first)
+        offsets, order = group_by(route_nodes, len(self.nodes))
+        return CompactRoutes(nodes=self.nodes,
+                             offsets=offsets,
+                             destinations=array("l", (destinations[row]
+                                                      for row in order)),
+                             targets=array("l", (targets[row]
+                                                 for row in order)))
+
+
+@attr.s
+class CompactRoutes(object):
+    """
+    Route tables in CSR form.  The routes for node n are the rows offsets[n]
+    to offsets[n + 1] of the destinations and targets arrays.
+    """
+    nodes = attr.ib(type=Interner)
+    offsets = attr.ib()
+    destinations = attr.ib()
+    targets = attr.ib()
+
+    def to_routes(self, exclude=("external",)):
+        names = self.nodes.names
+        routes = {}
+        for node_id, node in enumerate(names):
+            if node in exclude:
+                continue
+            routes[node] = [{
+                "destination": names[self.destinations[row]],
+                "target": names[self.targets[row]]
+                } for row in range(self.offsets[node_id],
+                                   self.offsets[node_id + 1])]
+        return routes
@@ -0,0 +1,426 @@
+"""
+A long running deployer, so CI doesn't pay for a cold start on every deploy.
+
+    python -m deployment_experiments daemon --socket /run/deployer.sock
+
+A fresh process imports boto3, builds its clients, and snapshots the whole
+deployment before it can do anything, and for a small deploy that's most of
+the time it takes.  The daemon does all of that once and keeps it:
+
+- clients get built once and reused (see clients.keep_warm), with boto3
+  already imported.
+- images are kept by their plugins, so each AMI only gets built once.
+- every deployment it's asked to plan has its snapshot kept, and a
+  background thread refreshes them every refresh_interval seconds.  Anything
+  that provisions or destroys in a deployment marks its snapshot stale, so
+  the next plan takes a fresh one instead of planning against old state.
+- every refresh also records how many addresses each datacenter uses, in
+  history, as the {datacenter: [(time, used addresses)]} that
+  fragmentation.analyze wants.  Only the last history_length samples per
+  deployment are kept.
+
+Only plan and snapshot use the kept snapshots.  provision, discover and
+destroy go through the resource classes, which still look up their VPCs and
+subnets in AWS on every call.
+
+It listens on a Unix socket, and the protocol is JSON lines.  Each request
+is one line:
+
+    {"id": 1, "method": "provision", "params": {"kind": "network",
+                                                "name": "web"}}
+
+and gets back one line with the same id, and either "result" or "error":
+
+    {"id": 1, "result": ["subnet-1", "subnet-2", "subnet-3"]}
+
+Every request runs on its own thread (up to max_concurrency at once), even
+several from the same connection, so responses can come back in a different
+order than the requests went in.  That's what the ids are for.
+
+The methods are provision, discover and destroy, which take a "kind" of
+network, load_balancer or service plus that resource's arguments, and plan,
+snapshot, status and ping.  request() is a client for all of them.  Plans
+and snapshots come from the Planner, which only knows aws, so a memory
+daemon turns those down.
+"""
+
+import json
+import os
+import socket
+import threading
+import timeit
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import attr
+
+from . import clients
+from .fragmentation import usage
+
+WARM_SERVICES = ["ec2", "elb", "autoscaling", "route53"]
+
+
+class DaemonException(Exception):
+    pass
+
+
+def error(e):
+    return {"type": type(e).__name__, "message": str(e)}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    Reads requests off one connection and hands each one to its own thread.
+    """
+
+    def handle(self):
+        daemon = self.server.daemon
+        write_lock = threading.Lock()
+        threads = []
+
+        def respond(line):
+            try:
+                response = daemon.handle(json.loads(line))
+            except ValueError as e:
+                response = {"id": None, "error": error(e)}
+            # default=str is for the datetimes in boto3's responses
+            data = (json.dumps(response, sort_keys=True, default=str) +
+                    "\n").encode("utf-8")
+            with write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        def run(line):
+            try:
+                respond(line)
+            finally:
+                daemon.slots.release()
+
+        for line in iter(self.rfile.readline, b""):
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            daemon.slots.acquire()
+            thread = threading.Thread(target=run, args=(line,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@attr.s
+class Daemon(object):
+    provider = attr.ib(default="aws")
+    deployment_name = attr.ib(default="default")
+    refresh_interval = attr.ib(default=60.0)
+    max_concurrency = attr.ib(default=16)
+    clock = attr.ib(default=timeit.default_timer)
+    history_length = attr.ib(default=1440)
+    snapshots = attr.ib(default=attr.Factory(dict))
+    history = attr.ib(default=attr.Factory(dict))
+    images = attr.ib(default=attr.Factory(dict))
+    served = attr.ib(default=0)
+    started = attr.ib(default=None)
+    slots = attr.ib(default=None)
+    server = attr.ib(default=None)
+    _lock = attr.ib(default=attr.Factory(threading.RLock))
+    _deployment_locks = attr.ib(default=attr.Factory(dict))
+    _image_locks = attr.ib(default=attr.Factory(dict))
+    _invalidations = attr.ib(default=attr.Factory(dict))
+    _stop = attr.ib(default=attr.Factory(threading.Event))
+
+    def __attrs_post_init__(self):
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.started = self.clock()
+
+    def warm(self):
+        """
+        Imports boto3 and builds the clients up front, so the first request
+        doesn't wait for them.
+        """
+        clients.keep_warm()
+        if self.provider == "aws":
+            for service_name in WARM_SERVICES:
+                clients.client(service_name)
+
+    # Resources
+
+    def image(self, plugins, build=False):
+        """
+        One VirtualMachine per set of plugins, so its AMI gets kept.  With
+        build, its AMI gets built now, under a lock per set of plugins, so
+        two services with the same plugins don't both build it.
+        """
+        from .virtual_machine import VirtualMachine, VirtualMachinePlugin
+        key = tuple(tuple(plugin) for plugin in plugins)
+        with self._lock:
+            if key not in self.images:
+                self.images[key] = VirtualMachine(
+                    plugins=[VirtualMachinePlugin(*plugin)
+                             for plugin in plugins])
+                self._image_locks[key] = threading.Lock()
+            image, lock = self.images[key], self._image_locks[key]
+        if build:
+            with lock:
+                image.get()
+        return image
+
+    def resource(self, params, build=False):
+        """
+        Builds the resource a request is about.  Services say which load
+        balancer they're behind as {"name": ..., "dns": ...}, and optionally
+        give a capacity, as CapacityModel's arguments.
+
+        Only networks take a deployment.  Load balancers and services end up
+        in whatever deployment owns the subnets they're colocated with.
+        """
+        from .network import Network
+        from .service import LoadBalancer, Service
+        kind = params.get("kind")
+        if kind == "network":
+            return Network(provider=self.provider,
+                           deployment_name=params.get("deployment",
+                                                      self.deployment_name))
+        elif "deployment" in params:
+            raise DaemonException("A %s doesn't take a deployment, it goes "
+                                  "wherever it's colocated" % (kind,))
+        if kind == "load_balancer":
+            return LoadBalancer(params["name"], params["dns"],
+                                provider=self.provider)
+        elif kind == "service":
+            from .capacity import CapacityModel
+            load_balancer = params["load_balancer"]
+            capacity = params.get("capacity")
+            return Service(params["name"],
+                           self.image(params.get("plugins", []), build),
+                           LoadBalancer(load_balancer["name"],
+                                        load_balancer["dns"],
+                                        provider=self.provider),
+                           provider=self.provider,
+                           capacity=(CapacityModel(**capacity) if capacity
+                                     else None))
+        raise DaemonException("Unknown kind %r, it should be network, "
+                              "load_balancer or service" % (kind,))
+
+    def provision(self, params):
+        resource = self.resource(params, build=True)
+        try:
+            if params["kind"] == "network":
+                return resource.provision(
+                        network_name=params["name"],
+                        colocated_network=params.get("colocated_with"))
+            elif params["kind"] == "service":
+                return resource.provision(
+                        colocated_service=params.get("colocated_with"))
+            return resource.provision()
+        finally:
+            # Even a failed provision can leave half of it behind
+            self.invalidate_for(params)
+
+    def discover(self, params):
+        resource = self.resource(params)
+        if params["kind"] == "network":
+            return resource.discover(params["name"])
+        return resource.discover()
+
+    def destroy(self, params):
+        resource = self.resource(params)
+        try:
+            if params["kind"] == "network":
+                return resource.destroy(params["name"])
+            return resource.destroy()
+        finally:
+            self.invalidate_for(params)
+
+    # Snapshots
+
+    def deployment_lock(self, deployment_name):
+        with self._lock:
+            return self._deployment_locks.setdefault(deployment_name,
+                                                     threading.Lock())
+
+    def invalidate(self, deployment_name):
+        """
+        Marks the snapshot stale, and counts it, so a refresh that was
+        already running when this happened knows its snapshot might be from
+        before the change.
+        """
+        with self._lock:
+            self._invalidations[deployment_name] = \
+                self._invalidations.get(deployment_name, 0) + 1
+            if deployment_name in self.snapshots:
+                self.snapshots[deployment_name]["stale"] = True
+
+    def invalidate_for(self, params):
+        """
+        Marks stale whatever a request could have changed: its deployment
+        for a network, and every deployment for anything else, since those
+        don't know which deployment they're in.
+        """
+        if params.get("kind") == "network":
+            self.invalidate(params.get("deployment", self.deployment_name))
+        else:
+            with self._lock:
+                deployments = list(self.snapshots)
+            for deployment_name in deployments:
+                self.invalidate(deployment_name)
+
+    def refresh(self, deployment_name, desired=None):
+        """
+        Takes a new snapshot.  Only one refresh per deployment runs at a
+        time, and anything that wanted one while it ran gets that one.
+        """
+        from .plan import Planner
+        if self.provider != "aws":
+            raise DaemonException("Snapshots and plans only work against "
+                                  "aws, not %s" % self.provider)
+        lock = self.deployment_lock(deployment_name)
+        requested = self.clock()
+        with lock:
+            with self._lock:
+                cached = self.snapshots.get(deployment_name)
+                if desired is None and cached:
+                    desired = cached["desired"]
+                if (cached and not cached["stale"] and
+                        cached["updated"] >= requested and
+                        cached["desired"] == desired):
+                    return cached["snapshot"]
+                invalidations = self._invalidations.get(deployment_name, 0)
+            planner = Planner(provider=self.provider,
+                              deployment_name=deployment_name)
+            started = self.clock()
+            snapshot = planner.snapshot(desired)
+            used = usage(snapshot)
+            with self._lock:
+                stale = (self._invalidations.get(deployment_name, 0) !=
+                         invalidations)
+                self.snapshots[deployment_name] = {
+                        "snapshot": snapshot, "desired": desired,
+                        "updated": started, "stale": stale}
+                history = self.history.setdefault(deployment_name, {})
+                for datacenter, addresses in used.items():
+                    samples = history.setdefault(datacenter, [])
+                    samples.append((started, addresses))
+                    del samples[:-self.history_length]
+            return snapshot
+
+    def snapshot(self, params, desired=None):
+        deployment_name = params.get("deployment", self.deployment_name)
+        if params.get("refresh"):
+            return self.refresh(deployment_name, desired)
+        with self._lock:
+            cached = self.snapshots.get(deployment_name)
+            if (cached and not cached["stale"] and
+                    (desired is None or cached["desired"] == desired)):
+                return cached["snapshot"]
+        return self.refresh(deployment_name, desired)
+
+    def plan(self, params):
+        from .plan import Planner
+        deployment_name = params.get("deployment", self.deployment_name)
+        desired = params["desired"]
+        snapshot = self.snapshot(params, desired)
+        return Planner(provider=self.provider,
+                       deployment_name=deployment_name).plan(
+                           desired, snapshot,
+                           prune=params.get("prune", True))
+
+    def refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            with self._lock:
+                deployments = list(self.snapshots)
+            for deployment_name in deployments:
+                try:
+                    self.refresh(deployment_name)
+                except Exception:
+                    # Whatever broke will show up on the next request that
+                    # needs the snapshot, this just keeps the loop going.
+                    self.invalidate(deployment_name)
+
+    # Requests
+
+    def status(self, params):
+        now = self.clock()
+        with self._lock:
+            return {"provider": self.provider,
+                    "uptime": now - self.started,
+                    "served": self.served,
+                    "images": len(self.images),
+                    "snapshots": dict(
+                        (name, {"age": now - cached["updated"],
+                                "stale": cached["stale"]})
+                        for name, cached in self.snapshots.items())}
+
+    def ping(self, params):
+        return "pong"
+
+    def handle(self, request):
+        """
+        Runs one request, and returns its response.  Nothing raised in here
+        gets past it, it all becomes an error response.
+        """
+        request_id = request.get("id")
+        method = request.get("method")
+        with self._lock:
+            self.served += 1
+        if method not in ("provision", "discover", "destroy", "plan",
+                          "snapshot", "status", "ping"):
+            return {"id": request_id,
+                    "error": error(DaemonException("Unknown method %r" %
+                                                   (method,)))}
+        try:
+            result = getattr(self, method)(request.get("params") or {})
+        except Exception as e:
+            return {"id": request_id, "error": error(e)}
+        return {"id": request_id, "result": result}
+
+    def serve(self, socket_path):
+        """
+        Serves until stop() is called.
+        """
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.warm()
+        self.server = Server(socket_path, Handler)
+        self.server.daemon = self
+        refresher = threading.Thread(target=self.refresh_loop)
+        refresher.daemon = True
+        refresher.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(socket_path)
+
+    def stop(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def request(socket_path, method, **params):
+    """
+    Sends one request to a daemon and returns its result, or raises a
+    DaemonException with the daemon's error.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps({"id": 1, "method": method,
+                                        "params": params}) +
+                            "\n").encode("utf-8"))
+        connection.shutdown(socket.SHUT_WR)
+        response = json.loads(connection.makefile("rb").readline().decode(
+            "utf-8"))
+    finally:
+        connection.close()
+    if "error" in response:
+        raise DaemonException("%(type)s: %(message)s" % response["error"])
+    return response["result"]
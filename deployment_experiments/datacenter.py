@@ -1,9 +1,40 @@
 #!/usr/bin/env python
 
+import threading
+from contextlib import contextmanager
+
 import attr
-import boto3
 
-from subnet_generator import generate_subnets
+from . import clients
+from . import memory
+from .firewall_compiler import FirewallCompiler
+from .subnet_generator import generate_subnets
+
+# Picking a free CIDR block and claiming it has to happen as one step, or two
+# threads (or coroutines, see aio) creating at once both get the same block.
+# Network carves subnets under it too.  Only the picking happens under the
+# lock: a picked block goes in pending_blocks, under the block it was picked
+# from, until whatever it's for exists in AWS, and the creating happens
+# outside the lock, so creates for different blocks overlap.
+allocation_lock = threading.RLock()
+pending_blocks = {}
+
+
+@contextmanager
+def reserved(parent, blocks):
+    """
+    Keeps blocks picked from parent in pending_blocks until the with block is
+    done.  By then they either exist, so anyone picking finds them in AWS,
+    or creating them failed, and they're free again.
+    """
+    try:
+        yield
+    finally:
+        with allocation_lock:
+            pending = pending_blocks.get(parent, set())
+            pending.difference_update(blocks)
+            if not pending:
+                pending_blocks.pop(parent, None)
 
 
 @attr.s
@@ -29,11 +60,14 @@ class DatacenterInventory(object):
         # discover all VPCs in this account, or all VPCs in a geographic
         # region).  I don't want this to encourage working with VPCs directly.
         if self.provider == "aws":
-            ec2 = boto3.client("ec2")
+            ec2 = clients.client("ec2")
             deployment_filter = {'Name': "tag:cloud-deployer-deployment",
                                  'Values': [self.deployment_name]}
             return [vpc["VpcId"] for vpc
                     in ec2.describe_vpcs(Filters=[deployment_filter])["Vpcs"]]
+        elif self.provider == "memory":
+            return [vpc["id"] for vpc in memory.cloud.describe_vpcs(
+                tags={"cloud-deployer-deployment": self.deployment_name})]
         else:
             return []
 
@@ -56,22 +90,28 @@ class Datacenter(object):
     def aws_create(self, private_block="10.0.0.0/8"):
         # TODO: I think this throws an exception, but figure out proper error
         # handling.
-        ec2 = boto3.client("ec2")
-        existing_cidrs = []
-        if self.siblings:
-            sibling_ids = [dc_id for dc_id in self.siblings.get()]
-            dc = Datacenter()
-            for sibling_id in sibling_ids:
-                sibling_dc = dc.discover(sibling_id)
-                existing_cidrs.append(sibling_dc["Vpcs"][0]["CidrBlock"])
-        new_cidr = str(generate_subnets(private_block,
-                                        existing_cidrs,
-                                        self.prefix).next())
-        vpc = ec2.create_vpc(CidrBlock=new_cidr)
-        vpc_id = vpc["Vpc"]["VpcId"]
-        ec2.create_tags(Resources=[vpc_id],
-                        Tags=[{"Key": "cloud-deployer-deployment",
-                               "Value": self.deployment_name}])
+        ec2 = clients.client("ec2")
+        with allocation_lock:
+            existing_cidrs = []
+            if self.siblings:
+                sibling_ids = [dc_id for dc_id in self.siblings.get()]
+                dc = Datacenter()
+                for sibling_id in sibling_ids:
+                    sibling_dc = dc.discover(sibling_id)
+                    existing_cidrs.append(sibling_dc["Vpcs"][0]["CidrBlock"])
+            existing_cidrs.extend(pending_blocks.get(private_block, ()))
+            new_cidr = str(next(generate_subnets(private_block,
+                                                 existing_cidrs,
+                                                 self.prefix)))
+            pending_blocks.setdefault(private_block, set()).add(new_cidr)
+        # Siblings get found by their tag, so it's only really taken once
+        # it's tagged
+        with reserved(private_block, [new_cidr]):
+            vpc = ec2.create_vpc(CidrBlock=new_cidr)
+            vpc_id = vpc["Vpc"]["VpcId"]
+            ec2.create_tags(Resources=[vpc_id],
+                            Tags=[{"Key": "cloud-deployer-deployment",
+                                   "Value": self.deployment_name}])
 
         # TODO: Figure out whether I really want this.  Should every DC have an
         # internet gatway by default?  Doesn't AWS already do that?
@@ -83,24 +123,49 @@ class Datacenter(object):
     def aws_discover(self, dc_id):
         # TODO: I think this throws an exception, but figure out proper error
         # handling.
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         return ec2.describe_vpcs(Filters=[{"Name": "vpc-id",
                                            "Values": [dc_id]}])
 
+    def memory_create(self, private_block="10.0.0.0/8"):
+        # The allocator only knows about this deployment's datacenters, which
+        # is what the siblings are supposed to be.
+        return memory.cloud.create_vpc(self.deployment_name, private_block,
+                                       self.prefix)
+
+    def memory_discover(self, dc_id):
+        return {"Vpcs": [{"VpcId": vpc["id"], "CidrBlock": vpc["cidr"]}
+                         for vpc in memory.cloud.describe_vpcs([dc_id])]}
+
+    def memory_destroy(self, dc_id):
+        memory.cloud.delete_vpc(dc_id)
+
     def create(self, private_block="10.0.0.0/8"):
         if self.provider == "aws":
             return self.aws_create(private_block)
+        elif self.provider == "memory":
+            return self.memory_create(private_block)
         else:
             raise NotImplemented
 
     def discover(self, dc_id):
         if self.provider == "aws":
             return self.aws_discover(dc_id)
+        elif self.provider == "memory":
+            return self.memory_discover(dc_id)
         else:
             raise NotImplemented
 
     def destroy(self, dc_id):
-        ec2 = boto3.client("ec2")
+        if self.provider == "aws":
+            return self.aws_destroy(dc_id)
+        elif self.provider == "memory":
+            return self.memory_destroy(dc_id)
+        else:
+            raise NotImplemented
+
+    def aws_destroy(self, dc_id):
+        ec2 = clients.client("ec2")
         # TODO: Figure out whether I really want this.  Should every DC have an
         # internet gatway by default?  Doesn't AWS already do that?
         # XXX: Moto hasn't implemented filters on this function yet...
@@ -115,4 +180,7 @@ class Datacenter(object):
         for igw_id in igw_ids:
             ec2.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=dc_id)
             ec2.delete_internet_gateway(InternetGatewayId=igw_id)
+        # Whatever security groups are left would keep the VPC around
+        FirewallCompiler(deployment_name=self.deployment_name).destroy(
+                vpc_id=dc_id)
         return ec2.delete_vpc(VpcId=dc_id)
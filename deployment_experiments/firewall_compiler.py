@@ -13,12 +13,294 @@ And just generate the ingress/egress rules.
 Is there any real work that needs to be done here?
 
 I think a little.  If only to just change the format.
+
+The "X should be able to access Y" part is netgraph.net_to_firewalls.  This
+takes that output and makes it real: every node is a network, so it resolves
+to the CIDR blocks of that network's subnets, and gets a security group in
+that network's VPC.  Then it diffs against what's already in the security
+groups and only applies the difference, with one call per group and direction
+rather than one per rule.
+
+Service launch configurations put their instances in these groups, so the
+rules are what the instances actually get.  AWS puts an allow-all egress rule
+in every new group, and since that's not in the net, the first apply revokes
+it like anything else that isn't wanted.  Egress ends up exactly what the net
+says, and a node with no outgoing edges can't send anything.
 """
 
 import attr
 
+from . import clients
+from .compactgraph import parse_ports
+from .subnet_generator import collapse_cidrs
+
+EXTERNAL_CIDRS = ["0.0.0.0/0"]
+
+
+def permissions_to_rules(permissions):
+    """
+    Flattens EC2 IpPermissions into a set of (protocol, from port, to port,
+    cidr) tuples, which is what makes diffing easy.  Anything that isn't a
+    plain IPv4 CIDR (security group references, prefix lists) is ignored,
+    since we never create those.
+    """
+    rules = set()
+    for permission in permissions:
+        for ip_range in permission.get("IpRanges", []):
+            rules.add((permission["IpProtocol"],
+                       permission.get("FromPort", -1),
+                       permission.get("ToPort", -1),
+                       ip_range["CidrIp"]))
+    return rules
+
+
+def group_rules(groups):
+    """
+    {node: {"ingress": rules, "egress": rules}} for security group
+    descriptions.
+    """
+    return dict((node, {
+        "ingress": permissions_to_rules(group["IpPermissions"]),
+        "egress": permissions_to_rules(group["IpPermissionsEgress"])})
+        for node, group in groups.items())
+
+
+def rules_to_permissions(rules):
+    """
+    The reverse of permissions_to_rules, grouping every CIDR with the same
+    protocol and port range into one IpPermission.
+    """
+    grouped = {}
+    for protocol, from_port, to_port, cidr in rules:
+        grouped.setdefault((protocol, from_port, to_port), []).append(cidr)
+    permissions = []
+    for (protocol, from_port, to_port), cidrs in sorted(grouped.items()):
+        permission = {
+                "IpProtocol": protocol,
+                "IpRanges": [{"CidrIp": cidr} for cidr in sorted(cidrs)]
+                }
+        if protocol != "-1":
+            permission["FromPort"] = from_port
+            permission["ToPort"] = to_port
+        permissions.append(permission)
+    return permissions
+
+
 @attr.s
 class FirewallCompiler(object):
+    """
+    Compiles netgraph firewalls into security groups.  Each node gets a
+    security group named after it in the VPC its network lives in, tagged the
+    same way the network's subnets are.
+
+    max_rules is how many rules AWS lets a security group have in each
+    direction.
+    """
+    provider = attr.ib(default="aws")
+    deployment_name = attr.ib(default="default")
+    max_rules = attr.ib(default=60)
+
+    def aws_network_subnets(self):
+        """
+        All the subnets in this deployment, grouped by network name.  This is
+        one describe call no matter how many networks there are.
+        """
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        networks = {}
+        for subnet in ec2.describe_subnets(
+                Filters=[deployment_filter])["Subnets"]:
+            tags = dict((tag["Key"], tag["Value"])
+                        for tag in subnet.get("Tags", []))
+            if "cloud-deployer-network" in tags:
+                networks.setdefault(tags["cloud-deployer-network"],
+                                    []).append(subnet)
+        return networks
+
+    def resolve_cidrs(self, network_subnets):
+        """
+        Turns each network into the fewest CIDR blocks that cover its subnets.
+        """
+        cidrs = {"external": EXTERNAL_CIDRS}
+        for network_name, subnets in network_subnets.items():
+            cidrs[network_name] = collapse_cidrs(subnet["CidrBlock"]
+                                                 for subnet in subnets)
+        return cidrs
+
+    def generate_rules(self, firewalls, cidrs):
+        """
+        Resolves the sources of every rule to CIDR blocks.  Returns
+        {node: {"ingress": rules, "egress": rules}} where rules is a set of
+        (protocol, from port, to port, cidr) tuples.
+
+        Sources can be comma separated, like the output of
+        netgraph.minimize_firewalls.  A source that doesn't resolve to any
+        network is an error, because silently dropping it would mean silently
+        dropping access that someone asked for.
+        """
+        rules = {}
+        for node, node_rules in firewalls.items():
+            rules[node] = {"ingress": set(), "egress": set()}
+            for rule in node_rules:
+                from_port, to_port = parse_ports(rule["port"])
+                for source in rule["source"].split(","):
+                    if source not in cidrs:
+                        raise KeyError("Node %s has a rule for %s, but there "
+                                       "is no network named %s in deployment "
+                                       "%s" % (node, source, source,
+                                               self.deployment_name))
+                    for cidr in cidrs[source]:
+                        rules[node][rule["type"]].add(
+                            (rule["protocol"], from_port, to_port, cidr))
+        return rules
+
+    def aws_security_groups(self, nodes, network_subnets):
+        """
+        Finds the security group for each node, creating any that don't exist
+        yet.  Returns {node: security group description}.
+        """
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        groups = {}
+        for group in ec2.describe_security_groups(
+                Filters=[deployment_filter])["SecurityGroups"]:
+            tags = dict((tag["Key"], tag["Value"])
+                        for tag in group.get("Tags", []))
+            if tags.get("cloud-deployer-network") in nodes:
+                groups[tags["cloud-deployer-network"]] = group
+        for node in nodes:
+            if node in groups:
+                continue
+            if node not in network_subnets:
+                raise KeyError("Can't create a security group for %s, there "
+                               "is no network named %s in deployment %s" %
+                               (node, node, self.deployment_name))
+            vpc_id = network_subnets[node][0]["VpcId"]
+            group_name = "%s-%s" % (self.deployment_name, node)
+            group_id = ec2.create_security_group(
+                    GroupName=group_name,
+                    Description="cloud-deployer rules for %s" % node,
+                    VpcId=vpc_id)["GroupId"]
+            ec2.create_tags(Resources=[group_id],
+                            Tags=[{"Key": "cloud-deployer-deployment",
+                                   "Value": self.deployment_name},
+                                  {"Key": "cloud-deployer-network",
+                                   "Value": node}])
+            groups[node] = ec2.describe_security_groups(
+                    GroupIds=[group_id])["SecurityGroups"][0]
+        return groups
+
+    def diff(self, rules, groups):
+        """
+        Compares the rules we want with what's in each security group.
+        Returns {node: {"authorize_ingress": rules, "revoke_ingress": rules,
+        "authorize_egress": rules, "revoke_egress": rules}}, leaving out
+        anything that's already right.
+        """
+        return self.diff_rules(rules, group_rules(groups))
+
+    def diff_rules(self, rules, existing_rules):
+        """
+        Same as diff, but against {node: {"ingress": rules, "egress": rules}}
+        rather than security group descriptions, for when the existing rules
+        came from somewhere else (like a plan.Planner snapshot).
+        """
+        changes = {}
+        for node, wanted in rules.items():
+            existing = existing_rules[node]
+            node_changes = {}
+            for rule_type in ["ingress", "egress"]:
+                authorize = wanted[rule_type] - existing[rule_type]
+                revoke = existing[rule_type] - wanted[rule_type]
+                if authorize:
+                    node_changes["authorize_%s" % rule_type] = authorize
+                if revoke:
+                    node_changes["revoke_%s" % rule_type] = revoke
+            if node_changes:
+                changes[node] = node_changes
+        return changes
+
+    def aws_apply(self, firewalls):
+        network_subnets = self.aws_network_subnets()
+        cidrs = self.resolve_cidrs(network_subnets)
+        rules = self.generate_rules(firewalls, cidrs)
+        groups = self.aws_security_groups(rules.keys(), network_subnets)
+        existing = group_rules(groups)
+        changes = self.diff_rules(rules, existing)
+        self.aws_execute(changes, dict((node, group["GroupId"])
+                                       for node, group in groups.items()),
+                         dict((node, dict((rule_type, len(node_rules))
+                                          for rule_type, node_rules
+                                          in existing[node].items()))
+                              for node in changes))
+        return changes
+
+    def aws_execute(self, changes, group_ids, rule_counts):
+        """
+        Makes the calls for changes from diff, given each node's security
+        group id, and how many rules each group has now as {node:
+        {"ingress": count, "egress": count}}.
+
+        New rules go in before the old ones come out, so nothing that's
+        allowed both before and after ever gets dropped in between.  The one
+        exception is a group that would go over max_rules holding both, which
+        has to lose the old rules first.
+        """
+        ec2 = clients.client("ec2")
+        calls = {
+                "authorize_ingress": ec2.authorize_security_group_ingress,
+                "revoke_ingress": ec2.revoke_security_group_ingress,
+                "authorize_egress": ec2.authorize_security_group_egress,
+                "revoke_egress": ec2.revoke_security_group_egress
+                }
+        for node, node_changes in sorted(changes.items()):
+            for rule_type in ["ingress", "egress"]:
+                authorize = node_changes.get("authorize_%s" % rule_type, ())
+                actions = ["authorize", "revoke"]
+                if (rule_counts[node][rule_type] + len(authorize) >
+                        self.max_rules):
+                    actions.reverse()
+                for action in actions:
+                    action = "%s_%s" % (action, rule_type)
+                    if action in node_changes:
+                        calls[action](GroupId=group_ids[node],
+                                      IpPermissions=rules_to_permissions(
+                                          node_changes[action]))
+
+    def aws_destroy(self, network_names=None, vpc_id=None):
+        """
+        Deletes this deployment's security groups for the given networks, or
+        all of them in vpc_id.  aws_security_groups creates them, but nothing
+        else ever deletes them, and a VPC with groups left in it can't be
+        deleted either.
+        """
+        ec2 = clients.client("ec2")
+        filters = [{'Name': "tag:cloud-deployer-deployment",
+                    'Values': [self.deployment_name]}]
+        if vpc_id is not None:
+            filters.append({'Name': "vpc-id", 'Values': [vpc_id]})
+        for group in ec2.describe_security_groups(
+                Filters=filters)["SecurityGroups"]:
+            tags = dict((tag["Key"], tag["Value"])
+                        for tag in group.get("Tags", []))
+            if (network_names is None or
+                    tags.get("cloud-deployer-network") in network_names):
+                ec2.delete_security_group(GroupId=group["GroupId"])
+
+    def apply(self, firewalls):
+        """
+        Makes the security groups match the given firewalls, as generated by
+        netgraph.net_to_firewalls.  Returns the changes that were made.
+        """
+        if self.provider == "aws":
+            return self.aws_apply(firewalls)
+        else:
+            raise NotImplemented
 
-    def generate_rules(self):
-        return ["0.0.0.0/0"]
+    def destroy(self, network_names=None, vpc_id=None):
+        if self.provider == "aws":
+            return self.aws_destroy(network_names, vpc_id)
+        else:
+            raise NotImplemented
@@ -0,0 +1,156 @@
+"""
+Simulates forwarding through route tables, to check what net_to_routes (and
+compress_routes) actually produce before anything gets applied.
+
+Each node's route table gets compiled for longest prefix match, and then
+batches of (source, destination IP) probes get traced hop by hop.  Probes are
+grouped by destination and the outcome from every node towards a destination
+is memoized, so a hundred thousand flows mostly turn into dict lookups.
+
+A probe ends up as one of:
+
+- "delivered": it reached the node that owns the destination address, or
+  left through an exit (like "external") towards an address nobody owns.
+- "blackhole": some node on the way had no route for it.
+- "loop": it came back around to a node it already went through.
+
+This only does IPv4, since that's all the VPCs have.
+"""
+
+import socket
+import struct
+
+import attr
+
+from .subnet_generator import ip_network
+
+
+def ip_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+@attr.s
+class LpmTable(object):
+    """
+    A longest prefix match table, compiled into one hash table per prefix
+    length.  A lookup tries the lengths longest first, so it's at most 33 dict
+    lookups, which beats walking a binary trie one bit at a time in python.
+    """
+    lengths = attr.ib(default=attr.Factory(list))
+    tables = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        entries is a list of (cidr, value) pairs.  If a CIDR shows up more
+        than once, the first value wins.
+        """
+        table = cls()
+        for cidr, value in entries:
+            network = ip_network(cidr)
+            key = int(network.network_address) >> (32 - network.prefixlen)
+            table.tables.setdefault(network.prefixlen, {}).setdefault(
+                key, value)
+        table.lengths = sorted(table.tables, reverse=True)
+        return table
+
+    def lookup(self, ip):
+        for prefixlen in self.lengths:
+            value = self.tables[prefixlen].get(ip >> (32 - prefixlen))
+            if value is not None:
+                return value
+        return None
+
+
+@attr.s
+class ForwardingSimulator(object):
+    """
+    Build it with from_routes.  tables holds the compiled route table for each
+    node, owners maps addresses back to the node they belong to, and exits are
+    the nodes where traffic leaves the network.
+    """
+    tables = attr.ib(default=attr.Factory(dict))
+    owners = attr.ib(default=attr.Factory(LpmTable))
+    exits = attr.ib(default=("external",))
+
+    @classmethod
+    def from_routes(cls, routes, cidrs, exits=("external",)):
+        """
+        routes has CIDR destinations, like the output of
+        routegraph.compress_routes, and cidrs maps each node to its own CIDR
+        blocks.  When a table has more than one target for the same prefix,
+        the first one is the one that gets simulated.
+        """
+        return cls(tables=dict((node, LpmTable.from_entries(
+                                    (entry["destination"], entry["target"])
+                                    for entry in route))
+                               for node, route in routes.items()),
+                   owners=LpmTable.from_entries(
+                       (cidr, node) for node, node_cidrs in cidrs.items()
+                       for cidr in node_cidrs),
+                   exits=exits)
+
+    def trace_destination(self, ip, starts):
+        """
+        Traces every start node towards one destination address.  Returns
+        {node: (status, path)} for every node it went through, where path is
+        the rest of the way from that node.
+        """
+        owner = self.owners.lookup(ip)
+        outcomes = {}
+        for start in starts:
+            path = []
+            on_path = set()
+            node = start
+            while node not in outcomes:
+                if node in on_path:
+                    outcome = ("loop", (node,))
+                    break
+                if node == owner or (node in self.exits and owner is None):
+                    outcome = ("delivered", (node,))
+                    break
+                next_hop = None
+                if node in self.tables:
+                    next_hop = self.tables[node].lookup(ip)
+                if next_hop is None:
+                    outcome = ("blackhole", (node,))
+                    break
+                path.append(node)
+                on_path.add(node)
+                node = next_hop
+            else:
+                outcome = outcomes[node]
+            outcomes[node] = outcome
+            status, rest = outcome
+            for hop in reversed(path):
+                rest = (hop,) + rest
+                outcomes[hop] = (status, rest)
+        return outcomes
+
+    def trace(self, probes):
+        """
+        Traces a batch of (source node, destination IP) probes.  Returns one
+        {"status", "path"} dict per probe, in the same order.
+        """
+        by_destination = {}
+        for source, ip in probes:
+            by_destination.setdefault(ip, set()).add(source)
+        outcomes = {}
+        for ip, sources in by_destination.items():
+            outcomes[ip] = self.trace_destination(ip_to_int(ip), sources)
+        results = []
+        for source, ip in probes:
+            status, path = outcomes[ip][source]
+            results.append({"status": status, "path": list(path)})
+        return results
+
+
+def summarize(results):
+    """
+    Counts probes by status, which is the thing to look at before applying a
+    route change.
+    """
+    summary = {"delivered": 0, "blackhole": 0, "loop": 0}
+    for result in results:
+        summary[result["status"]] += 1
+    return summary
@@ -0,0 +1,268 @@
+"""
+Works out how fragmented each datacenter's address space is, and plans how
+to get a contiguous block back when it's too fragmented.
+
+Subnets get allocated first fit (see SubnetAllocator), and destroying a
+network leaves a hole where its subnets were, so an old VPC ends up with
+plenty of free addresses and nowhere to put a big subnet.  Everything here
+works offline on a planner snapshot, which has every subnet and the VPC
+CIDR blocks:
+
+    snapshot = Planner(deployment_name="prod").snapshot()
+    reports = analyze(snapshot, history)
+    compaction = AddressSpace.from_snapshot(snapshot)["vpc-1"].compaction(20)
+
+For each datacenter the report has:
+
+- free_blocks: the free space as the fewest aligned blocks, counted by
+  prefix, so {20: 1, 24: 3} is one /20 and three /24s.  The smallest prefix
+  in there (largest_free_prefix) is the biggest subnet that still fits.
+- allocatable: how many subnets of each prefix could still be allocated,
+  from that one down to a /28, the smallest subnet AWS allows.
+- fragmentation: 1 - the biggest free block / all the free space.  It's 0
+  when the free space is one block, and close to 1 when it's all small holes.
+- exhaustion: how long until the free space runs out at the rate it's been
+  getting used, in whatever units history's times are in.
+
+AWS doesn't keep when subnets were created, so history has to be recorded:
+it's {datacenter: [(time, used addresses)]}, which is what calling usage()
+on snapshots taken over time gives you.  The daemon records it on every
+refresh, in Daemon.history[deployment_name].
+
+A compaction moves the fewest subnets it can out of one aligned block, so
+that block is free.  Each move is a new subnet in the same zone and network,
+then the network's instances migrate to it (a rolling update of the
+service), and then the old subnet gets deleted.  The old subnets are still
+there while that happens, so the new ones only go in space that's free now.
+"""
+
+import ipaddress
+from bisect import bisect_left, bisect_right
+
+import attr
+
+from .subnet_generator import NotEnoughIPSpaceException, SubnetAllocator
+from .subnet_generator import ip_network
+
+SMALLEST_PREFIX = 28
+
+
+class CompactionException(Exception):
+    pass
+
+
+def usage(snapshot):
+    """
+    Addresses in use in each datacenter, to record as history.
+    """
+    return dict((datacenter, space.used())
+                for datacenter, space
+                in AddressSpace.from_snapshot(snapshot).items())
+
+
+def time_to_exhaustion(history, free):
+    """
+    How long until free addresses run out, from a least squares fit of
+    [(time, used addresses)].  None if usage isn't growing, or there isn't
+    enough history to tell.
+    """
+    if len(history) < 2:
+        return None
+    times = [float(time) for time, _ in history]
+    used = [float(used) for _, used in history]
+    mean_time = sum(times) / len(times)
+    mean_used = sum(used) / len(used)
+    variance = sum((time - mean_time) ** 2 for time in times)
+    if variance == 0:
+        return None
+    rate = sum((time - mean_time) * (count - mean_used)
+               for time, count in zip(times, used)) / variance
+    if rate <= 0:
+        return None
+    return free / rate
+
+
+@attr.s
+class Compaction(object):
+    datacenter = attr.ib()
+    block = attr.ib()
+    # [{"subnet": id, "network": ..., "zone": ..., "from": cidr, "to": cidr}]
+    moves = attr.ib(default=attr.Factory(list))
+
+    def steps(self):
+        """
+        The moves as ordered changes: every new subnet, then each network's
+        migration, then deleting the old subnets.
+        """
+        steps = [{"action": "create_subnet", "datacenter": self.datacenter,
+                  "network": move["network"], "zone": move["zone"],
+                  "cidr": move["to"], "replaces": move["subnet"]}
+                 for move in self.moves]
+        networks = {}
+        for move in self.moves:
+            networks.setdefault(move["network"], {})[move["subnet"]] = \
+                move["to"]
+        steps.extend({"action": "migrate_network", "network": network,
+                      "subnets": subnets}
+                     for network, subnets in sorted(networks.items()))
+        steps.extend({"action": "delete_subnet", "subnet_id": move["subnet"]}
+                     for move in self.moves)
+        return steps
+
+
+@attr.s
+class AddressSpace(object):
+    """
+    One datacenter's CIDR block and the subnets in it, each as {"id":
+    ..., "cidr": ..., "zone": ..., "network": ...}.
+    """
+    datacenter = attr.ib()
+    cidr = attr.ib(converter=ip_network)
+    subnets = attr.ib(default=attr.Factory(list))
+    starts = attr.ib(default=None)
+    ends = attr.ib(default=None)
+    # sizes[i] is the addresses in the first i subnets
+    sizes = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        for subnet in self.subnets:
+            network = ip_network(subnet["cidr"])
+            subnet["start"] = int(network.network_address)
+            subnet["end"] = int(network.broadcast_address)
+        self.subnets.sort(key=lambda subnet: subnet["start"])
+        self.starts = [subnet["start"] for subnet in self.subnets]
+        self.ends = [subnet["end"] for subnet in self.subnets]
+        self.sizes = [0]
+        for subnet in self.subnets:
+            self.sizes.append(self.sizes[-1] + subnet["end"] -
+                              subnet["start"] + 1)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        {datacenter: AddressSpace} for every datacenter in a planner
+        snapshot.
+        """
+        if "datacenter_cidrs" not in snapshot:
+            raise KeyError("The snapshot has no datacenter_cidrs, take a new "
+                           "one with Planner.snapshot")
+        subnets = dict((datacenter, [])
+                       for datacenter in snapshot["datacenter_cidrs"])
+        for name, network in snapshot["networks"].items():
+            for subnet_id, subnet in network["subnets"].items():
+                subnets[network["datacenter"]].append({
+                    "id": subnet_id, "cidr": subnet["cidr"],
+                    "zone": subnet["zone"], "network": name})
+        return dict((datacenter, cls(datacenter, cidr, subnets[datacenter]))
+                    for datacenter, cidr
+                    in snapshot["datacenter_cidrs"].items())
+
+    def prefix(self, start, end):
+        return self.cidr.max_prefixlen - (end - start + 1).bit_length() + 1
+
+    def used(self):
+        return self.sizes[-1]
+
+    def allocator(self):
+        return SubnetAllocator(self.cidr, starts=list(self.starts),
+                               ends=list(self.ends))
+
+    def report(self, history=None):
+        bits = self.cidr.max_prefixlen
+        free_blocks = {}
+        for _, prefix in self.allocator().free_blocks():
+            free_blocks[prefix] = free_blocks.get(prefix, 0) + 1
+        free = self.cidr.num_addresses - self.used()
+        largest = min(free_blocks) if free_blocks else None
+        allocatable = {}
+        if largest is not None:
+            for prefix in range(largest, max(largest, SMALLEST_PREFIX) + 1):
+                allocatable[prefix] = sum(
+                    count << (prefix - block_prefix)
+                    for block_prefix, count in free_blocks.items()
+                    if block_prefix <= prefix)
+        return {
+                "cidr": str(self.cidr),
+                "subnets": len(self.subnets),
+                "used": self.used(),
+                "free": free,
+                "free_blocks": free_blocks,
+                "largest_free_prefix": largest,
+                "allocatable": allocatable,
+                "fragmentation": (1.0 - float(1 << (bits - largest)) / free
+                                  if free else 0.0),
+                "exhaustion": time_to_exhaustion(history or [], free)
+                }
+
+    def compaction(self, prefix):
+        """
+        Plans the fewest moves that leave a free /prefix.  Every aligned
+        block of that size is a candidate, and they get tried in order of
+        how many subnets are in them, until one has somewhere for all of
+        those to go.
+        """
+        bits = self.cidr.max_prefixlen
+        if prefix < self.cidr.prefixlen:
+            raise CompactionException("A /%d is bigger than all of %s" %
+                                      (prefix, self.cidr))
+        size = 1 << (bits - prefix)
+        found = self.allocator().find(prefix)
+        if found is not None:
+            return Compaction(self.datacenter,
+                              str(ipaddress.ip_network((found[0], prefix))))
+        free = self.cidr.num_addresses - self.used()
+        if free < size:
+            raise CompactionException(
+                "%s only has %d addresses free, a /%d needs %d" %
+                (self.cidr, free, prefix, size))
+
+        candidates = []
+        first = int(self.cidr.network_address)
+        for block in range(first, first + self.cidr.num_addresses, size):
+            low = bisect_left(self.ends, block)
+            high = bisect_right(self.starts, block + size - 1)
+            # Subnets are aligned too, so one that doesn't fit inside the
+            # block is the only one there, and covers all of it.
+            if (high - low == 1 and self.starts[low] <= block and
+                    self.ends[low] >= block + size - 1):
+                continue
+            candidates.append((high - low, self.sizes[high] - self.sizes[low],
+                               block, low, high))
+        candidates.sort()
+
+        for _, _, block, low, high in candidates:
+            allocator = SubnetAllocator(
+                self.cidr,
+                starts=self.starts[:low] + [block] + self.starts[high:],
+                ends=self.ends[:low] + [block + size - 1] + self.ends[high:])
+            moves = []
+            try:
+                # Biggest first, so the small ones don't break up the space
+                # the big ones need
+                for subnet in sorted(self.subnets[low:high],
+                                     key=lambda subnet: (subnet["start"] -
+                                                         subnet["end"],
+                                                         subnet["start"])):
+                    moves.append({
+                        "subnet": subnet["id"], "network": subnet["network"],
+                        "zone": subnet["zone"], "from": subnet["cidr"],
+                        "to": allocator.allocate(
+                            self.prefix(subnet["start"], subnet["end"]))})
+            except NotEnoughIPSpaceException:
+                continue
+            return Compaction(self.datacenter,
+                              str(ipaddress.ip_network((block, prefix))),
+                              moves)
+        raise CompactionException(
+            "There's no /%d in %s whose subnets fit anywhere else" %
+            (prefix, self.cidr))
+
+
+def analyze(snapshot, history=None):
+    """
+    A report for every datacenter in a planner snapshot.
+    """
+    history = history or {}
+    return dict((datacenter, space.report(history.get(datacenter)))
+                for datacenter, space
+                in AddressSpace.from_snapshot(snapshot).items())
@@ -2,6 +2,36 @@
 
 import attr
 
+# (name, vcpus, memory in GiB, instance storage in GiB, on demand dollars an
+# hour in us-east-1).  Storage is local instance storage, so it's 0 for the
+# EBS only types.  t2.nano is left out on purpose, half a gig of memory isn't
+# enough to run anything we'd deploy.
+INSTANCE_TYPES = [
+        ("t2.micro", 1, 1, 0, 0.0116),
+        ("t2.small", 1, 2, 0, 0.023),
+        ("t2.medium", 2, 4, 0, 0.0464),
+        ("t2.large", 2, 8, 0, 0.0928),
+        ("c5.large", 2, 4, 0, 0.085),
+        ("c5.xlarge", 4, 8, 0, 0.17),
+        ("c5.2xlarge", 8, 16, 0, 0.34),
+        ("c5.4xlarge", 16, 32, 0, 0.68),
+        ("m5.large", 2, 8, 0, 0.096),
+        ("m5.xlarge", 4, 16, 0, 0.192),
+        ("m5.2xlarge", 8, 32, 0, 0.384),
+        ("m5.4xlarge", 16, 64, 0, 0.768),
+        ("m5d.large", 2, 8, 75, 0.113),
+        ("m5d.xlarge", 4, 16, 150, 0.226),
+        ("m5d.2xlarge", 8, 32, 300, 0.452),
+        ("r5.large", 2, 16, 0, 0.126),
+        ("r5.xlarge", 4, 32, 0, 0.252),
+        ("r5.2xlarge", 8, 64, 0, 0.504),
+        ]
+
+
+class NoFittingInstanceException(Exception):
+    pass
+
+
 @attr.s
 class InstanceFitter(object):
     """
@@ -10,6 +40,8 @@ class InstanceFitter(object):
 
     If nothing is specified, the default is to find the cheapest instance.
     """
+    instance_types = attr.ib(default=attr.Factory(lambda: list(
+        INSTANCE_TYPES)))
 
     def get_fitting_instance(self, memory=None, cpus=None, storage=None):
         """
@@ -17,10 +49,18 @@ class InstanceFitter(object):
         https://aws.amazon.com/blogs/aws/new-aws-price-list-api/
         which I found from:
         https://stackoverflow.com/questions/33120348/boto3-aws-api-listing-available-instance-types
-        For now I'm just hardcoding for testing.
+        For now the table is hardcoded, but it's real prices, so this picks
+        the cheapest type with at least the memory (GiB), cpus and instance
+        storage (GiB) asked for.
         """
-        if memory or cpus or storage:
-            raise NotImplementedError
-        return "t2.micro"
-
-
+        fitting = [(price, name)
+                   for name, type_cpus, type_memory, type_storage, price
+                   in self.instance_types
+                   if type_cpus >= (cpus or 0) and
+                   type_memory >= (memory or 0) and
+                   type_storage >= (storage or 0)]
+        if not fitting:
+            raise NoFittingInstanceException(
+                "No instance type has %s GiB of memory, %s cpus and %s GiB "
+                "of storage" % (memory, cpus, storage))
+        return min(fitting)[1]
@@ -0,0 +1,247 @@
+"""
+Records every AWS API call, so I can see which code path makes which calls.
+
+ApiRecorder hooks botocore's events on the boto3 session, so it sees every
+call from every client created while it's installed, without touching the
+code making the calls.  For each call it records the operation, how long it
+took, how many times botocore retried it, whether it got throttled, and which
+method in deployment_experiments made it.
+
+    with ApiRecorder() as recorder:
+        LoadBalancer("web-lb", "web.example.com").provision()
+    print(recorder.report())
+
+It also looks for the N+1 pattern, where a provision keeps describing things
+one at a time (like Datacenter.aws_create describing every sibling VPC).  When
+the same read operation gets called more than once inside a single top level
+provision, it warns with a RepeatedCallWarning.
+"""
+
+import os
+import sys
+import timeit
+import warnings
+
+import attr
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+THROTTLE_CODES = set(["Throttling", "ThrottlingException",
+                      "RequestLimitExceeded", "TooManyRequestsException",
+                      "RequestThrottled", "SlowDown",
+                      "PriorRequestNotComplete"])
+READ_PREFIXES = ("Describe", "List", "Get")
+
+
+class RepeatedCallWarning(UserWarning):
+    pass
+
+
+def error_code(response):
+    """
+    The error code out of a parsed botocore response, or None.
+    """
+    if not response:
+        return None
+    return response.get("Error", {}).get("Code")
+
+
+def package_frames(frame):
+    """
+    Walks out from a frame, yielding only the frames running code in this
+    package (other than this module).
+    """
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (os.path.dirname(filename) == PACKAGE_DIR and
+                not filename.startswith(os.path.splitext(
+                    os.path.abspath(__file__))[0])):
+            yield frame
+        frame = frame.f_back
+
+
+def frame_name(frame):
+    """
+    "Class.method" for methods, or just the function name.
+    """
+    if "self" in frame.f_locals:
+        return "%s.%s" % (type(frame.f_locals["self"]).__name__,
+                          frame.f_code.co_name)
+    return frame.f_code.co_name
+
+
+@attr.s
+class ApiCall(object):
+    service = attr.ib()
+    operation = attr.ib()
+    caller = attr.ib(default=None)
+    started = attr.ib(default=0.0)
+    seconds = attr.ib(default=0.0)
+    attempts = attr.ib(default=1)
+    throttles = attr.ib(default=0)
+    error = attr.ib(default=None)
+
+    @property
+    def name(self):
+        return "%s.%s" % (self.service, self.operation)
+
+    @property
+    def retries(self):
+        return self.attempts - 1
+
+
+@attr.s
+class ApiRecorder(object):
+    """
+    Install it (or use it as a context manager) before creating clients,
+    since botocore copies the session's handlers into each client when it's
+    created.
+
+    callbacks get called with each ApiCall as it finishes, which is the place
+    to hook up a metrics library.  session defaults to boto3's default
+    session.
+    """
+    session = attr.ib(default=None)
+    callbacks = attr.ib(default=attr.Factory(list))
+    warn = attr.ib(default=True)
+    calls = attr.ib(default=attr.Factory(list))
+    repeats = attr.ib(default=attr.Factory(list))
+    _scope = attr.ib(default=None)
+    _scope_calls = attr.ib(default=attr.Factory(dict))
+
+    def install(self):
+        if self.session is None:
+            import boto3
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            self.session = boto3.DEFAULT_SESSION
+        events = self.session.events
+        events.register("before-call", self.before_call,
+                        unique_id="instrumentation-before-call-%d" % id(self))
+        events.register("needs-retry", self.needs_retry,
+                        unique_id="instrumentation-needs-retry-%d" % id(self))
+        events.register("after-call", self.after_call,
+                        unique_id="instrumentation-after-call-%d" % id(self))
+        events.register("after-call-error", self.after_call_error,
+                        unique_id="instrumentation-after-call-error-%d" %
+                        id(self))
+        return self
+
+    def uninstall(self):
+        events = self.session.events
+        events.unregister("before-call", self.before_call,
+                          unique_id="instrumentation-before-call-%d" %
+                          id(self))
+        events.unregister("needs-retry", self.needs_retry,
+                          unique_id="instrumentation-needs-retry-%d" %
+                          id(self))
+        events.unregister("after-call", self.after_call,
+                          unique_id="instrumentation-after-call-%d" % id(self))
+        events.unregister("after-call-error", self.after_call_error,
+                          unique_id="instrumentation-after-call-error-%d" %
+                          id(self))
+        self._scope = None
+        self._scope_calls = {}
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def before_call(self, event_name, model, context, **kwargs):
+        call = ApiCall(service=event_name.split(".")[1],
+                       operation=model.name,
+                       started=timeit.default_timer())
+        frames = list(package_frames(sys._getframe(1)))
+        if frames:
+            call.caller = frame_name(frames[0])
+        context["instrumentation_call"] = call
+        if model.name.startswith(READ_PREFIXES):
+            self.check_repeats(call, frames)
+
+    def needs_retry(self, attempts, response=None, request_dict=None,
+                    **kwargs):
+        call = (request_dict or {}).get("context", {}).get(
+            "instrumentation_call")
+        if call is None:
+            return
+        call.attempts = attempts
+        if response and error_code(response[1]) in THROTTLE_CODES:
+            call.throttles += 1
+
+    def finish(self, call, parsed):
+        call.seconds = timeit.default_timer() - call.started
+        call.error = error_code(parsed)
+        # Throttles that used up every retry never make it to needs-retry
+        # as a retry, so count the final one here.
+        if call.error in THROTTLE_CODES and call.throttles < call.attempts:
+            call.throttles = call.attempts
+        self.calls.append(call)
+        for callback in self.callbacks:
+            callback(call)
+
+    def after_call(self, parsed, context, **kwargs):
+        call = context.pop("instrumentation_call", None)
+        if call is not None:
+            self.finish(call, parsed)
+
+    def after_call_error(self, context, exception, **kwargs):
+        call = context.pop("instrumentation_call", None)
+        if call is not None:
+            self.finish(call, {"Error": {"Code": type(exception).__name__}})
+
+    def check_repeats(self, call, frames):
+        """
+        The scope is the outermost provision on the stack.  I hang on to its
+        frame rather than its id, because the next provision's frame can
+        easily end up at the same address.
+        """
+        provisions = [frame for frame in frames
+                      if frame.f_code.co_name in ("provision",
+                                                  "aws_provision")]
+        if not provisions:
+            return
+        scope = provisions[-1]
+        if scope is not self._scope:
+            self._scope = scope
+            self._scope_calls = {}
+        callers = self._scope_calls.setdefault(call.name, [])
+        callers.append(call.caller)
+        if len(callers) == 2:
+            repeat = {"operation": call.name,
+                      "scope": frame_name(scope),
+                      "callers": callers}
+            self.repeats.append(repeat)
+            if self.warn:
+                warnings.warn("%s called more than once in %s (from %s)" % (
+                    call.name, repeat["scope"], ", ".join(
+                        sorted(set(caller or "?" for caller in callers)))),
+                    RepeatedCallWarning, stacklevel=2)
+
+    def report(self):
+        """
+        Everything recorded so far, totalled by operation and by caller.
+        """
+        report = {
+                "calls": len(self.calls),
+                "seconds": sum(call.seconds for call in self.calls),
+                "retries": sum(call.retries for call in self.calls),
+                "throttles": sum(call.throttles for call in self.calls),
+                "errors": sum(1 for call in self.calls if call.error),
+                "operations": {},
+                "callers": {},
+                "repeats": [dict(repeat, count=len(repeat["callers"]))
+                            for repeat in self.repeats]
+                }
+        for call in self.calls:
+            operation = report["operations"].setdefault(call.name, {
+                "calls": 0, "seconds": 0.0, "retries": 0, "throttles": 0,
+                "errors": 0})
+            operation["calls"] += 1
+            operation["seconds"] += call.seconds
+            operation["retries"] += call.retries
+            operation["throttles"] += call.throttles
+            operation["errors"] += 1 if call.error else 0
+            callers = report["callers"].setdefault(call.caller, {})
+            callers[call.name] = callers.get(call.name, 0) + 1
+        return report
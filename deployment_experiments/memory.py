@@ -0,0 +1,411 @@
+"""
+An in-process cloud, for provider="memory".
+
+Every resource class has memory_* methods next to its aws_* ones, and they
+work against a MemoryCloud instead of AWS.  It keeps the same tags and the
+same discovery rules (a datacenter only avoids the CIDR blocks of
+datacenters in its own deployment, networks are found by their network and
+deployment tags, and so on), so code that works against one works against
+the other.
+
+Nothing here is ever a scan.  Tags are indexed, subnets are indexed by VPC,
+and CIDR blocks come from SubnetAllocators instead of generate_subnets, so
+provisioning stays roughly constant time per resource and a deployment of
+ten thousand services simulates in seconds.
+
+All the resource classes share the module level cloud, the same way they
+share boto3's default session.  reset() starts over with an empty one.
+"""
+
+import itertools
+import threading
+import timeit
+
+import attr
+
+from .subnet_generator import SubnetAllocator
+
+ZONES = ["us-east-1a", "us-east-1b", "us-east-1c"]
+
+
+class MemoryCloudException(Exception):
+    pass
+
+
+@attr.s
+class TagIndex(object):
+    """
+    Which resources have each (key, value) tag.
+    """
+    tags = attr.ib(default=attr.Factory(dict))
+    index = attr.ib(default=attr.Factory(dict))
+
+    def add(self, resource_id, tags):
+        resource_tags = self.tags.setdefault(resource_id, {})
+        for key, value in tags.items():
+            if key in resource_tags:
+                self.index[(key, resource_tags[key])].discard(resource_id)
+            resource_tags[key] = value
+            self.index.setdefault((key, value), set()).add(resource_id)
+
+    def remove(self, resource_id):
+        for key, value in self.tags.pop(resource_id, {}).items():
+            self.index[(key, value)].discard(resource_id)
+
+    def find(self, tags):
+        """
+        Everything that has all of the given tags, starting from the rarest
+        one so the intersection stays small.
+        """
+        matches = None
+        for key, value in sorted(tags.items(),
+                                 key=lambda tag: len(self.index.get(tag,
+                                                                    ()))):
+            found = self.index.get((key, value), set())
+            matches = set(found) if matches is None else matches & found
+            if not matches:
+                return set()
+        return matches if matches is not None else set()
+
+
+@attr.s
+class MemoryCloud(object):
+    """
+    The state of one pretend account.  Methods are named after the AWS calls
+    they stand in for, but take and return plain python values.
+
+    Instances pass their load balancer health check boot_seconds after they
+    launch, going by clock, so a simulation can run on a fake clock.
+    """
+    zones = attr.ib(default=attr.Factory(lambda: list(ZONES)))
+    boot_seconds = attr.ib(default=0.0)
+    clock = attr.ib(default=timeit.default_timer)
+    vpcs = attr.ib(default=attr.Factory(dict))
+    subnets = attr.ib(default=attr.Factory(dict))
+    vpc_tags = attr.ib(default=attr.Factory(TagIndex))
+    subnet_tags = attr.ib(default=attr.Factory(TagIndex))
+    vpc_allocators = attr.ib(default=attr.Factory(dict))
+    load_balancers = attr.ib(default=attr.Factory(dict))
+    hosted_zones = attr.ib(default=attr.Factory(dict))
+    zones_by_name = attr.ib(default=attr.Factory(dict))
+    launch_configurations = attr.ib(default=attr.Factory(dict))
+    auto_scaling_groups = attr.ib(default=attr.Factory(dict))
+    group_tags = attr.ib(default=attr.Factory(TagIndex))
+    instances = attr.ib(default=attr.Factory(dict))
+    _ids = attr.ib(default=attr.Factory(itertools.count))
+    _lock = attr.ib(default=attr.Factory(threading.RLock))
+
+    def new_id(self, prefix):
+        return "%s-%08x" % (prefix, next(self._ids))
+
+    # Datacenters
+
+    def vpc_allocator(self, deployment_name, private_block):
+        """
+        The allocator for a deployment's datacenters, built from the
+        datacenters it already has the first time it's needed.
+        """
+        key = (deployment_name, private_block)
+        if key not in self.vpc_allocators:
+            allocator = SubnetAllocator(private_block)
+            for vpc_id in self.vpc_tags.find(
+                    {"cloud-deployer-deployment": deployment_name}):
+                allocator.claim(self.vpcs[vpc_id]["cidr"])
+            self.vpc_allocators[key] = allocator
+        return self.vpc_allocators[key]
+
+    def create_vpc(self, deployment_name, private_block, prefix):
+        """
+        Picks the first block in private_block that none of the deployment's
+        datacenters use, like Datacenter.aws_create, and creates a VPC there
+        tagged with the deployment.  That's all one step, so it's safe from
+        any number of threads.
+        """
+        with self._lock:
+            cidr = self.vpc_allocator(deployment_name,
+                                      private_block).allocate(prefix)
+            for (name, block), allocator in self.vpc_allocators.items():
+                if name == deployment_name and block != private_block:
+                    allocator.claim(cidr)
+            vpc_id = self.new_id("vpc")
+            self.vpcs[vpc_id] = {"id": vpc_id, "cidr": cidr,
+                                 "allocator": SubnetAllocator(cidr),
+                                 "subnets": set()}
+            self.vpc_tags.add(vpc_id, {"cloud-deployer-deployment":
+                                       deployment_name})
+            return vpc_id
+
+    def describe_vpcs(self, vpc_ids=None, tags=None):
+        with self._lock:
+            if vpc_ids is None:
+                vpc_ids = self.vpc_tags.find(tags) if tags else self.vpcs
+            return [self.vpcs[vpc_id] for vpc_id in sorted(vpc_ids)
+                    if vpc_id in self.vpcs]
+
+    def delete_vpc(self, vpc_id):
+        with self._lock:
+            vpc = self.vpcs.get(vpc_id)
+            if vpc is None:
+                raise MemoryCloudException("No VPC %s" % vpc_id)
+            if vpc["subnets"]:
+                raise MemoryCloudException("VPC %s still has subnets" %
+                                           vpc_id)
+            deployment = self.vpc_tags.tags.get(vpc_id, {}).get(
+                "cloud-deployer-deployment")
+            for (deployment_name, _), allocator in (
+                    self.vpc_allocators.items()):
+                if deployment_name == deployment:
+                    try:
+                        allocator.release(vpc["cidr"])
+                    except ValueError:
+                        pass
+            self.vpc_tags.remove(vpc_id)
+            del self.vpcs[vpc_id]
+
+    # Networks
+
+    def create_subnets(self, vpc_id, prefix, zones):
+        """
+        Carves one subnet per zone out of a VPC, first fit like
+        Network.carve_subnets.
+        """
+        with self._lock:
+            vpc = self.vpcs[vpc_id]
+            subnet_ids = []
+            for zone in zones:
+                subnet_id = self.new_id("subnet")
+                self.subnets[subnet_id] = {
+                        "id": subnet_id, "vpc": vpc_id, "zone": zone,
+                        "cidr": vpc["allocator"].allocate(prefix)}
+                vpc["subnets"].add(subnet_id)
+                subnet_ids.append(subnet_id)
+            return subnet_ids
+
+    def tag_subnets(self, subnet_ids, tags):
+        with self._lock:
+            for subnet_id in subnet_ids:
+                self.subnet_tags.add(subnet_id, tags)
+
+    def describe_subnets(self, subnet_ids=None, tags=None):
+        with self._lock:
+            if subnet_ids is None:
+                subnet_ids = (self.subnet_tags.find(tags) if tags
+                              else self.subnets)
+            return [self.subnets[subnet_id]
+                    for subnet_id in sorted(subnet_ids)
+                    if subnet_id in self.subnets]
+
+    def delete_subnet(self, subnet_id):
+        with self._lock:
+            subnet = self.subnets.pop(subnet_id)
+            vpc = self.vpcs[subnet["vpc"]]
+            vpc["subnets"].discard(subnet_id)
+            vpc["allocator"].release(subnet["cidr"])
+            self.subnet_tags.remove(subnet_id)
+
+    # Load balancers
+
+    def create_load_balancer(self, name, subnet_ids):
+        with self._lock:
+            if name in self.load_balancers:
+                raise MemoryCloudException("Load balancer %s already exists"
+                                           % name)
+            self.load_balancers[name] = {
+                    "name": name,
+                    "dns_name": "%s-%d.memory.elb.example.com" % (
+                        name, next(self._ids)),
+                    "subnets": list(subnet_ids),
+                    "instances": set()}
+            return self.load_balancers[name]["dns_name"]
+
+    def describe_load_balancers(self, names):
+        with self._lock:
+            return [self.load_balancers[name] for name in names
+                    if name in self.load_balancers]
+
+    def delete_load_balancer(self, name):
+        with self._lock:
+            self.load_balancers.pop(name, None)
+
+    def deregister_instances(self, name, instance_ids):
+        with self._lock:
+            self.load_balancers[name]["instances"].difference_update(
+                instance_ids)
+
+    def instance_health(self, name):
+        """
+        {instance id: "InService" or "OutOfService"} for everything
+        registered with a load balancer.
+        """
+        with self._lock:
+            now = self.clock()
+            health = {}
+            for instance_id in self.load_balancers[name]["instances"]:
+                instance = self.instances[instance_id]
+                healthy = (instance["health"] == "Healthy" and
+                           now - instance["launched"] >= self.boot_seconds)
+                health[instance_id] = ("InService" if healthy
+                                       else "OutOfService")
+            return health
+
+    # DNS
+
+    def create_hosted_zone(self, name):
+        with self._lock:
+            zone_id = "/hostedzone/%s" % self.new_id("Z").upper()
+            name = name.rstrip(".") + "."
+            self.hosted_zones[zone_id] = {"id": zone_id, "name": name,
+                                          "records": {}}
+            self.zones_by_name.setdefault(name, []).append(zone_id)
+            return zone_id
+
+    def list_hosted_zones_by_name(self, name):
+        with self._lock:
+            return list(self.zones_by_name.get(name.rstrip(".") + ".", []))
+
+    def change_record(self, zone_id, action, name, value=None):
+        with self._lock:
+            records = self.hosted_zones[zone_id]["records"]
+            if action == "CREATE" and name in records:
+                raise MemoryCloudException("%s already exists in %s" %
+                                           (name, zone_id))
+            if action == "DELETE":
+                records.pop(name, None)
+            else:
+                records[name] = value
+
+    def delete_hosted_zone(self, zone_id):
+        with self._lock:
+            zone = self.hosted_zones.pop(zone_id)
+            self.zones_by_name[zone["name"]].remove(zone_id)
+            if not self.zones_by_name[zone["name"]]:
+                del self.zones_by_name[zone["name"]]
+
+    # Autoscaling
+
+    def create_launch_configuration(self, name, image_id, instance_type,
+                                    user_data):
+        with self._lock:
+            if name in self.launch_configurations:
+                raise MemoryCloudException("Launch configuration %s already "
+                                           "exists" % name)
+            self.launch_configurations[name] = {
+                    "name": name, "image_id": image_id,
+                    "instance_type": instance_type, "user_data": user_data}
+
+    def delete_launch_configuration(self, name):
+        with self._lock:
+            self.launch_configurations.pop(name, None)
+
+    def create_auto_scaling_group(self, name, launch_configuration, size,
+                                  subnet_ids, load_balancer_names, tags,
+                                  min_size=None, max_size=None):
+        with self._lock:
+            if name in self.auto_scaling_groups:
+                raise MemoryCloudException("Autoscaling group %s already "
+                                           "exists" % name)
+            self.auto_scaling_groups[name] = {
+                    "name": name,
+                    "launch_configuration": launch_configuration,
+                    "desired": 0,
+                    "min": size if min_size is None else min_size,
+                    "max": size if max_size is None else max_size,
+                    "subnets": list(subnet_ids),
+                    "load_balancers": list(load_balancer_names),
+                    "instances": [],
+                    "policies": {}}
+            self.group_tags.add(name, tags)
+            self.set_desired_capacity(name, size)
+
+    def put_scaling_policy(self, name, policy_name, configuration):
+        with self._lock:
+            self.auto_scaling_groups[name]["policies"][policy_name] = (
+                configuration)
+
+    def set_desired_capacity(self, name, desired):
+        """
+        Launches or terminates instances until the group is at desired.
+        Instances launch into the group's subnets round robin, with the
+        group's current launch configuration.  Scaling in terminates the
+        oldest first.
+        """
+        with self._lock:
+            group = self.auto_scaling_groups[name]
+            group["desired"] = desired
+            group["min"] = min(group["min"], desired)
+            group["max"] = max(group["max"], desired)
+            while len(group["instances"]) < desired:
+                subnet = self.subnets[group["subnets"][
+                    len(group["instances"]) % len(group["subnets"])]]
+                instance_id = self.new_id("i")
+                self.instances[instance_id] = {
+                        "id": instance_id, "group": name,
+                        "launch_configuration": group["launch_configuration"],
+                        "zone": subnet["zone"], "health": "Healthy",
+                        "launched": self.clock()}
+                group["instances"].append(instance_id)
+                for load_balancer in group["load_balancers"]:
+                    if load_balancer in self.load_balancers:
+                        self.load_balancers[load_balancer][
+                            "instances"].add(instance_id)
+            while len(group["instances"]) > desired:
+                self.terminate_instance(group["instances"][0],
+                                        decrement=False)
+
+    def update_auto_scaling_group(self, name, launch_configuration=None,
+                                  desired=None, max_size=None):
+        with self._lock:
+            group = self.auto_scaling_groups[name]
+            if launch_configuration is not None:
+                if launch_configuration not in self.launch_configurations:
+                    raise MemoryCloudException("No launch configuration %s" %
+                                               launch_configuration)
+                group["launch_configuration"] = launch_configuration
+            if max_size is not None:
+                group["max"] = max_size
+            if desired is not None:
+                if desired > group["max"]:
+                    raise MemoryCloudException(
+                        "Desired capacity %s is over the max size of %s" %
+                        (desired, name))
+                self.set_desired_capacity(name, desired)
+
+    def terminate_instance(self, instance_id, decrement=True):
+        with self._lock:
+            instance = self.instances.pop(instance_id)
+            group = self.auto_scaling_groups[instance["group"]]
+            group["instances"].remove(instance_id)
+            if decrement:
+                group["desired"] -= 1
+            for load_balancer in group["load_balancers"]:
+                if load_balancer in self.load_balancers:
+                    self.load_balancers[load_balancer]["instances"].discard(
+                        instance_id)
+
+    def describe_auto_scaling_groups(self, names=None, tags=None):
+        with self._lock:
+            if names is None:
+                names = (self.group_tags.find(tags) if tags
+                         else self.auto_scaling_groups)
+            return [self.auto_scaling_groups[name] for name in sorted(names)
+                    if name in self.auto_scaling_groups]
+
+    def delete_auto_scaling_group(self, name):
+        with self._lock:
+            group = self.auto_scaling_groups[name]
+            for instance_id in list(group["instances"]):
+                self.terminate_instance(instance_id)
+            self.group_tags.remove(name)
+            del self.auto_scaling_groups[name]
+
+
+cloud = MemoryCloud()
+
+
+def reset(zones=None):
+    """
+    Throws away everything and starts over, which is what tests want.
+    """
+    global cloud
+    cloud = MemoryCloud(zones=list(zones or ZONES))
+    return cloud
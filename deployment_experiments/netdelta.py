@@ -0,0 +1,116 @@
+"""
+Incremental version of netgraph.net_to_firewalls.
+
+Rerunning net_to_firewalls over the whole graph every time a dependency
+changes means diffing and reapplying every rule on every node.  Instead this
+keeps a reference count per compiled rule, and turns added and removed edges
+(in the same format as a netgraph net) into exactly the rules that need to be
+added and removed, grouped by node so each node is one call per direction.
+
+Reference counts matter because the same rule can come from more than one
+place, for example when the same dependency is declared twice.  The rule only
+goes away when the last edge that needs it does.
+"""
+
+from collections import Counter
+
+import attr
+
+
+def edge_rules(edges):
+    """
+    The (node, rule) pairs that a set of edges compiles to, with rules as
+    (type, source, protocol, port) tuples.  Same logic as net_to_firewalls,
+    just without building the dicts.
+    """
+    for source, targets in edges.items():
+        for target, configs in targets.items():
+            for config in configs:
+                if target != "external":
+                    yield target, ("ingress", source, config["protocol"],
+                                   config["port"])
+                if source != "external":
+                    yield source, ("egress", target, config["protocol"],
+                                   config["port"])
+
+
+def rule_dict(rule):
+    rule_type, source, protocol, port = rule
+    return {
+            "source": source,
+            "protocol": protocol,
+            "port": port,
+            "type": rule_type
+            }
+
+
+@attr.s
+class IncrementalFirewalls(object):
+    """
+    The compiled firewalls for a net, kept up to date one change at a time.
+    """
+    counts = attr.ib(default=attr.Factory(Counter))
+
+    @classmethod
+    def from_net(cls, net):
+        firewalls = cls()
+        firewalls.apply(added=net)
+        return firewalls
+
+    def apply(self, added=None, removed=None):
+        """
+        Applies added and removed edges, and returns the rule changes as
+        {"add": {node: [rules]}, "remove": {node: [rules]}}.  The cost is in
+        the number of changed edges, not the size of the graph.
+
+        An edge that's added and removed in the same change cancels out and
+        doesn't show up at all.
+        """
+        changes = Counter()
+        for key in edge_rules(added or {}):
+            changes[key] += 1
+        for key in edge_rules(removed or {}):
+            changes[key] -= 1
+        # Check everything before touching the counts, so a bad removal
+        # doesn't leave things half applied.
+        for key, change in changes.items():
+            if self.counts[key] + change < 0:
+                node, rule = key
+                raise ValueError("Can't remove rule %s from %s, no edge in "
+                                 "the graph created it.  Were these edges "
+                                 "ever added?" % (rule, node))
+        delta = {"add": {}, "remove": {}}
+        for key, change in changes.items():
+            node, rule = key
+            before = self.counts[key]
+            after = before + change
+            if before == 0 and after > 0:
+                delta["add"].setdefault(node, []).append(rule_dict(rule))
+            elif before > 0 and after == 0:
+                delta["remove"].setdefault(node, []).append(rule_dict(rule))
+            if after == 0:
+                del self.counts[key]
+            else:
+                self.counts[key] = after
+        return delta
+
+    def firewalls(self):
+        """
+        The current rules, in the same format as net_to_firewalls but with
+        each rule only listed once.
+        """
+        firewalls = {}
+        for node, rule in sorted(self.counts):
+            firewalls.setdefault(node, []).append(rule_dict(rule))
+        return firewalls
+
+
+def call_count(delta):
+    """
+    How many API calls it takes to apply a delta, assuming one call per node
+    per action and rule type.
+    """
+    return len(set((action, node, rule["type"])
+                   for action, nodes in delta.items()
+                   for node, rules in nodes.items()
+                   for rule in rules))
@@ -3,37 +3,43 @@ Functions to convert from a network graph to a list of firewall rules, and
 potentially back if possible.
 """
 
+from .compactgraph import parse_ports, format_ports
 
-def net_to_firewalls(net):
+
+def net_to_firewalls(net, exclude=("external",)):
     """
     TODO: Really figure out this format.  Perhaps my sources and targets can be
     comma separated ids or something, to make it easier to build this for
     multiple subnets.  That actually makes peered subnets reasonably
     straightforward, since I can reference the same list.
+
+    This goes straight from dicts to dicts in one pass.  There's no compact
+    form for firewalls, since every rule has to be built as a dict at the end
+    anyway and interning the net first only adds to that.
     """
     firewalls = {}
-    for source, targets in net.iteritems():
-        if source not in firewalls and source != "external":
-            firewalls[source] = []
-        for target, configs in targets.iteritems():
-            if target not in firewalls and target != "external":
-                firewalls[target] = []
-            ingress_rules = [{
-                    "source": source,
-                    "protocol": config["protocol"],
-                    "port": config["port"],
-                    "type": "ingress"
-                    } for config in configs]
-            egress_rules = [{
-                    "source": target,
-                    "protocol": config["protocol"],
-                    "port": config["port"],
-                    "type": "egress"
-                    } for config in configs]
-            if target != "external":
-                firewalls[target].extend(ingress_rules)
-            if source != "external":
-                firewalls[source].extend(egress_rules)
+    for source, targets in net.items():
+        egress = None
+        if source not in exclude:
+            egress = firewalls.setdefault(source, [])
+        for target, configs in targets.items():
+            if target not in exclude:
+                ingress = firewalls.get(target)
+                if ingress is None:
+                    ingress = firewalls[target] = []
+                ingress.extend([{
+                        "source": source,
+                        "protocol": config["protocol"],
+                        "port": config["port"],
+                        "type": "ingress"
+                        } for config in configs])
+            if egress is not None:
+                egress.extend([{
+                        "source": target,
+                        "protocol": config["protocol"],
+                        "port": config["port"],
+                        "type": "egress"
+                        } for config in configs])
     return firewalls
 
 
@@ -47,7 +53,7 @@ def firewalls_to_net(firewalls):
     - Figure out what to do when I have conflicting rules
     """
     net = {}
-    for source, rules in firewalls.iteritems():
+    for source, rules in firewalls.items():
         for rule in rules:
             if rule["type"] == "ingress":
                 if rule["source"] not in net:
@@ -57,3 +63,69 @@ def firewalls_to_net(firewalls):
                     "port": rule["port"]
                     }]
     return net
+
+
+def merge_port_ranges(ranges):
+    """
+    Merges overlapping and adjacent (start, end) port ranges, so 80, 81 and
+    82-90 come back as a single 80-90.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def rule_count(firewalls):
+    return sum(len(rules) for rules in firewalls.values())
+
+
+def minimize_firewalls(firewalls):
+    """
+    Squashes the output of net_to_firewalls down to a smaller equivalent set
+    of rules.  Security groups have hard limits on the number of rules, so
+    this matters more than it looks like it should.
+
+    For every node, rule type and protocol:
+
+    - Duplicate rules go away.
+    - The ports each source is allowed on get merged into ranges.
+    - Sources that end up with exactly the same port range get grouped into
+      one rule, with the sources comma separated (the format from the TODO in
+      net_to_firewalls).
+
+    This isn't guaranteed to be the true minimum, which is a set cover
+    problem, but it gets the common cases.
+
+    Returns the new firewalls along with a report of the rule counts before
+    and after, since that's the number that actually matters.
+    """
+    minimized = {}
+    for node, rules in firewalls.items():
+        ports = {}
+        for rule in rules:
+            key = (rule["type"], rule["protocol"])
+            for source in rule["source"].split(","):
+                ports.setdefault(key, {}).setdefault(source, []).append(
+                    parse_ports(rule["port"]))
+        minimized[node] = []
+        for (rule_type, protocol), source_ports in sorted(ports.items()):
+            sources = {}
+            for source, ranges in source_ports.items():
+                for port_range in merge_port_ranges(ranges):
+                    sources.setdefault(port_range, set()).add(source)
+            for (start, end), grouped in sorted(sources.items()):
+                minimized[node].append({
+                    "source": ",".join(sorted(grouped)),
+                    "protocol": protocol,
+                    "port": format_ports(start, end),
+                    "type": rule_type
+                    })
+    report = {
+            "before": rule_count(firewalls),
+            "after": rule_count(minimized)
+            }
+    return minimized, report
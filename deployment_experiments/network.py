@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 
 import attr
-import boto3
 
-from subnet_generator import generate_subnets
-from datacenter import Datacenter
+from . import clients
+from . import memory
+from .subnet_generator import NotEnoughIPSpaceException, generate_subnets
+from .datacenter import Datacenter, DatacenterInventory, allocation_lock
+from .datacenter import pending_blocks, reserved
+from .firewall_compiler import FirewallCompiler
+from .tracing import span, traced
 
 
-class NotEnoughIPSpaceException(Exception):
+class NetworkExistsException(Exception):
     pass
 
 
@@ -39,9 +43,9 @@ class Network(object):
     provider = attr.ib(default="aws")
     deployment_name = attr.ib(default="default")
 
-    def carve_subnets(self, vpc_id, prefix=28, count=3):
+    def carve_subnets(self, vpc_id, prefix=28, count=3, pending=()):
         # First, grab the vpc_cidr using the VPC id
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         vpc = ec2.describe_vpcs(VpcIds=[vpc_id])
         vpc_cidr = vpc["Vpcs"][0]["CidrBlock"]
 
@@ -51,6 +55,8 @@ class Network(object):
                 'Values': [vpc_id]}])
         existing_cidrs = [subnet["CidrBlock"]
                           for subnet in existing_subnets["Subnets"]]
+        # And ones someone else picked, but hasn't created yet
+        existing_cidrs.extend(pending)
 
         # Finally, iterate the list of all subnets of the given prefix that can
         # fit in the given VPC
@@ -66,10 +72,12 @@ class Network(object):
                                         (count, prefix, vpc_id))
 
     def get_availability_zones(self):
+        if self.provider == "memory":
+            return list(memory.cloud.zones)
         # TODO: XXX: Moto does not have this function supported...  So I need
         # to fix that before this code can be reasonable again, because
         # otherwise it just fails.
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         try:
             availability_zones = ec2.describe_availablity_zones()
             return [az["ZoneName"]
@@ -78,10 +86,14 @@ class Network(object):
             return ["us-east-1a", "us-east-1b", "us-east-1c"]
 
     def aws_provision(self, colocated_network, network_name):
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         dc_id = None
         if not colocated_network:
-            dc = Datacenter(deployment_name=self.deployment_name)
+            # The siblings have to be this deployment's, or its VPCs overlap
+            # and can never be peered
+            dc = Datacenter(siblings=DatacenterInventory(
+                                deployment_name=self.deployment_name),
+                            deployment_name=self.deployment_name)
             dc_id = dc.create()
         else:
             dc_id = None
@@ -93,12 +105,17 @@ class Network(object):
                 assert subnet["VpcId"] == dc_id
         subnet_ids = []
         availability_zones = self.get_availability_zones()
-        for subnet_cidr, availability_zone in zip(self.carve_subnets(dc_id),
-                                                  availability_zones):
-            subnet = ec2.create_subnet(CidrBlock=subnet_cidr,
-                                       AvailabilityZone=availability_zone,
-                                       VpcId=dc_id)
-            subnet_ids.append(subnet["Subnet"]["SubnetId"])
+        with allocation_lock:
+            subnet_cidrs = self.carve_subnets(
+                    dc_id, pending=pending_blocks.get(dc_id, ()))
+            pending_blocks.setdefault(dc_id, set()).update(subnet_cidrs)
+        with reserved(dc_id, subnet_cidrs):
+            for subnet_cidr, availability_zone in zip(subnet_cidrs,
+                                                      availability_zones):
+                subnet = ec2.create_subnet(CidrBlock=subnet_cidr,
+                                           AvailabilityZone=availability_zone,
+                                           VpcId=dc_id)
+                subnet_ids.append(subnet["Subnet"]["SubnetId"])
         ec2.create_tags(Resources=subnet_ids,
                         Tags=[{"Key": "cloud-deployer-deployment",
                                "Value": self.deployment_name},
@@ -109,7 +126,7 @@ class Network(object):
     def aws_discover(self, network_name):
         # TODO: I think this throws an exception, but figure out proper error
         # handling.
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         service_filter = {'Name': "tag:cloud-deployer-network",
                           'Values': [network_name]}
         deployment_filter = {'Name': "tag:cloud-deployer-deployment",
@@ -118,22 +135,85 @@ class Network(object):
                                                 deployment_filter])
         return [subnet["SubnetId"] for subnet in subnets["Subnets"]]
 
+    def memory_provision(self, colocated_network, network_name):
+        cloud = memory.cloud
+        if not colocated_network:
+            dc = Datacenter(provider="memory",
+                            deployment_name=self.deployment_name)
+            dc_id = dc.create()
+        else:
+            dc_id = None
+            for subnet in cloud.describe_subnets(
+                    self.discover(colocated_network)):
+                if not dc_id:
+                    dc_id = subnet["vpc"]
+                assert subnet["vpc"] == dc_id
+        subnet_ids = cloud.create_subnets(
+                dc_id, 28, self.get_availability_zones()[:3])
+        cloud.tag_subnets(subnet_ids, {
+            "cloud-deployer-deployment": self.deployment_name,
+            "cloud-deployer-network": network_name})
+        return subnet_ids
+
+    def memory_discover(self, network_name):
+        return [subnet["id"] for subnet in memory.cloud.describe_subnets(
+            tags={"cloud-deployer-network": network_name,
+                  "cloud-deployer-deployment": self.deployment_name})]
+
     def provision(self, network_name="default", colocated_network=None):
         if self.provider == "aws":
             if self.discover(network_name):
-                raise "Service %s already exists!" % network_name
+                raise NetworkExistsException("Network %s already exists!" %
+                                             network_name)
             return self.aws_provision(colocated_network, network_name)
+        elif self.provider == "memory":
+            if self.discover(network_name):
+                raise NetworkExistsException("Network %s already exists!" %
+                                             network_name)
+            return self.memory_provision(colocated_network, network_name)
         else:
             raise NotImplemented
 
     def discover(self, network_name):
         if self.provider == "aws":
             return self.aws_discover(network_name)
+        elif self.provider == "memory":
+            return self.memory_discover(network_name)
+        else:
+            raise NotImplemented
+
+    def aws_placement(self, network_name):
+        ec2 = clients.client("ec2")
+        subnet_ids = self.discover(network_name)
+        if not subnet_ids:
+            return {}
+        placement = {}
+        for subnet in ec2.describe_subnets(SubnetIds=subnet_ids)["Subnets"]:
+            placement.setdefault(subnet["AvailabilityZone"], []).append(
+                subnet["CidrBlock"])
+        return placement
+
+    def memory_placement(self, network_name):
+        placement = {}
+        for subnet in memory.cloud.describe_subnets(
+                self.discover(network_name)):
+            placement.setdefault(subnet["zone"], []).append(subnet["cidr"])
+        return placement
+
+    def placement(self, network_name):
+        """
+        Where a network's subnets are, as {availability zone: [cidrs]}.  This
+        is the per node format routegraph.zonal_routes wants.
+        """
+        if self.provider == "aws":
+            return self.aws_placement(network_name)
+        elif self.provider == "memory":
+            return self.memory_placement(network_name)
         else:
             raise NotImplemented
 
     def colocated(self, subnet_ids):
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         dc_id = None
         for subnet in ec2.describe_subnets(SubnetIds=subnet_ids)["Subnets"]:
             if not dc_id:
@@ -142,30 +222,54 @@ class Network(object):
                 return False
         return True
 
+    @traced("Network.aws_destroy")
     def aws_destroy(self, network_name):
         """
         Destroy all networks represented by this object.  Also destroys the
         underlying VPC if it's empty.
         """
-        ec2 = boto3.client("ec2")
+        ec2 = clients.client("ec2")
         dc_id = None
-        subnet_ids = self.discover(network_name)
-        subnets = ec2.describe_subnets(SubnetIds=subnet_ids)
+        with span("subnet discover", network=network_name):
+            subnet_ids = self.discover(network_name)
+            subnets = ec2.describe_subnets(SubnetIds=subnet_ids)
         for subnet in subnets["Subnets"]:
             if not dc_id:
                 dc_id = subnet["VpcId"]
             assert subnet["VpcId"] == dc_id
-        for subnet in subnet_ids:
-            ec2.delete_subnet(SubnetId=subnet)
-        remaining_subnets = ec2.describe_subnets(Filters=[{
-                'Name': 'vpc-id',
-                'Values': [dc_id]}])
-        if len(remaining_subnets["Subnets"]) == 0:
-            dc = Datacenter(deployment_name=self.deployment_name)
+        with span("subnet delete", subnets=len(subnet_ids)):
+            for subnet in subnet_ids:
+                ec2.delete_subnet(SubnetId=subnet)
+        with span("security group delete", network=network_name):
+            FirewallCompiler(deployment_name=self.deployment_name).destroy(
+                    network_names=[network_name])
+        with span("datacenter destroy", datacenter=dc_id):
+            remaining_subnets = ec2.describe_subnets(Filters=[{
+                    'Name': 'vpc-id',
+                    'Values': [dc_id]}])
+            if len(remaining_subnets["Subnets"]) == 0:
+                dc = Datacenter(deployment_name=self.deployment_name)
+                dc.destroy(dc_id)
+
+    def memory_destroy(self, network_name):
+        cloud = memory.cloud
+        dc_id = None
+        subnet_ids = self.discover(network_name)
+        for subnet in cloud.describe_subnets(subnet_ids):
+            if not dc_id:
+                dc_id = subnet["vpc"]
+            assert subnet["vpc"] == dc_id
+        for subnet_id in subnet_ids:
+            cloud.delete_subnet(subnet_id)
+        if dc_id and not cloud.vpcs[dc_id]["subnets"]:
+            dc = Datacenter(provider="memory",
+                            deployment_name=self.deployment_name)
             dc.destroy(dc_id)
 
     def destroy(self, network_name):
         if self.provider == "aws":
             return self.aws_destroy(network_name)
+        elif self.provider == "memory":
+            return self.memory_destroy(network_name)
         else:
             raise NotImplemented
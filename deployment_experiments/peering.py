@@ -0,0 +1,450 @@
+"""
+Connects a deployment's datacenters to each other, for the traffic between
+services that ended up in different VPCs.
+
+The obvious way is a peering connection between every pair that talks, but
+that's O(n^2) peerings, and every VPC needs a route for every peer.  AWS caps
+route tables at 50 entries and peerings at 50 per VPC by default, so that
+falls over somewhere around fifty datacenters, and it's a lot of API calls
+before that.  So each pair either gets:
+
+- a direct peering, which is the cheapest and fastest path, but costs a
+  peering and a route on both sides.
+- or the transit hub (a transit gateway), which every datacenter that needs
+  it attaches to once.  Its routes all point at the hub, so they can be
+  aggregated: compress_table first, and if that's still more than one
+  route, the smallest block covering all of them.
+
+Pairs get picked for direct peering heaviest traffic first, as long as both
+ends have peerings and routes to spare, and the rest go through the hub.
+Each datacenter has at most max_peerings direct peers and one hub route,
+so the number of peerings and routes grows linearly with the datacenters.
+
+    compiler = PeeringCompiler(deployment_name="prod")
+    plan = compiler.compile(datacenter_traffic(net, datacenter_of), cidrs)
+    compiler.apply(net)
+
+The hub's own route table isn't managed here.  Transit gateways get created
+with default route table association and propagation turned on, so every
+attachment puts its VPC's CIDR block in the hub's table by itself, one
+route per attachment (which max_attachments keeps under AWS's limit).
+
+Aggregated hub routes can cover addresses outside the deployment.  Those
+were unreachable anyway, since the hub only has routes for the datacenters
+attached to it, and anything more specific in the table (like a peering
+that isn't ours) still wins.
+"""
+
+import time
+
+import attr
+
+from . import clients
+from .colocation import traffic_edges
+from .routegraph import compress_table
+from .subnet_generator import ip_network
+
+HUB = "hub"
+
+
+class PeeringException(Exception):
+    pass
+
+
+def datacenter_traffic(net, datacenter_of, external=("external",)):
+    """
+    {(a, b): traffic} between datacenters, with a < b, adding up the traffic
+    of every pair of services in them.  datacenter_of maps each service to
+    its datacenter.
+    """
+    traffic = {}
+    for (first, second), weight in traffic_edges(net, external).items():
+        for service in (first, second):
+            if service not in datacenter_of:
+                raise KeyError("%s has traffic, but isn't in any datacenter" %
+                               service)
+        first, second = datacenter_of[first], datacenter_of[second]
+        if first == second:
+            continue
+        pair = (first, second) if first < second else (second, first)
+        traffic[pair] = traffic.get(pair, 0) + weight
+    return traffic
+
+
+def covering_network(networks):
+    """
+    The smallest single block that covers all the given ones.
+    """
+    for prefixlen in range(min(network.prefixlen for network in networks),
+                           -1, -1):
+        supernets = set(network.supernet(new_prefix=prefixlen)
+                        for network in networks)
+        if len(supernets) == 1:
+            return supernets.pop()
+
+
+def table_to_routes(table):
+    return [{"destination": str(network), "target": target}
+            for network, targets in sorted(table.items())
+            for target in sorted(targets)]
+
+
+@attr.s
+class PeeringPlan(object):
+    # Pairs of datacenters to peer directly
+    peerings = attr.ib()
+    # Datacenters attached to the hub
+    attachments = attr.ib()
+    # {datacenter: [{"destination": cidr, "target": peer or HUB}]}
+    routes = attr.ib()
+    direct_traffic = attr.ib(default=0)
+    hub_traffic = attr.ib(default=0)
+
+    def report(self):
+        return {
+                "peerings": len(self.peerings),
+                "attachments": len(self.attachments),
+                "routes": sum(len(routes) for routes in self.routes.values()),
+                "largest_table": max([0] + [len(routes) for routes
+                                            in self.routes.values()]),
+                "direct_traffic": self.direct_traffic,
+                "hub_traffic": self.hub_traffic
+                }
+
+
+@attr.s
+class PeeringCompiler(object):
+    """
+    max_routes is the route table limit, of which reserved_routes are taken
+    by other things (the local route and the internet gateway).  max_peerings
+    is how many direct peers a datacenter gets, kept well under AWS's 50 so
+    peerings don't grow quadratically.  Pairs with less traffic than
+    direct_threshold always go through the hub.
+    """
+    provider = attr.ib(default="aws")
+    deployment_name = attr.ib(default="default")
+    max_routes = attr.ib(default=50)
+    reserved_routes = attr.ib(default=2)
+    max_peerings = attr.ib(default=10)
+    direct_threshold = attr.ib(default=0)
+    max_attachments = attr.ib(default=5000)
+    external = attr.ib(default=attr.Factory(lambda: ["external"]))
+    hub_timeout = attr.ib(default=600)
+    sleep = attr.ib(default=time.sleep)
+
+    def compile(self, traffic, cidrs):
+        """
+        Takes the traffic between datacenters, from datacenter_traffic, and
+        each datacenter's CIDR block, and returns a PeeringPlan.
+        """
+        # One route always stays free for the hub
+        peer_limit = min(self.max_peerings,
+                         self.max_routes - self.reserved_routes - 1)
+        if peer_limit < 0:
+            raise PeeringException("A route table with %d routes, %d of them "
+                                   "reserved, has no room for the hub" %
+                                   (self.max_routes, self.reserved_routes))
+        networks = dict((datacenter, ip_network(cidr))
+                        for datacenter, cidr in cidrs.items())
+        peers = dict((datacenter, []) for datacenter in cidrs)
+        hub_peers = dict((datacenter, []) for datacenter in cidrs)
+        plan = PeeringPlan(peerings=[], attachments=[], routes={})
+        for (first, second), weight in sorted(
+                traffic.items(), key=lambda item: (-item[1], item[0])):
+            for datacenter in (first, second):
+                if datacenter not in networks:
+                    raise KeyError("There's traffic to %s, but no CIDR block "
+                                   "for it" % datacenter)
+            if networks[first].overlaps(networks[second]):
+                raise PeeringException(
+                    "%s (%s) and %s (%s) overlap, so there's no way to route "
+                    "between them" % (first, cidrs[first], second,
+                                      cidrs[second]))
+            if (weight >= self.direct_threshold and
+                    len(peers[first]) < peer_limit and
+                    len(peers[second]) < peer_limit):
+                peers[first].append(second)
+                peers[second].append(first)
+                plan.peerings.append((first, second))
+                plan.direct_traffic += weight
+            else:
+                hub_peers[first].append(second)
+                hub_peers[second].append(first)
+                plan.hub_traffic += weight
+
+        plan.peerings.sort()
+        plan.attachments = sorted(datacenter for datacenter in hub_peers
+                                  if hub_peers[datacenter])
+        if len(plan.attachments) > self.max_attachments:
+            raise PeeringException(
+                "%d datacenters need the hub, but it only takes %d "
+                "attachments" % (len(plan.attachments), self.max_attachments))
+
+        for datacenter in sorted(cidrs):
+            table = dict((networks[peer], frozenset([peer]))
+                         for peer in peers[datacenter])
+            if hub_peers[datacenter]:
+                hub_table = dict((networks[peer], frozenset([HUB]))
+                                 for peer in hub_peers[datacenter])
+                merged = dict(table)
+                merged.update(hub_table)
+                compressed = compress_table(merged)
+                if len(compressed) > len(table) + 1:
+                    compressed = dict(table)
+                    compressed[covering_network(list(hub_table))] = \
+                        frozenset([HUB])
+                table = compressed
+            if table:
+                plan.routes[datacenter] = table_to_routes(table)
+        return plan
+
+    def aws_datacenters(self):
+        """
+        Every network in the deployment mapped to its VPC, each VPC's CIDR
+        block, and its subnets.  That's one describe_subnets and one
+        describe_vpcs, no matter how many networks there are.
+        """
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        datacenter_of = {}
+        subnets = {}
+        for subnet in ec2.describe_subnets(
+                Filters=[deployment_filter])["Subnets"]:
+            tags = dict((tag["Key"], tag["Value"])
+                        for tag in subnet.get("Tags", []))
+            if "cloud-deployer-network" in tags:
+                datacenter_of[tags["cloud-deployer-network"]] = \
+                    subnet["VpcId"]
+            subnets.setdefault(subnet["VpcId"], []).append(subnet)
+        cidrs = {}
+        if subnets:
+            cidrs = dict((vpc["VpcId"], vpc["CidrBlock"]) for vpc
+                         in ec2.describe_vpcs(VpcIds=sorted(subnets))["Vpcs"])
+        return datacenter_of, cidrs, subnets
+
+    def aws_peerings(self, plan):
+        """
+        Creates the peerings that don't exist yet.  Returns {pair: peering
+        id} for every one of ours, wanted or not, and what got created.
+        """
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        status_filter = {'Name': "status-code",
+                         'Values': ["active", "pending-acceptance"]}
+        existing = {}
+        for peering in ec2.describe_vpc_peering_connections(
+                Filters=[deployment_filter, status_filter])[
+                    "VpcPeeringConnections"]:
+            pair = tuple(sorted([peering["RequesterVpcInfo"]["VpcId"],
+                                 peering["AccepterVpcInfo"]["VpcId"]]))
+            existing[pair] = peering["VpcPeeringConnectionId"]
+        created = []
+        for first, second in plan.peerings:
+            if (first, second) in existing:
+                continue
+            peering_id = ec2.create_vpc_peering_connection(
+                    VpcId=first, PeerVpcId=second)[
+                        "VpcPeeringConnection"]["VpcPeeringConnectionId"]
+            ec2.accept_vpc_peering_connection(
+                    VpcPeeringConnectionId=peering_id)
+            ec2.create_tags(Resources=[peering_id],
+                            Tags=[{"Key": "cloud-deployer-deployment",
+                                   "Value": self.deployment_name}])
+            existing[(first, second)] = peering_id
+            created.append((first, second))
+        return existing, created
+
+    def aws_hub(self, plan, subnets):
+        """
+        Finds or creates the deployment's transit gateway, and attaches
+        every datacenter in the plan that isn't yet.  Returns the gateway id
+        (None if there isn't one and nothing needs it), its attachments by
+        VPC, and which VPCs got attached.
+        """
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        hubs = [hub for hub in ec2.describe_transit_gateways(
+                    Filters=[deployment_filter])["TransitGateways"]
+                if hub["State"] not in ("deleting", "deleted")]
+        if hubs:
+            hub_id = hubs[0]["TransitGatewayId"]
+        elif plan.attachments:
+            hub_id = ec2.create_transit_gateway(
+                    Description="cloud-deployer hub for %s" %
+                    self.deployment_name,
+                    TagSpecifications=[{
+                        "ResourceType": "transit-gateway",
+                        "Tags": [{"Key": "cloud-deployer-deployment",
+                                  "Value": self.deployment_name}]}])[
+                        "TransitGateway"]["TransitGatewayId"]
+        else:
+            return None, {}, []
+        self.aws_wait_for_hub(hub_id)
+
+        attachments = {}
+        hub_filter = {'Name': "transit-gateway-id", 'Values': [hub_id]}
+        for attachment in ec2.describe_transit_gateway_vpc_attachments(
+                Filters=[hub_filter])["TransitGatewayVpcAttachments"]:
+            if attachment["State"] not in ("deleting", "deleted"):
+                attachments[attachment["VpcId"]] = \
+                    attachment["TransitGatewayAttachmentId"]
+        attached = []
+        for vpc_id in plan.attachments:
+            if vpc_id in attachments:
+                continue
+            # An attachment takes one subnet in each zone it serves
+            by_zone = {}
+            for subnet in sorted(subnets[vpc_id],
+                                 key=lambda subnet: subnet["SubnetId"]):
+                by_zone.setdefault(subnet["AvailabilityZone"],
+                                   subnet["SubnetId"])
+            attachments[vpc_id] = ec2.create_transit_gateway_vpc_attachment(
+                    TransitGatewayId=hub_id, VpcId=vpc_id,
+                    SubnetIds=[by_zone[zone] for zone in sorted(by_zone)])[
+                        "TransitGatewayVpcAttachment"][
+                        "TransitGatewayAttachmentId"]
+            attached.append(vpc_id)
+        return hub_id, attachments, attached
+
+    def aws_wait_for_hub(self, hub_id):
+        ec2 = clients.client("ec2")
+        waited = 0
+        while True:
+            state = ec2.describe_transit_gateways(
+                    TransitGatewayIds=[hub_id])["TransitGateways"][0]["State"]
+            if state == "available":
+                return
+            if waited >= self.hub_timeout:
+                raise PeeringException("Transit gateway %s is still %s after "
+                                       "%d seconds" % (hub_id, state, waited))
+            self.sleep(5)
+            waited += 5
+
+    def aws_delete_hub(self, hub_id):
+        """
+        Deletes the transit gateway once nothing's attached to it, since it
+        bills by the hour whether it's used or not.  Detaching takes a while,
+        and the gateway can't go until it's done.
+        """
+        ec2 = clients.client("ec2")
+        hub_filter = {'Name': "transit-gateway-id", 'Values': [hub_id]}
+        waited = 0
+        while any(attachment["State"] != "deleted" for attachment
+                  in ec2.describe_transit_gateway_vpc_attachments(
+                      Filters=[hub_filter])["TransitGatewayVpcAttachments"]):
+            if waited >= self.hub_timeout:
+                raise PeeringException("Transit gateway %s still has "
+                                       "attachments after %d seconds" %
+                                       (hub_id, waited))
+            self.sleep(5)
+            waited += 5
+        ec2.delete_transit_gateway(TransitGatewayId=hub_id)
+
+    def aws_routes(self, plan, vpc_ids, peering_ids, hub_id):
+        """
+        Makes the main route table of each VPC in vpc_ids match the plan.
+        Only routes that go to one of our peerings or our hub get replaced
+        or deleted.
+        """
+        ec2 = clients.client("ec2")
+        ours = set(peering_ids.values())
+        if hub_id:
+            ours.add(hub_id)
+        tables = {}
+        if vpc_ids:
+            for table in ec2.describe_route_tables(
+                    Filters=[{'Name': "vpc-id", 'Values': vpc_ids},
+                             {'Name': "association.main",
+                              'Values': ["true"]}])["RouteTables"]:
+                tables[table["VpcId"]] = table
+
+        changes = {}
+        for vpc_id, table in sorted(tables.items()):
+            existing = {}
+            for route in table["Routes"]:
+                target = (route.get("VpcPeeringConnectionId") or
+                          route.get("TransitGatewayId"))
+                if "DestinationCidrBlock" in route and target in ours:
+                    existing[route["DestinationCidrBlock"]] = target
+            wanted = {}
+            for route in plan.routes.get(vpc_id, []):
+                if route["target"] == HUB:
+                    wanted[route["destination"]] = hub_id
+                else:
+                    pair = tuple(sorted([vpc_id, route["target"]]))
+                    wanted[route["destination"]] = peering_ids[pair]
+            vpc_changes = {}
+            for destination, target in sorted(wanted.items()):
+                if destination not in existing:
+                    vpc_changes.setdefault("create", []).append(destination)
+                elif existing[destination] != target:
+                    vpc_changes.setdefault("replace", []).append(destination)
+                else:
+                    continue
+                call = (ec2.create_route if destination not in existing
+                        else ec2.replace_route)
+                target_key = ("TransitGatewayId" if target == hub_id
+                              else "VpcPeeringConnectionId")
+                call(RouteTableId=table["RouteTableId"],
+                     DestinationCidrBlock=destination, **{target_key: target})
+            for destination in sorted(set(existing) - set(wanted)):
+                ec2.delete_route(RouteTableId=table["RouteTableId"],
+                                 DestinationCidrBlock=destination)
+                vpc_changes.setdefault("delete", []).append(destination)
+            if vpc_changes:
+                changes[vpc_id] = vpc_changes
+        return changes
+
+    def aws_execute(self, plan, subnets):
+        """
+        Everything gets built first, then routes move over, and only then
+        does anything that's no longer wanted get removed, so traffic always
+        has a path while it changes.
+        """
+        ec2 = clients.client("ec2")
+        changes = {}
+        peering_ids, created = self.aws_peerings(plan)
+        if created:
+            changes["peer"] = created
+        hub_id, attachments, attached = self.aws_hub(plan, subnets)
+        if attached:
+            changes["attach"] = attached
+        routes = self.aws_routes(plan, sorted(subnets), peering_ids, hub_id)
+        if routes:
+            changes["routes"] = routes
+        unpeered = sorted(set(peering_ids) - set(plan.peerings))
+        for pair in unpeered:
+            ec2.delete_vpc_peering_connection(
+                    VpcPeeringConnectionId=peering_ids[pair])
+        if unpeered:
+            changes["unpeer"] = unpeered
+        detached = sorted(set(attachments) - set(plan.attachments))
+        for vpc_id in detached:
+            ec2.delete_transit_gateway_vpc_attachment(
+                    TransitGatewayAttachmentId=attachments[vpc_id])
+        if detached:
+            changes["detach"] = detached
+        if hub_id and not plan.attachments:
+            self.aws_delete_hub(hub_id)
+            changes["delete_hub"] = hub_id
+        return changes
+
+    def aws_apply(self, net):
+        datacenter_of, cidrs, subnets = self.aws_datacenters()
+        plan = self.compile(datacenter_traffic(net, datacenter_of,
+                                               self.external), cidrs)
+        return self.aws_execute(plan, subnets)
+
+    def apply(self, net):
+        """
+        Peers the datacenters of a deployment for the traffic in net, a
+        netgraph net whose rules can carry "traffic" (see colocation).
+        Returns the changes that were made.
+        """
+        if self.provider == "aws":
+            return self.aws_apply(net)
+        else:
+            raise NotImplemented
@@ -0,0 +1,496 @@
+"""
+Plan and apply, so a deploy only touches what actually changed.
+
+provision() goes straight to the mutating APIs, and has to discover first just
+to find out whether there's anything to do.  Instead, a Planner takes one
+snapshot of everything in the deployment, with a fixed number of reads, and
+compares it against the deployment we want:
+
+    planner = Planner(deployment_name="prod")
+    snapshot = planner.snapshot(desired)
+    changes = planner.plan(desired, snapshot)
+    planner.apply(changes, desired, snapshot)
+
+Planning doesn't call AWS at all, so it works just as well on a snapshot
+that was saved as JSON somewhere.  Applying only makes the calls for the
+changes in the plan, so running an unchanged deployment again costs the
+snapshot's reads and no writes.
+
+The desired deployment looks like:
+
+    {
+        "load_balancers": {"web-lb": {"dns": "web.example.com"}},
+        "services": {"web": {"image": image, "load_balancer": "web-lb"}},
+        "networks": {"db": {"colocated_with": "web-lb"}},
+        "net": {...}
+    }
+
+Every load balancer gets its own network in a new datacenter, every service
+gets a network colocated with its load balancer (like provision() does), and
+"networks" is for any other networks.  A service can also have a "capacity",
+as CapacityModel's arguments, to size its group.  "net" is a netgraph net, which gets
+compiled into security groups.
+
+A change is a dict with an "action", in the order they need to happen:
+networks, load balancers, DNS, services, then firewalls, and then whatever
+isn't wanted anymore, in the reverse order.  DNS records are only looked at in
+zones the desired load balancers use, so records in other zones are never
+touched, and only the ones pointing at the deployment's load balancers ever
+get deleted.  Load balancers are tagged with their DNS name, so their zones
+get read (and pruned, once they're empty) even when nothing desired uses
+them.
+"""
+
+import attr
+
+from . import clients
+from .capacity import CapacityModel
+from .firewall_compiler import EXTERNAL_CIDRS, FirewallCompiler
+from .firewall_compiler import permissions_to_rules
+from .datacenter import Datacenter
+from .netgraph import net_to_firewalls
+from .network import Network
+from .service import LoadBalancer, Service, ServiceDns
+from .subnet_generator import collapse_cidrs
+from .tracing import span
+
+
+class PlanException(Exception):
+    pass
+
+
+def tag_dict(tags):
+    return dict((tag["Key"], tag["Value"]) for tag in tags or [])
+
+
+def paginate(client, operation, key, **kwargs):
+    """
+    Every item from an operation, across all the pages.
+    """
+    if client.can_paginate(operation):
+        return [item for page
+                in client.get_paginator(operation).paginate(**kwargs)
+                for item in page[key]]
+    return getattr(client, operation)(**kwargs)[key]
+
+
+def desired_networks(desired):
+    """
+    Every network the deployment needs, as {name: network it's colocated with,
+    or None for a new datacenter}.
+    """
+    networks = {}
+    for name in desired.get("load_balancers", {}):
+        networks[name] = None
+    for name, service in desired.get("services", {}).items():
+        networks[name] = service.get("load_balancer")
+    for name, network in desired.get("networks", {}).items():
+        networks[name] = network.get("colocated_with")
+    return networks
+
+
+def network_order(networks):
+    """
+    Network names with every network after the one it's colocated with.
+    """
+    order = []
+    placed = set()
+    remaining = sorted(networks)
+    while remaining:
+        ready = [name for name in remaining
+                 if networks[name] is None or networks[name] in placed]
+        if not ready:
+            missing = [name for name in remaining
+                       if networks[name] not in networks]
+            if missing:
+                raise PlanException("Network %s is colocated with %s, which "
+                                    "isn't in the deployment" %
+                                    (missing[0], networks[missing[0]]))
+            raise PlanException("Networks %s are colocated with each other "
+                                "in a loop" % ", ".join(remaining))
+        order.extend(ready)
+        placed.update(ready)
+        remaining = [name for name in remaining if name not in placed]
+    return order
+
+
+def rule_set(rules):
+    return set(tuple(rule) for rule in rules)
+
+
+@attr.s
+class Planner(object):
+    provider = attr.ib(default="aws")
+    deployment_name = attr.ib(default="default")
+
+    def aws_snapshot(self, zone_names):
+        zone_names = set(zone_names)
+        ec2 = clients.client("ec2")
+        deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                             'Values': [self.deployment_name]}
+        vpcs = paginate(ec2, "describe_vpcs", "Vpcs",
+                        Filters=[deployment_filter])
+        snapshot = {
+                "datacenters": sorted(vpc["VpcId"] for vpc in vpcs),
+                "datacenter_cidrs": dict((vpc["VpcId"], vpc["CidrBlock"])
+                                         for vpc in vpcs),
+                "networks": {},
+                "security_groups": {},
+                "load_balancers": {},
+                "services": {},
+                "zones": {}
+                }
+        subnet_networks = {}
+        for subnet in paginate(ec2, "describe_subnets", "Subnets",
+                               Filters=[deployment_filter]):
+            name = tag_dict(subnet.get("Tags")).get("cloud-deployer-network")
+            if name is None:
+                continue
+            network = snapshot["networks"].setdefault(name, {
+                "datacenter": subnet["VpcId"], "subnets": {}})
+            network["subnets"][subnet["SubnetId"]] = {
+                    "cidr": subnet["CidrBlock"],
+                    "zone": subnet["AvailabilityZone"]}
+            subnet_networks[subnet["SubnetId"]] = name
+
+        for group in paginate(ec2, "describe_security_groups",
+                              "SecurityGroups", Filters=[deployment_filter]):
+            name = tag_dict(group.get("Tags")).get("cloud-deployer-network")
+            if name is not None:
+                snapshot["security_groups"][name] = {
+                        "id": group["GroupId"],
+                        "ingress": sorted(list(rule) for rule in
+                                          permissions_to_rules(
+                                              group["IpPermissions"])),
+                        "egress": sorted(list(rule) for rule in
+                                         permissions_to_rules(
+                                             group["IpPermissionsEgress"]))}
+
+        # Load balancers and autoscaling groups aren't tagged, so they belong
+        # to the deployment if they're in its subnets.
+        elb = clients.client("elb")
+        for load_balancer in paginate(elb, "describe_load_balancers",
+                                      "LoadBalancerDescriptions"):
+            if any(subnet in subnet_networks
+                   for subnet in load_balancer["Subnets"]):
+                snapshot["load_balancers"][
+                    load_balancer["LoadBalancerName"]] = {
+                        "dns_name": load_balancer["DNSName"],
+                        "subnets": sorted(load_balancer["Subnets"])}
+        # Which name each one got pointed at, so its record can be found
+        # again even when no desired load balancer uses that zone anymore.
+        names = sorted(snapshot["load_balancers"])
+        for start in range(0, len(names), 20):
+            for description in elb.describe_tags(
+                    LoadBalancerNames=names[start:start + 20])[
+                        "TagDescriptions"]:
+                dns = tag_dict(description["Tags"]).get("cloud-deployer-dns")
+                snapshot["load_balancers"][description["LoadBalancerName"]][
+                    "dns"] = dns
+                if dns:
+                    zone_names.add(ServiceDns(dns, None).zone_name())
+
+        autoscaling = clients.client("autoscaling")
+        for group in paginate(autoscaling, "describe_auto_scaling_groups",
+                              "AutoScalingGroups"):
+            subnets = [subnet for subnet
+                       in group["VPCZoneIdentifier"].split(",") if subnet]
+            if any(subnet in subnet_networks for subnet in subnets):
+                snapshot["services"][group["AutoScalingGroupName"]] = {
+                        "launch_configuration": group.get(
+                            "LaunchConfigurationName"),
+                        "load_balancers": sorted(group["LoadBalancerNames"]),
+                        "subnets": sorted(subnets)}
+
+        # One read per zone we care about, not per record or per zone in the
+        # account.
+        if zone_names:
+            route53 = clients.client("route53")
+            for zone in paginate(route53, "list_hosted_zones",
+                                 "HostedZones"):
+                zone_name = zone["Name"].rstrip(".")
+                if (zone_name not in zone_names or
+                        zone_name in snapshot["zones"]):
+                    continue
+                records = {}
+                other_records = 0
+                for record in paginate(route53, "list_resource_record_sets",
+                                       "ResourceRecordSets",
+                                       HostedZoneId=zone["Id"]):
+                    if record["Type"] == "CNAME":
+                        records[record["Name"].rstrip(".")] = record[
+                            "ResourceRecords"][0]["Value"]
+                    elif record["Type"] not in ("NS", "SOA"):
+                        other_records += 1
+                snapshot["zones"][zone_name] = {
+                        "id": zone["Id"], "records": records,
+                        "other_records": other_records}
+        return snapshot
+
+    def snapshot(self, desired=None):
+        """
+        Everything in the deployment that plan needs, as plain JSON friendly
+        dicts and lists.
+        """
+        zone_names = set(
+                ServiceDns(load_balancer["dns"], None).zone_name()
+                for load_balancer
+                in (desired or {}).get("load_balancers", {}).values())
+        if self.provider == "aws":
+            return self.aws_snapshot(zone_names)
+        else:
+            raise NotImplemented
+
+    def plan_firewalls(self, net, snapshot):
+        """
+        If every network in the net already exists, this works out the exact
+        rule changes offline.  Otherwise the CIDRs aren't known until the
+        networks get created, so the whole thing gets compiled at apply time.
+        """
+        firewalls = net_to_firewalls(net)
+        networks = snapshot["networks"]
+        groups = snapshot["security_groups"]
+        sources = set(source for rules in firewalls.values()
+                      for rule in rules
+                      for source in rule["source"].split(","))
+        if (any(node not in groups or node not in networks
+                for node in firewalls) or
+                any(source not in networks and source != "external"
+                    for source in sources)):
+            return [{"action": "apply_firewalls"}]
+        compiler = FirewallCompiler(provider=self.provider,
+                                    deployment_name=self.deployment_name)
+        cidrs = {"external": EXTERNAL_CIDRS}
+        for name, network in networks.items():
+            cidrs[name] = collapse_cidrs(subnet["cidr"] for subnet
+                                         in network["subnets"].values())
+        existing = dict((node, {"ingress": rule_set(group["ingress"]),
+                                "egress": rule_set(group["egress"])})
+                        for node, group in groups.items())
+        changes = compiler.diff_rules(compiler.generate_rules(firewalls,
+                                                              cidrs),
+                                      existing)
+        return [{"action": "update_firewall", "name": node,
+                 "group_id": groups[node]["id"],
+                 "rule_counts": {"ingress": len(existing[node]["ingress"]),
+                                 "egress": len(existing[node]["egress"])},
+                 "changes": dict((action, sorted(list(rule)
+                                                 for rule in rules))
+                                 for action, rules in node_changes.items())}
+                for node, node_changes in sorted(changes.items())]
+
+    def plan(self, desired, snapshot, prune=True):
+        """
+        The ordered list of changes that gets from snapshot to desired.  With
+        prune, anything in the deployment that isn't in desired goes away.
+        """
+        changes = []
+        networks = desired_networks(desired)
+        existing = snapshot["networks"]
+        load_balancers = desired.get("load_balancers", {})
+        services = desired.get("services", {})
+
+        for name in network_order(networks):
+            colocated = networks[name]
+            if name not in existing:
+                changes.append({"action": "create_network", "name": name,
+                                "colocated_with": colocated})
+            elif (colocated in existing and existing[colocated]["datacenter"]
+                  != existing[name]["datacenter"]):
+                raise PlanException("Network %s should be colocated with %s, "
+                                    "but it's in %s and networks can't move" %
+                                    (name, colocated,
+                                     existing[name]["datacenter"]))
+
+        for name in sorted(load_balancers):
+            if name not in snapshot["load_balancers"]:
+                changes.append({"action": "create_load_balancer",
+                                "name": name})
+
+        for name, load_balancer in sorted(load_balancers.items()):
+            dns = load_balancer["dns"]
+            zone = snapshot["zones"].get(ServiceDns(dns, None).zone_name())
+            current = zone["records"].get(dns) if zone else None
+            target = snapshot["load_balancers"].get(name, {}).get("dns_name")
+            if current is None:
+                action = "create_dns"
+            elif target is None or current != target:
+                action = "update_dns"
+            else:
+                continue
+            changes.append({"action": action, "name": dns,
+                            "load_balancer": name,
+                            "zone_id": zone["id"] if zone else None})
+
+        for name, service in sorted(services.items()):
+            if name not in snapshot["services"]:
+                changes.append({"action": "create_service", "name": name,
+                                "load_balancer": service.get(
+                                    "load_balancer")})
+
+        if desired.get("net"):
+            changes.extend(self.plan_firewalls(desired["net"], snapshot))
+
+        if prune:
+            firewall_nodes = net_to_firewalls(desired.get("net") or {})
+            for name, group in sorted(snapshot["security_groups"].items()):
+                if name not in firewall_nodes:
+                    changes.append({"action": "delete_security_group",
+                                    "name": name, "group_id": group["id"]})
+            for name in sorted(snapshot["services"]):
+                if name not in services:
+                    changes.append({"action": "delete_service",
+                                    "name": name,
+                                    "launch_configuration": snapshot[
+                                        "services"][name][
+                                        "launch_configuration"]})
+            # Only records pointing at one of our load balancers are ours, the
+            # rest of the zone belongs to someone else.
+            wanted_dns = set(load_balancer["dns"]
+                             for load_balancer in load_balancers.values())
+            targets = set(load_balancer["dns_name"] for load_balancer
+                          in snapshot["load_balancers"].values())
+            wanted_zones = set(ServiceDns(dns, None).zone_name()
+                               for dns in wanted_dns)
+            for zone_name, zone in sorted(snapshot["zones"].items()):
+                deleted = 0
+                for dns, target in sorted(zone["records"].items()):
+                    if target in targets and dns not in wanted_dns:
+                        changes.append({"action": "delete_dns", "name": dns,
+                                        "target": target,
+                                        "zone_id": zone["id"]})
+                        deleted += 1
+                # Like LoadBalancer.destroy, the zone goes too, but only
+                # when nothing else is left in it.
+                if (deleted and zone_name not in wanted_zones and
+                        deleted == len(zone["records"]) and
+                        not zone.get("other_records")):
+                    changes.append({"action": "delete_dns_zone",
+                                    "name": zone_name,
+                                    "zone_id": zone["id"]})
+            for name in sorted(snapshot["load_balancers"]):
+                if name not in load_balancers:
+                    changes.append({"action": "delete_load_balancer",
+                                    "name": name})
+            for name in sorted(existing):
+                if name not in networks:
+                    changes.append({"action": "delete_network",
+                                    "name": name})
+            # Network.destroy takes the datacenter with it when it's the last
+            # network, so this is just for ones that were already empty.
+            used = set(network["datacenter"] for network in existing.values())
+            for datacenter in snapshot["datacenters"]:
+                if datacenter not in used:
+                    changes.append({"action": "delete_datacenter",
+                                    "name": datacenter})
+        return changes
+
+    def aws_create_network(self, change, desired, state):
+        network = Network(deployment_name=self.deployment_name)
+        # No need for provision()'s discover, the plan knows it isn't there.
+        state["subnets"][change["name"]] = network.aws_provision(
+                change["colocated_with"], change["name"])
+
+    def aws_create_load_balancer(self, change, desired, state):
+        load_balancer = LoadBalancer(
+                change["name"],
+                desired.get("load_balancers", {})[change["name"]]["dns"])
+        state["dns_names"][change["name"]] = (
+                load_balancer.create_load_balancer(
+                    state["subnets"][change["name"]]))
+
+    def aws_create_dns(self, change, desired, state):
+        dns = ServiceDns(change["name"],
+                         state["dns_names"][change["load_balancer"]])
+        zone_id = change["zone_id"] or state["zones"].get(dns.zone_name())
+        if zone_id is None:
+            zone_id = dns.create_zone()["HostedZone"]["Id"]
+            state["zones"][dns.zone_name()] = zone_id
+        dns.create_record(zone_id)
+
+    def aws_update_dns(self, change, desired, state):
+        dns = ServiceDns(change["name"],
+                         state["dns_names"][change["load_balancer"]])
+        dns.create_record(change["zone_id"], action="UPSERT")
+
+    def aws_create_service(self, change, desired, state):
+        load_balancer_name = change["load_balancer"]
+        load_balancer = None
+        if load_balancer_name is not None:
+            load_balancer = LoadBalancer(
+                    load_balancer_name,
+                    desired.get("load_balancers", {}).get(
+                        load_balancer_name, {}).get("dns"))
+        wanted = desired.get("services", {})[change["name"]]
+        capacity = wanted.get("capacity")
+        service = Service(change["name"], wanted["image"], load_balancer,
+                          capacity=(CapacityModel(**capacity) if capacity
+                                    else None),
+                          deployment_name=self.deployment_name)
+        service.auto_scaling_group(change["name"],
+                                   state["subnets"][change["name"]])
+
+    def aws_update_firewall(self, change, desired, state):
+        compiler = FirewallCompiler(provider=self.provider,
+                                    deployment_name=self.deployment_name)
+        compiler.aws_execute({change["name"]: dict(
+                                (action, rule_set(rules)) for action, rules
+                                in change["changes"].items())},
+                             {change["name"]: change["group_id"]},
+                             {change["name"]: change["rule_counts"]})
+
+    def aws_apply_firewalls(self, change, desired, state):
+        compiler = FirewallCompiler(provider=self.provider,
+                                    deployment_name=self.deployment_name)
+        compiler.apply(net_to_firewalls(desired["net"]))
+
+    def aws_delete_security_group(self, change, desired, state):
+        clients.client("ec2").delete_security_group(
+                GroupId=change["group_id"])
+
+    def aws_delete_dns(self, change, desired, state):
+        ServiceDns(change["name"], change["target"]).create_record(
+                change["zone_id"], action="DELETE")
+
+    def aws_delete_dns_zone(self, change, desired, state):
+        clients.client("route53").delete_hosted_zone(Id=change["zone_id"])
+
+    def aws_delete_service(self, change, desired, state):
+        Service(change["name"], None, None).delete_auto_scaling_group(
+                change.get("launch_configuration"))
+
+    def aws_delete_load_balancer(self, change, desired, state):
+        LoadBalancer(change["name"], None).delete_load_balancer()
+
+    def aws_delete_network(self, change, desired, state):
+        Network(deployment_name=self.deployment_name).destroy(change["name"])
+
+    def aws_delete_datacenter(self, change, desired, state):
+        Datacenter(deployment_name=self.deployment_name).destroy(
+                change["name"])
+
+    def apply(self, changes, desired, snapshot):
+        """
+        Makes the changes from plan, in order.  Returns what got created along
+        the way, as {"subnets": {network: ids}, "dns_names": {load balancer:
+        DNS name}, "zones": {zone name: id}}, on top of what was in the
+        snapshot.
+        """
+        state = {
+                "subnets": dict((name, sorted(network["subnets"]))
+                                for name, network
+                                in snapshot["networks"].items()),
+                "dns_names": dict((name, load_balancer["dns_name"])
+                                  for name, load_balancer
+                                  in snapshot["load_balancers"].items()),
+                "zones": dict((name, zone["id"]) for name, zone
+                              in snapshot["zones"].items())
+                }
+        for change in changes:
+            if self.provider == "aws":
+                step = getattr(self, "aws_%s" % change["action"])
+            else:
+                raise NotImplemented
+            with span(change["action"], resource=change.get("name")):
+                step(change, desired, state)
+        return state
@@ -0,0 +1,190 @@
+"""
+Client side rate limiting and retries, so provisioning lots of services at
+once runs at the API limits instead of falling over at them.
+
+Every client from clients.client gets attached to the shared limiter:
+
+- Each service has a token bucket, and every attempt (retries included) takes
+  a token before it goes out.  The rates start at roughly the published
+  limits, which are per account and region, so every client in the process
+  shares the same bucket.
+- When AWS throttles us anyway (someone else is using the account too), that
+  service's rate gets halved, and then creeps back up by a little with every
+  call that succeeds.  That's the same additive increase, multiplicative
+  decrease that TCP does.
+- Throttled calls always get retried, since AWS never ran them.  Other
+  transient failures (5xx, dropped connections) only get retried when that's
+  safe, meaning reads and calls that carry an idempotency token.  Each retry
+  waits a random amount of time up to an exponentially growing cap, so
+  clients that got throttled together don't all come back together.
+"""
+
+import random
+import threading
+import time
+import timeit
+
+import attr
+
+from .instrumentation import THROTTLE_CODES, READ_PREFIXES, error_code
+
+# (requests per second, burst), keyed by endpoint prefix.  EC2 publishes its
+# buckets; ELB and autoscaling don't, so those are what they seem to
+# tolerate.  Route53 is 5 requests per second for the whole account.
+LIMITS = {
+        "ec2": (20.0, 100),
+        "elasticloadbalancing": (10.0, 20),
+        "autoscaling": (10.0, 20),
+        "route53": (5.0, 5)
+        }
+DEFAULT_LIMIT = (10.0, 10)
+IDEMPOTENCY_TOKENS = ("ClientToken", "CallerReference", "IdempotencyToken")
+
+
+@attr.s
+class TokenBucket(object):
+    """
+    A token bucket whose rate adapts between min_rate and max_rate.  Taking a
+    token never fails, it just sleeps until the token would have been there.
+    """
+    max_rate = attr.ib()
+    capacity = attr.ib()
+    rate = attr.ib(default=None)
+    min_rate = attr.ib(default=0.5)
+    increase = attr.ib(default=None)
+    clock = attr.ib(default=timeit.default_timer)
+    sleep = attr.ib(default=time.sleep)
+    tokens = attr.ib(default=None)
+    updated = attr.ib(default=None)
+    _lock = attr.ib(default=attr.Factory(threading.Lock))
+
+    def __attrs_post_init__(self):
+        if self.rate is None:
+            self.rate = self.max_rate
+        if self.increase is None:
+            self.increase = self.max_rate / 100.0
+        if self.tokens is None:
+            self.tokens = float(self.capacity)
+        if self.updated is None:
+            self.updated = self.clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(float(self.capacity),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token, and returns how long it had to wait for it.  Tokens can
+        go negative, which reserves a spot in line so waiting threads don't
+        all wake up for the same token.
+        """
+        with self._lock:
+            self.refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.refill()
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+def idempotent(operation):
+    """
+    Reads are always safe to repeat.  Writes are when they carry a token that
+    AWS dedupes on, either one botocore fills in for us or one the API
+    requires (like Route53's CallerReference).
+    """
+    if operation.name.startswith(READ_PREFIXES):
+        return True
+    input_shape = operation.input_shape
+    if input_shape is None:
+        return False
+    for name, member in input_shape.members.items():
+        if name in IDEMPOTENCY_TOKENS and (
+                member.metadata.get("idempotencyToken") or
+                name in input_shape.required_members):
+            return True
+    return False
+
+
+def retryable(operation, response, caught_exception):
+    """
+    Whether a failed attempt is safe to try again, and whether it was a
+    throttle.  Returns (retry, throttled).
+    """
+    code = error_code(response[1]) if response else None
+    if code in THROTTLE_CODES:
+        return True, True
+    transient = (caught_exception is not None or
+                 (response is not None and response[0].status_code >= 500))
+    if not transient:
+        return False, False
+    return idempotent(operation), False
+
+
+@attr.s
+class RateLimiter(object):
+    """
+    One bucket per service, created on first use from LIMITS.  max_attempts
+    counts the first try.
+    """
+    limits = attr.ib(default=attr.Factory(lambda: dict(LIMITS)))
+    max_attempts = attr.ib(default=8)
+    base_delay = attr.ib(default=0.1)
+    max_delay = attr.ib(default=20.0)
+    buckets = attr.ib(default=attr.Factory(dict))
+    _lock = attr.ib(default=attr.Factory(threading.Lock))
+
+    def bucket(self, service_name):
+        with self._lock:
+            if service_name not in self.buckets:
+                rate, capacity = self.limits.get(service_name, DEFAULT_LIMIT)
+                self.buckets[service_name] = TokenBucket(max_rate=rate,
+                                                         capacity=capacity)
+            return self.buckets[service_name]
+
+    def delay(self, attempts):
+        """
+        Full jitter: anywhere from nothing up to the exponential backoff.
+        """
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempts))
+
+    def attach(self, client):
+        """
+        Hooks a client up to this limiter.  The client should be created with
+        botocore's own retries turned off (see clients.client), or both will
+        retry.
+        """
+        service_name = client.meta.service_model.endpoint_prefix
+        bucket = self.bucket(service_name)
+
+        def request_created(**kwargs):
+            bucket.acquire()
+
+        def needs_retry(attempts, operation, response=None,
+                        caught_exception=None, **kwargs):
+            retry, throttled = retryable(operation, response,
+                                         caught_exception)
+            if throttled:
+                bucket.throttled()
+            elif not retry and caught_exception is None:
+                bucket.succeeded()
+            if retry and attempts < self.max_attempts:
+                return self.delay(attempts)
+            return None
+
+        client.meta.events.register("request-created", request_created)
+        client.meta.events.register("needs-retry", needs_retry)
+        return client
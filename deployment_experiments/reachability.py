@@ -0,0 +1,182 @@
+"""
+Answers "can A reach B on tcp/443?" without walking every rule.
+
+The index gets built once from compiled firewalls (and optionally routes), and
+then every query is a lookup.  Ports get split into classes per protocol,
+where a class is a range of ports that every rule treats the same way.  For
+each class every node gets a bitset of the nodes it can reach, stored as a
+plain python int, so a point query is a bit test and a whole row of the
+all-pairs matrix is a couple of big integer ANDs.
+
+A can reach B when:
+
+- B allows ingress from A,
+- A allows egress to B, and
+- if routes were given, following the route tables from A towards B actually
+  gets there.
+
+Nodes that don't have a firewall (like "external") don't filter anything, and
+nodes without a route table are assumed to be able to send anywhere that can
+route back to them.
+"""
+
+from bisect import bisect_right
+
+import attr
+
+from .compactgraph import Interner, parse_ports
+
+
+def route_masks(routes, nodes):
+    """
+    For every node, a bitset of the destinations the route tables get it to.
+    Route entries get indexed by destination once, and each destination's
+    walk is memoized, so this is linear in the number of route entries.
+    """
+    next_hops = {}
+    for node, entries in routes.items():
+        for entry in entries:
+            next_hops.setdefault(entry["destination"], {}).setdefault(
+                node, entry["target"])
+    masks = [0] * len(nodes)
+    for destination, hops in next_hops.items():
+        reached = {destination: True}
+        for start in hops:
+            path = []
+            on_path = set()
+            node = start
+            while node not in reached and node in hops and node not in on_path:
+                path.append(node)
+                on_path.add(node)
+                node = hops[node]
+            # Walking off the end of the tables only counts if we got there,
+            # and coming back around to the path itself is a loop.
+            result = reached.get(node, False)
+            for hop in path:
+                reached[hop] = result
+        bit = 1 << nodes.intern(destination)
+        for node, result in reached.items():
+            if result:
+                masks[nodes.intern(node)] |= bit
+    masks.extend([0] * (len(nodes) - len(masks)))
+    for node_id in range(len(nodes)):
+        masks[node_id] |= 1 << node_id
+    # Nodes with no route table of their own can reach whatever routes back
+    # to them.
+    for node_id, node in enumerate(nodes.names):
+        if node not in routes:
+            bit = 1 << node_id
+            for other_id in range(len(nodes)):
+                if masks[other_id] & bit:
+                    masks[node_id] |= 1 << other_id
+    return masks
+
+
+@attr.s
+class ReachabilityIndex(object):
+    """
+    Build it with from_firewalls.  boundaries maps each protocol to the sorted
+    list of ports where the port classes change, and reach maps each protocol
+    to one list of per node bitsets for every port class.
+    """
+    nodes = attr.ib(default=attr.Factory(Interner))
+    boundaries = attr.ib(default=attr.Factory(dict))
+    reach = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def from_firewalls(cls, firewalls, routes=None):
+        index = cls()
+        nodes = index.nodes
+        rules = []
+        for node, node_rules in firewalls.items():
+            nodes.intern(node)
+            for rule in node_rules:
+                start, end = parse_ports(rule["port"])
+                for peer in rule["source"].split(","):
+                    rules.append((nodes.intern(node), nodes.intern(peer),
+                                  rule["type"], rule["protocol"], start, end))
+        if routes:
+            for node, entries in routes.items():
+                nodes.intern(node)
+                for entry in entries:
+                    nodes.intern(entry["destination"])
+                    nodes.intern(entry["target"])
+        everyone = (1 << len(nodes)) - 1
+        # Anything without a firewall lets everything through.
+        open_mask = 0
+        for node_id, node in enumerate(nodes.names):
+            if node not in firewalls:
+                open_mask |= 1 << node_id
+        masks = route_masks(routes, nodes) if routes else [everyone] * len(
+            nodes)
+
+        for protocol in set(rule[3] for rule in rules):
+            protocol_rules = [rule for rule in rules if rule[3] == protocol]
+            boundaries = sorted(set([rule[4] for rule in protocol_rules] +
+                                    [rule[5] + 1 for rule in protocol_rules]))
+            classes = len(boundaries) - 1
+            egress = [[0] * len(nodes) for _ in range(classes)]
+            accepts = [[0] * len(nodes) for _ in range(classes)]
+            for node_id, peer_id, rule_type, _, start, end in protocol_rules:
+                first = bisect_right(boundaries, start) - 1
+                last = bisect_right(boundaries, end) - 1
+                for port_class in range(first, last + 1):
+                    if rule_type == "egress":
+                        egress[port_class][node_id] |= 1 << peer_id
+                    else:
+                        accepts[port_class][peer_id] |= 1 << node_id
+            index.boundaries[protocol] = boundaries
+            index.reach[protocol] = [
+                    [((egress[c][a] | (everyone if open_mask >> a & 1 else 0))
+                      & (accepts[c][a] | open_mask)
+                      & masks[a])
+                     for a in range(len(nodes))]
+                    for c in range(classes)]
+        return index
+
+    def port_class(self, protocol, port):
+        """
+        Which class a port falls in, or None if no rule mentions it.
+        """
+        boundaries = self.boundaries.get(protocol)
+        if not boundaries:
+            return None
+        port_class = bisect_right(boundaries, int(port)) - 1
+        if port_class < 0 or port_class >= len(boundaries) - 1:
+            return None
+        return port_class
+
+    def matrix(self, protocol, port):
+        """
+        The all-pairs answer for one protocol and port, as one bitset per
+        node, indexed the same way as self.nodes.
+        """
+        port_class = self.port_class(protocol, port)
+        if port_class is None:
+            return [0] * len(self.nodes)
+        return self.reach[protocol][port_class]
+
+    def can_reach(self, source, target, protocol, port):
+        if source not in self.nodes.index or target not in self.nodes.index:
+            return False
+        row = self.matrix(protocol, port)[self.nodes.index[source]]
+        return bool(row >> self.nodes.index[target] & 1)
+
+    def reachable(self, source, protocol, port):
+        """
+        Every node the source can reach on the given protocol and port.
+        """
+        if source not in self.nodes.index:
+            return []
+        row = self.matrix(protocol, port)[self.nodes.index[source]]
+        return [node for node_id, node in enumerate(self.nodes.names)
+                if row >> node_id & 1]
+
+    def check(self, policy):
+        """
+        Checks a list of (source, target, protocol, port, allowed)
+        expectations, and returns the ones that don't hold.  An empty list
+        means the policy passes, which is the thing to assert on in CI.
+        """
+        return [expectation for expectation in policy
+                if self.can_reach(*expectation[:4]) != expectation[4]]
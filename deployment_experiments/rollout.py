@@ -0,0 +1,307 @@
+"""
+Rolling image updates, so a new VirtualMachine image goes out without taking
+the service down.
+
+    update = RollingUpdate(web, new_image, batch_size=2)
+    report = update.run()
+
+A rollout points the autoscaling group at a new launch configuration, then
+goes through the old instances a batch at a time:
+
+1. Surge: raise the group's desired capacity by the batch size, so the group
+   launches that many instances from the new launch configuration while all
+   the old ones keep serving.
+2. Wait until the load balancer (through LoadBalancer.instance_health) says
+   the new instances are in service.  If they don't make it in
+   health_timeout seconds the rollout stops there, with every old instance
+   that hasn't been replaced yet still serving.
+3. Drain the batch of old instances: take them out of the load balancer,
+   give requests in flight drain_seconds to finish, and terminate them,
+   which brings desired capacity back down.
+
+So capacity never drops below where it started, and the cost is batch_size
+extra instances while it runs.  Bigger batches finish sooner.
+
+roll_out runs the rollouts for lots of services at once, on a bounded pool of
+threads.  Every report has the two numbers that matter: how long the rollout
+took, and the least capacity the service was serving with along the way, as
+a fraction of what it had when it started.
+"""
+
+import threading
+import time
+import timeit
+import uuid
+
+import attr
+
+from . import clients
+from . import memory
+from .tracing import span, wrap
+
+
+class RolloutException(Exception):
+    pass
+
+
+@attr.s
+class RolloutReport(object):
+    service = attr.ib()
+    launch_configuration = attr.ib(default=None)
+    capacity = attr.ib(default=0)
+    seconds = attr.ib(default=0.0)
+    batches = attr.ib(default=0)
+    replaced = attr.ib(default=0)
+    # (seconds since the start, instances in service) at every health check
+    samples = attr.ib(default=attr.Factory(list))
+    error = attr.ib(default=None)
+
+    @property
+    def min_serving(self):
+        return min([serving for _, serving in self.samples] or
+                   [self.capacity])
+
+    @property
+    def served_capacity(self):
+        """
+        The least capacity the service had while it rolled, as a fraction of
+        what it started with.
+        """
+        if not self.capacity:
+            return 1.0
+        return float(self.min_serving) / self.capacity
+
+
+@attr.s
+class RollingUpdate(object):
+    """
+    Replaces every instance of service with instances of image.
+    """
+    service = attr.ib()
+    image = attr.ib()
+    batch_size = attr.ib(default=1)
+    health_timeout = attr.ib(default=600.0)
+    poll_interval = attr.ib(default=5.0)
+    drain_seconds = attr.ib(default=0.0)
+    clock = attr.ib(default=timeit.default_timer)
+    sleep = attr.ib(default=time.sleep)
+
+    @property
+    def provider(self):
+        return self.service.provider
+
+    def group(self):
+        groups = self.service.discover()["AutoScalingGroups"]
+        if not groups:
+            raise RolloutException("Service %s has no autoscaling group" %
+                                   self.service.name)
+        return groups[0]
+
+    def aws_create_launch_configuration(self, name):
+        attr.evolve(self.service, image=self.image).launch_configuration(name)
+
+    def aws_update_group(self, **kwargs):
+        autoscaling = clients.client("autoscaling")
+        autoscaling.update_auto_scaling_group(
+                AutoScalingGroupName=self.service.name, **kwargs)
+
+    def aws_terminate(self, instance_ids):
+        autoscaling = clients.client("autoscaling")
+        for instance_id in instance_ids:
+            autoscaling.terminate_instance_in_auto_scaling_group(
+                    InstanceId=instance_id,
+                    ShouldDecrementDesiredCapacity=True)
+
+    def aws_delete_launch_configuration(self, name):
+        autoscaling = clients.client("autoscaling")
+        autoscaling.delete_launch_configuration(LaunchConfigurationName=name)
+
+    def memory_create_launch_configuration(self, name):
+        service = attr.evolve(self.service, image=self.image)
+        memory.cloud.create_launch_configuration(
+                name, service.find_ami(), service.get_instance_type(),
+                self.image.build_cloud_init())
+
+    def memory_update_group(self, LaunchConfigurationName=None,
+                            DesiredCapacity=None, MaxSize=None):
+        memory.cloud.update_auto_scaling_group(
+                self.service.name,
+                launch_configuration=LaunchConfigurationName,
+                desired=DesiredCapacity, max_size=MaxSize)
+
+    def memory_terminate(self, instance_ids):
+        for instance_id in instance_ids:
+            memory.cloud.terminate_instance(instance_id)
+
+    def memory_delete_launch_configuration(self, name):
+        memory.cloud.delete_launch_configuration(name)
+
+    def call(self, step, *args, **kwargs):
+        if self.provider == "aws":
+            return getattr(self, "aws_%s" % step)(*args, **kwargs)
+        elif self.provider == "memory":
+            return getattr(self, "memory_%s" % step)(*args, **kwargs)
+        else:
+            raise NotImplemented
+
+    def serving(self, instance_ids):
+        health = self.service.load_balancer.instance_health()
+        return set(instance_id for instance_id in instance_ids
+                   if health.get(instance_id) == "InService")
+
+    def sample(self, report, started):
+        """
+        Records how many of the group's instances are in service right now,
+        and returns the instances and which ones those are.
+        """
+        instances = self.group()["Instances"]
+        serving = self.serving([instance["InstanceId"]
+                                for instance in instances])
+        report.samples.append((self.clock() - started, len(serving)))
+        return instances, serving
+
+    def wait_for_health(self, report, started, launch_configuration, count):
+        """
+        Waits until count instances from the new launch configuration are in
+        service.
+        """
+        deadline = self.clock() + self.health_timeout
+        while True:
+            instances, serving = self.sample(report, started)
+            new = [instance for instance in instances
+                   if instance["InstanceId"] in serving and
+                   instance.get("LaunchConfigurationName") ==
+                   launch_configuration]
+            if len(new) >= count:
+                return
+            if self.clock() >= deadline:
+                raise RolloutException(
+                    "Only %s of %s new instances of %s passed their health "
+                    "check after %s seconds" % (
+                        len(new), count, self.service.name,
+                        self.health_timeout))
+            self.sleep(self.poll_interval)
+
+    def drain(self, instance_ids):
+        self.service.load_balancer.deregister(instance_ids)
+        if self.drain_seconds:
+            self.sleep(self.drain_seconds)
+        self.call("terminate", instance_ids)
+
+    def rollback(self, report, old_configuration, launch_configuration,
+                 capacity, max_size):
+        """
+        Puts the group back how it was after a batch fails, so scaling out
+        later doesn't launch the image that just failed.  Instances from
+        batches that already finished passed their health checks and took
+        the place of old ones, so they stay, but whatever the failed batch
+        surged in goes, starting with the ones that aren't in service.
+        """
+        self.call("update_group", LaunchConfigurationName=old_configuration)
+        new = [instance["InstanceId"] for instance in self.group()["Instances"]
+               if instance.get("LaunchConfigurationName") ==
+               launch_configuration]
+        serving = self.serving(new)
+        new.sort(key=lambda instance_id: instance_id in serving)
+        surge = new[:len(new) - report.replaced]
+        if surge:
+            self.call("terminate", surge)
+        self.call("update_group", DesiredCapacity=capacity, MaxSize=max_size)
+        self.call("delete_launch_configuration", launch_configuration)
+
+    def run(self):
+        started = self.clock()
+        group = self.group()
+        old_configuration = group["LaunchConfigurationName"]
+        launch_configuration = "%s-%s" % (self.service.name,
+                                          uuid.uuid4().hex[:8])
+        capacity = group["DesiredCapacity"]
+        max_size = group["MaxSize"]
+        report = RolloutReport(service=self.service.name,
+                               launch_configuration=launch_configuration,
+                               capacity=capacity)
+        old = [instance["InstanceId"] for instance in group["Instances"]
+               if instance.get("LaunchConfigurationName") !=
+               launch_configuration]
+
+        with span("rollout", service=self.service.name):
+            with span("launch configuration create"):
+                self.call("create_launch_configuration",
+                          launch_configuration)
+                self.call("update_group",
+                          LaunchConfigurationName=launch_configuration,
+                          MaxSize=max(max_size,
+                                      capacity + self.batch_size))
+            try:
+                while old:
+                    batch, old = old[:self.batch_size], old[self.batch_size:]
+                    with span("batch", instances=len(batch)):
+                        self.call("update_group",
+                                  DesiredCapacity=capacity + len(batch))
+                        self.wait_for_health(
+                                report, started, launch_configuration,
+                                report.replaced + len(batch))
+                        self.drain(batch)
+                    report.batches += 1
+                    report.replaced += len(batch)
+                self.sample(report, started)
+            except RolloutException as e:
+                report.error = str(e)
+                with span("rollback"):
+                    self.rollback(report, old_configuration,
+                                  launch_configuration, capacity, max_size)
+                report.seconds = self.clock() - started
+                return report
+            with span("launch configuration delete"):
+                self.call("update_group", MaxSize=max_size)
+                self.call("delete_launch_configuration", old_configuration)
+        report.seconds = self.clock() - started
+        return report
+
+
+def roll_out(updates, max_concurrency=8):
+    """
+    Runs a bunch of RollingUpdates at once, at most max_concurrency at a
+    time, and returns their reports in the same order.  One service failing
+    its health checks doesn't stop the others.
+    """
+    updates = list(updates)
+    reports = [None] * len(updates)
+    pending = iter(range(len(updates)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(pending, None)
+            if index is None:
+                return
+            try:
+                reports[index] = updates[index].run()
+            except Exception as e:
+                reports[index] = RolloutReport(
+                        service=updates[index].service.name, error=str(e))
+
+    threads = [threading.Thread(target=wrap(worker))
+               for _ in range(min(max_concurrency, len(updates)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return reports
+
+
+def summarize(reports):
+    """
+    The numbers for the whole rollout: the slowest service, the worst
+    capacity any service got down to, and which ones didn't finish.
+    """
+    return {
+            "services": len(reports),
+            "seconds": max([report.seconds for report in reports] or [0.0]),
+            "served_capacity": min([report.served_capacity
+                                    for report in reports] or [1.0]),
+            "replaced": sum(report.replaced for report in reports),
+            "failed": sorted(report.service for report in reports
+                             if report.error)
+            }
@@ -3,68 +3,266 @@ Functions to convert from a network graph to a list of route tables, and
 potentially back if possible.
 """
 
-from itertools import tee
+from .compactgraph import CompactPaths
+from .subnet_generator import ip_network
+
+
+class RoutingLoopException(Exception):
+    pass
 
 
 def net_to_routes(net):
-    routes = {}
-
-    def pairwise(iterable):
-        "s -> (s0,s1), (s1,s2), (s2, s3), ..."
-        a, b = tee(iterable)
-        next(b, None)
-        return zip(a, b)
-
-    for path in net:
-        assert len(path) > 1
-        src = path[0]
-        dest = path[-1]
-        for first, second in pairwise(path):
-            if first not in routes:
-                routes[first] = []
-            if second not in routes:
-                routes[second] = []
-            routes[first].append({
-                "destination": dest,
-                "target": second
-                })
-            routes[second].append({
-                "destination": src,
-                "target": first
-                })
-        del routes["external"]
-    return routes
+    """
+    The actual compiling happens on the compact form of the paths, this just
+    converts in and out of the dict format.
+    """
+    return CompactPaths.from_paths(net).compile_routes().to_routes()
 
 
 def routes_to_net(routes):
     """
     TODO: I can't really tell the difference between to/from routes...
+
+    A path gets rebuilt from every node with a route table towards each
+    destination it has a route to, unless that route is only part of a
+    longer path:
+
+    - the node is also a hop on some other node's route to the destination,
+      so it's in the middle of a path that ends there.
+    - or the destination has a route table, but no route back to the node.
+      net_to_routes always puts in back routes, so a real path has them, and
+      the node only has a route because it's on the back path from somewhere
+      else.
+
+    Starting from destinations isn't enough, since a path's start is never
+    anyone's destination when the other end is "external", which has no
+    route table to route back from.
+
+    Since net_to_routes puts in back routes, each path would come back
+    twice, once in each direction, so only the first direction seen is kept.
+
+    Routes get indexed by (node, destination) once, and the path from each
+    node to each destination is only ever walked once, so this is linear in
+    the number of route entries (plus the size of the output, if there are
+    several next hops for the same destination and so several paths).  A path
+    stops early if it reaches a node with no route for the destination, like
+    "external", which has no route table at all.
     """
-    net = []
-    # XXX: I don't know if this is the right thing...  It only tells us the
-    # ultimate targets.  Although I think that might be what we want.  Does
-    # this work with multiple routes?
-    endpoints = set()
-    for _, route in routes.iteritems():
+    next_hops = {}
+    destinations = {}
+    for node, route in routes.items():
         for rule in route:
-            endpoints.add(rule["destination"])
-        endpoints.remove("external")
-    for endpoint in endpoints:
-        def build_path(start, end, routes):
-            if start not in routes:
-                return [start]
-            else:
-                for rule in routes[start]:
-                    if rule["destination"] == end:
-                        return [start] + build_path(rule["target"],
-                                                    end, routes)
-                return [start]
-        # TODO: This external is hard coded.  I should do something better to
-        # find all paths that are contained in these route tables.  Can I do
-        # that?  Is it possible?  Yeah, it should be, but yeah I have the
-        # duplicate routes problem (back routes, specifically).  I think I
-        # might need to know which things aren't in the route table because
-        # they're external versus which things are not there because they're
-        # actually missing.
-        net.append(build_path(endpoint, "external", routes))
+            destination = rule["destination"]
+            if (node, destination) not in next_hops:
+                next_hops[(node, destination)] = []
+                destinations.setdefault(node, []).append(destination)
+            # net_to_routes repeats the same entry for every path through a
+            # hop, and those aren't different paths.
+            if rule["target"] not in next_hops[(node, destination)]:
+                next_hops[(node, destination)].append(rule["target"])
+
+    # (hop, destination) for every node that's a hop on some other node's way
+    # to destination.  A hop's own route to the destination is just part of
+    # that longer path.
+    transit = set()
+    for node, route in routes.items():
+        for rule in route:
+            if rule["target"] != rule["destination"]:
+                transit.add((rule["target"], rule["destination"]))
+
+    suffixes = {}
+
+    def build_paths(start, end):
+        """
+        All paths from start to end, walked iteratively with an explicit stack
+        so long paths don't hit the recursion limit.  A node showing up twice
+        on the stack is a routing loop.
+        """
+        stack = [start]
+        on_stack = set([start])
+        while stack:
+            node = stack[-1]
+            if (node, end) in suffixes:
+                stack.pop()
+                on_stack.discard(node)
+                continue
+            if node == end or (node, end) not in next_hops:
+                suffixes[(node, end)] = [(node,)]
+                continue
+            pending = [target for target in next_hops[(node, end)]
+                       if (target, end) not in suffixes]
+            if pending:
+                if pending[0] in on_stack:
+                    raise RoutingLoopException(
+                        "Routes towards %s loop back through %s: %s" %
+                        (end, pending[0],
+                         " -> ".join(stack[stack.index(pending[0]):] +
+                                     [pending[0]])))
+                stack.append(pending[0])
+                on_stack.add(pending[0])
+                continue
+            suffixes[(node, end)] = [(node,) + suffix
+                                     for target in next_hops[(node, end)]
+                                     for suffix in suffixes[(target, end)]]
+        return suffixes[(start, end)]
+
+    net = []
+    seen = set()
+    for start, ends in destinations.items():
+        for end in ends:
+            if start == end:
+                continue
+            # Walked even when it isn't a path of its own, so loops still
+            # get caught
+            paths = build_paths(start, end)
+            if (start, end) in transit:
+                continue
+            if end in routes and (end, start) not in next_hops:
+                continue
+            for path in paths:
+                if path in seen or tuple(reversed(path)) in seen:
+                    continue
+                seen.add(path)
+                net.append(list(path))
     return net
+
+
+def route_count(routes):
+    return sum(len(route) for route in routes.values())
+
+
+def compress_table(table):
+    """
+    Takes one node's table as {network: targets} and returns the smallest
+    table I know how to find that forwards every address the same way under
+    longest prefix match.
+
+    - Two sibling prefixes with the same targets merge into their parent,
+      unless the parent is already in the table with different targets.
+    - A prefix whose closest covering prefix has the same targets is
+      redundant, since the covering one already sends traffic to the same
+      place.
+    """
+    table = dict(table)
+    for prefixlen in range(max([0] + [network.prefixlen
+                                      for network in table]), 0, -1):
+        for network in [network for network in table
+                        if network.prefixlen == prefixlen]:
+            if network not in table:
+                continue
+            parent = network.supernet()
+            halves = list(parent.subnets())
+            sibling = halves[1] if halves[0] == network else halves[0]
+            if table.get(sibling) != table[network]:
+                continue
+            if parent in table and table[parent] != table[network]:
+                continue
+            table[parent] = table.pop(network)
+            del table[sibling]
+    compressed = {}
+    for network in sorted(table, key=lambda network: network.prefixlen):
+        covered = False
+        for prefixlen in range(network.prefixlen - 1, -1, -1):
+            supernet = network.supernet(new_prefix=prefixlen)
+            if supernet in compressed:
+                covered = compressed[supernet] == table[network]
+                break
+        if not covered:
+            compressed[network] = table[network]
+    return compressed
+
+
+def compress_routes(routes, cidrs):
+    """
+    Maps the node destinations from net_to_routes onto CIDR blocks, and then
+    squashes every table with compress_table.  cidrs maps each node to the
+    CIDR blocks for its subnets, and "external" means everything unless it's
+    given explicitly.
+
+    Returns the compressed routes along with a report of the table sizes
+    before and after, since AWS route tables have a hard limit.
+    """
+    cidrs = dict(cidrs)
+    cidrs.setdefault("external", ["0.0.0.0/0"])
+    compressed = {}
+    for node, route in routes.items():
+        table = {}
+        for rule in route:
+            if rule["destination"] not in cidrs:
+                raise KeyError("Node %s has a route to %s, but there are no "
+                               "CIDR blocks for %s" % (node,
+                                                       rule["destination"],
+                                                       rule["destination"]))
+            for cidr in cidrs[rule["destination"]]:
+                network = ip_network(cidr)
+                table[network] = table.get(network, frozenset()) | \
+                    frozenset([rule["target"]])
+        compressed[node] = [{
+            "destination": str(network),
+            "target": target
+            } for network, targets in sorted(compress_table(table).items())
+            for target in sorted(targets)]
+    report = {
+            "before": route_count(routes),
+            "after": route_count(compressed)
+            }
+    return compressed, report
+
+
+def zonal_routes(routes, zones):
+    """
+    Splits every node's route table up by availability zone, so traffic can
+    stay in the zone it started in.  Cross zone hops are slower and cost money
+    on every request.
+
+    zones maps each node to {availability zone: [cidrs]}, like
+    Network.placement returns.  Nodes that aren't in it (like "external", or
+    anything regional) aren't zonal.
+
+    Returns {node: {zone: [routes]}}, with a None zone for nodes that aren't
+    zonal.  Every route has the zone of the target it goes to, and for each
+    destination exactly one route is marked "preferred", and comes first: a
+    target in the same zone if any of them are there, and otherwise the first
+    target in the first zone it is in.  The rest are fallbacks to switch to
+    when that zone goes away.
+    """
+    zonal = {}
+    for node, route in routes.items():
+        zonal[node] = {}
+        for zone in sorted(zones.get(node, {})) or [None]:
+            options = {}
+            destinations = []
+            seen = set()
+            for rule in route:
+                if (rule["destination"], rule["target"]) in seen:
+                    continue
+                seen.add((rule["destination"], rule["target"]))
+                if rule["destination"] not in options:
+                    options[rule["destination"]] = []
+                    destinations.append(rule["destination"])
+                target_zones = sorted(zones.get(rule["target"], {}),
+                                      key=lambda target_zone:
+                                      (target_zone != zone, target_zone))
+                for target_zone in target_zones or [None]:
+                    options[rule["destination"]].append({
+                        "destination": rule["destination"],
+                        "target": rule["target"],
+                        "zone": target_zone,
+                        "preferred": False
+                        })
+            # Only one route per destination is preferred, even when there
+            # are several targets for it
+            entries = zonal[node][zone] = []
+            for destination in destinations:
+                candidates = options[destination]
+                preferred = next((entry for entry in candidates
+                                  if entry["zone"] == zone), candidates[0])
+                preferred["preferred"] = True
+                entries.append(preferred)
+                entries.extend(entry for entry in candidates
+                               if entry is not preferred)
+    return zonal
+
+
+def net_to_zonal_routes(net, zones):
+    return zonal_routes(net_to_routes(net), zones)
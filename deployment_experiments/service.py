@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
 import attr
-import boto3
 
-from subnet_generator import generate_subnets
-from instance_fitter import InstanceFitter
+from . import clients
+from . import memory
+from .subnet_generator import generate_subnets
+from .instance_fitter import InstanceFitter
 
-from network import Network
+from .firewall_compiler import FirewallCompiler
+from .network import Network
+from .tracing import span, traced
 
 import uuid
 
@@ -17,18 +20,23 @@ class ServiceDns(object):
     provider = attr.ib(default="aws")
 
     def create_zone(self):
-        route53 = boto3.client("route53")
+        route53 = clients.client("route53")
         # https://stackoverflow.com/questions/34644483/why-do-i-have-to-change-the-callerreference-on-every-call
         caller_reference = str(uuid.uuid4())
-        zone_name = ".".join(self.dns.split(".")[1:])
-        return route53.create_hosted_zone(Name=zone_name, CallerReference=caller_reference)
+        return route53.create_hosted_zone(Name=self.zone_name(), CallerReference=caller_reference)
 
-    def provision(self):
-        route53 = boto3.client("route53")
-        zone = self.create_zone()
+    def zone_name(self):
+        return ".".join(self.dns.split(".")[1:])
+
+    def create_record(self, zone_id, action="CREATE"):
+        """
+        Points the name at the target in an existing zone.  UPSERT instead of
+        CREATE repoints a record that's already there, and DELETE removes it.
+        """
+        route53 = clients.client("route53")
         change_batch = [
                 {
-                    "Action": "CREATE",
+                    "Action": action,
                     "ResourceRecordSet": {
                         "Name": self.dns,
                         "Type": "CNAME",
@@ -39,33 +47,38 @@ class ServiceDns(object):
                     }
                 }
             ]
-        route53.change_resource_record_sets(HostedZoneId=zone["HostedZone"]["Id"],
+        route53.change_resource_record_sets(HostedZoneId=zone_id,
                                             ChangeBatch={
                                                 "Comment": "Creating basic service DNS",
                                                 "Changes": change_batch
                                                 })
 
-    def discover(self):
-        route53 = boto3.client("route53")
-        zone_name = ".".join(self.dns.split(".")[1:])
-        hosted_zones = route53.list_hosted_zones_by_name(DNSName="%s." % zone_name)
+    def aws_provision(self):
+        zone = self.create_zone()
+        self.create_record(zone["HostedZone"]["Id"])
+
+    def aws_discover(self):
+        route53 = clients.client("route53")
+        hosted_zones = route53.list_hosted_zones_by_name(DNSName="%s." % self.zone_name())
         hosted_zone_ids = [zone["Id"] for zone in hosted_zones["HostedZones"]]
         return hosted_zone_ids
 
-    def destroy(self):
+    def aws_destroy(self):
         zone_ids = self.discover()
-        route53 = boto3.client("route53")
+        route53 = clients.client("route53")
         for zone_id in zone_ids:
             rr_sets = route53.list_resource_record_sets(HostedZoneId=zone_id)["ResourceRecordSets"]
-            for rr_set in rr_sets:
-                if rr_set["Type"] in ["NS", "SOA"]:
-                    continue
-                change_batch = [
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": rr_set
-                        }
-                    ]
+            # One change batch per zone, rather than one call per record, since
+            # Route53 only gives us five calls a second.
+            change_batch = [
+                    {
+                        "Action": "DELETE",
+                        "ResourceRecordSet": rr_set
+                    }
+                    for rr_set in rr_sets
+                    if rr_set["Type"] not in ["NS", "SOA"]
+                ]
+            if change_batch:
                 route53.change_resource_record_sets(HostedZoneId=zone_id,
                                                     ChangeBatch={
                                                       "Comment": "Deleting basic service DNS",
@@ -73,6 +86,41 @@ class ServiceDns(object):
                                                       })
             route53.delete_hosted_zone(Id=zone_id)
 
+    def memory_provision(self):
+        zone_id = memory.cloud.create_hosted_zone(self.zone_name())
+        memory.cloud.change_record(zone_id, "CREATE", self.dns, self.target)
+
+    def memory_discover(self):
+        return memory.cloud.list_hosted_zones_by_name(self.zone_name())
+
+    def memory_destroy(self):
+        for zone_id in self.discover():
+            memory.cloud.delete_hosted_zone(zone_id)
+
+    def provision(self):
+        if self.provider == "aws":
+            self.aws_provision()
+        elif self.provider == "memory":
+            self.memory_provision()
+        else:
+            raise NotImplemented
+
+    def discover(self):
+        if self.provider == "aws":
+            return self.aws_discover()
+        elif self.provider == "memory":
+            return self.memory_discover()
+        else:
+            raise NotImplemented
+
+    def destroy(self):
+        if self.provider == "aws":
+            self.aws_destroy()
+        elif self.provider == "memory":
+            self.memory_destroy()
+        else:
+            raise NotImplemented
+
 @attr.s
 class LoadBalancer(object):
     """
@@ -94,9 +142,11 @@ class LoadBalancer(object):
     dns = attr.ib()
     provider = attr.ib(default="aws")
 
-    def aws_provision(self):
-        elb = boto3.client("elb")
-        ec2 = boto3.client("ec2")
+    def create_load_balancer(self, subnet_ids):
+        """
+        Just the ELB, in subnets that already exist.  Returns its DNS name.
+        """
+        elb = clients.client("elb")
         listeners = [
                 {
                     'Protocol': 'http',
@@ -105,29 +155,106 @@ class LoadBalancer(object):
                     'InstancePort': 80
                     }
                 ]
+        # The DNS name goes in a tag, since it's the only way to find the
+        # record again once the load balancer isn't wanted anymore.
+        kwargs = {}
+        if self.dns:
+            kwargs["Tags"] = [{'Key': "cloud-deployer-dns",
+                               'Value': self.dns}]
+        return elb.create_load_balancer(LoadBalancerName=self.name,
+                                        Listeners=listeners,
+                                        Subnets=subnet_ids,
+                                        **kwargs)["DNSName"]
+
+    @traced("LoadBalancer.aws_provision")
+    def aws_provision(self):
         net = Network()
-        subnet_ids = net.provision(network_name=self.name)
-        load_balancer = elb.create_load_balancer(LoadBalancerName=self.name,
-                                                 Listeners=listeners,
-                                                 Subnets=subnet_ids)
-        dns = ServiceDns(self.dns, load_balancer["DNSName"])
-        dns.provision()
+        with span("network carve", network=self.name):
+            subnet_ids = net.provision(network_name=self.name)
+        with span("elb create", load_balancer=self.name):
+            dns_name = self.create_load_balancer(subnet_ids)
+        with span("dns zone create", dns=self.dns):
+            dns = ServiceDns(self.dns, dns_name)
+            dns.provision()
 
     def aws_discover(self):
         # TODO: I think this throws an exception, but figure out proper error
         # handling.
-        elb = boto3.client("elb")
+        elb = clients.client("elb")
         return elb.describe_load_balancers(LoadBalancerNames=[self.name])
 
+    def memory_provision(self):
+        net = Network(provider="memory")
+        subnet_ids = net.provision(network_name=self.name)
+        dns_name = memory.cloud.create_load_balancer(self.name, subnet_ids)
+        dns = ServiceDns(self.dns, dns_name, provider="memory")
+        dns.provision()
+
+    def memory_discover(self):
+        """
+        Shaped like describe_load_balancers, since that's what callers (like
+        Service.auto_scaling_group) read.
+        """
+        return {"LoadBalancerDescriptions": [
+            {"LoadBalancerName": load_balancer["name"],
+             "DNSName": load_balancer["dns_name"],
+             "Subnets": list(load_balancer["subnets"]),
+             "Instances": [{"InstanceId": instance_id} for instance_id
+                           in sorted(load_balancer["instances"])]}
+            for load_balancer
+            in memory.cloud.describe_load_balancers([self.name])]}
+
     def provision(self):
         if self.provider == "aws":
             self.aws_provision()
+        elif self.provider == "memory":
+            self.memory_provision()
         else:
             raise NotImplemented
 
     def discover(self):
         if self.provider == "aws":
             return self.aws_discover()
+        elif self.provider == "memory":
+            return self.memory_discover()
+        else:
+            raise NotImplemented
+
+    def aws_instance_health(self):
+        elb = clients.client("elb")
+        instance_states = elb.describe_instance_health(
+                LoadBalancerName=self.name)["InstanceStates"]
+        return dict((state["InstanceId"], state["State"])
+                    for state in instance_states)
+
+    def instance_health(self):
+        """
+        {instance id: "InService" or "OutOfService"} for every instance
+        registered with this load balancer.
+        """
+        if self.provider == "aws":
+            return self.aws_instance_health()
+        elif self.provider == "memory":
+            return memory.cloud.instance_health(self.name)
+        else:
+            raise NotImplemented
+
+    def aws_deregister(self, instance_ids):
+        elb = clients.client("elb")
+        elb.deregister_instances_from_load_balancer(
+                LoadBalancerName=self.name,
+                Instances=[{"InstanceId": instance_id}
+                           for instance_id in instance_ids])
+
+    def deregister(self, instance_ids):
+        """
+        Stops sending new requests to the given instances.  With connection
+        draining on, the ones in flight still get to finish.
+        """
+        if self.provider == "aws":
+            self.aws_deregister(instance_ids)
+        elif self.provider == "memory":
+            memory.cloud.deregister_instances(self.name, instance_ids)
         else:
             raise NotImplemented
 
@@ -135,89 +262,241 @@ class LoadBalancer(object):
         # TODO: This is how I'll set up routing/firewall rules
         pass
 
-    def destroy(self):
-        elb = boto3.client("elb")
+    def delete_load_balancer(self):
+        elb = clients.client("elb")
         elb.delete_load_balancer(LoadBalancerName=self.name)
+
+    def aws_destroy(self):
+        self.delete_load_balancer()
         dns = ServiceDns(self.dns, "dummy")
         dns.destroy()
         net = Network()
         net.destroy(network_name=self.name)
 
+    def memory_destroy(self):
+        memory.cloud.delete_load_balancer(self.name)
+        dns = ServiceDns(self.dns, "dummy", provider="memory")
+        dns.destroy()
+        net = Network(provider="memory")
+        net.destroy(network_name=self.name)
+
+    def destroy(self):
+        if self.provider == "aws":
+            self.aws_destroy()
+        elif self.provider == "memory":
+            self.memory_destroy()
+        else:
+            raise NotImplemented
+
 @attr.s
 class Service(object):
     """
     A service object.
 
     Creates the actual service instances.  Does not do anything with networking or anything like that.
+
+    Without a capacity (a capacity.CapacityModel), it's three of the cheapest
+    instance there is.  With one, the group gets sized for the load and
+    scales with it.
+
+    Instances launch into the security group FirewallCompiler keeps for the
+    service's network, which is in deployment_name.
     """
     name = attr.ib()
     image = attr.ib()
     load_balancer = attr.ib()
     provider = attr.ib(default="aws")
+    capacity = attr.ib(default=None)
+    deployment_name = attr.ib(default="default")
 
     def find_ami(self):
         return self.image.get()
 
     def get_instance_type(self):
-        # TODO: Actually allow for passing in these values to find the cheapest
-        # fitting instance.
+        if self.capacity is not None:
+            return self.capacity.instance_type()
         instance_fitter = InstanceFitter()
         return instance_fitter.get_fitting_instance(memory=None, cpus=None, storage=None)
 
+    def capacity_plan(self, zones):
+        """
+        The CapacityPlan for a group spread over the given number of zones,
+        or None for the fixed three instances.
+        """
+        if self.capacity is None:
+            return None
+        return self.capacity.plan(zones)
+
+    def security_groups(self):
+        """
+        The ids of the security group for this service's network, created
+        now if the firewalls haven't been applied yet, so the instances are
+        in it and get its rules whenever they are.  Empty if the network
+        isn't there.
+        """
+        compiler = FirewallCompiler(deployment_name=self.deployment_name)
+        network_subnets = compiler.aws_network_subnets()
+        if self.name not in network_subnets:
+            return []
+        groups = compiler.aws_security_groups([self.name], network_subnets)
+        return [groups[self.name]["GroupId"]]
+
     def launch_configuration(self, name):
-        autoscaling = boto3.client("autoscaling")
+        autoscaling = clients.client("autoscaling")
         user_data = self.image.build_cloud_init()
+        # Ids, not names, since these are VPC groups.  See
+        # https://github.com/hashicorp/terraform/issues/3600
         return autoscaling.create_launch_configuration(
                 LaunchConfigurationName=name,
                 ImageId=self.find_ami(),
-                # See https://github.com/hashicorp/terraform/issues/3600
-                #SecurityGroups=self.private_security_groups(),
+                SecurityGroups=self.security_groups(),
                 UserData=user_data,
                 InstanceType=self.get_instance_type())
 
     def auto_scaling_group(self, name, subnets):
-        autoscaling = boto3.client("autoscaling")
+        autoscaling = clients.client("autoscaling")
         comma_separated_subnets = ",".join(subnets)
-        launch_configuration = self.launch_configuration(name)
-        load_balancers = self.load_balancer.discover()
-        load_balancer_names = [load_balancer["LoadBalancerName"]
-                               for load_balancer in load_balancers["LoadBalancerDescriptions"]]
-        return autoscaling.create_auto_scaling_group(
+        with span("launch configuration create"):
+            launch_configuration = self.launch_configuration(name)
+        # A service doesn't have to be behind a load balancer, but then
+        # there's no ELB health check to go by.
+        load_balancer_names = []
+        if self.load_balancer is not None:
+            with span("load balancer discover"):
+                load_balancers = self.load_balancer.discover()
+            load_balancer_names = [load_balancer["LoadBalancerName"]
+                                   for load_balancer in load_balancers["LoadBalancerDescriptions"]]
+        plan = self.capacity_plan(len(subnets))
+        group = autoscaling.create_auto_scaling_group(
                 AutoScalingGroupName=name,
                 LaunchConfigurationName=name,
-                MinSize=3,
-                MaxSize=3,
-                DesiredCapacity=3,
+                MinSize=plan.min_size if plan else 3,
+                MaxSize=plan.max_size if plan else 3,
+                DesiredCapacity=plan.desired_capacity if plan else 3,
                 VPCZoneIdentifier=comma_separated_subnets,
                 LoadBalancerNames=load_balancer_names,
-                HealthCheckType='ELB',
-                HealthCheckGracePeriod=120)
+                HealthCheckType='ELB' if load_balancer_names else 'EC2',
+                HealthCheckGracePeriod=120,
+                Tags=[{"Key": "deploy-name",
+                       "Value": self.name,
+                       "PropagateAtLaunch": True}])
+        if plan:
+            with span("scaling policy create"):
+                autoscaling.put_scaling_policy(
+                        AutoScalingGroupName=name,
+                        PolicyName="%s-target-tracking" % name,
+                        PolicyType="TargetTrackingScaling",
+                        EstimatedInstanceWarmup=120,
+                        TargetTrackingConfiguration=plan.scaling_policy())
+        return group
 
+    @traced("Service.aws_provision")
     def aws_provision(self, colocated_service):
-        net = Network()
-        subnet_ids = net.provision(colocated_network=colocated_service, network_name=self.name)
-        self.auto_scaling_group(self.name, subnet_ids)
+        net = Network(deployment_name=self.deployment_name)
+        with span("network carve", network=self.name):
+            subnet_ids = net.provision(colocated_network=colocated_service, network_name=self.name)
+        with span("asg create", service=self.name):
+            self.auto_scaling_group(self.name, subnet_ids)
 
     def aws_discover(self):
-        autoscaling = boto3.client("autoscaling")
+        autoscaling = clients.client("autoscaling")
         name_filter = {'Name': "tag:deploy-name", 'Values': [self.name]}
         return autoscaling.describe_auto_scaling_groups(Filters=[name_filter])
 
+    def memory_provision(self, colocated_service):
+        net = Network(provider="memory")
+        subnet_ids = net.provision(colocated_network=colocated_service, network_name=self.name)
+        memory.cloud.create_launch_configuration(
+                self.name, self.find_ami(), self.get_instance_type(),
+                self.image.build_cloud_init())
+        load_balancers = self.load_balancer.discover()
+        load_balancer_names = [load_balancer["LoadBalancerName"]
+                               for load_balancer in load_balancers["LoadBalancerDescriptions"]]
+        plan = self.capacity_plan(len(subnet_ids))
+        memory.cloud.create_auto_scaling_group(
+                self.name, self.name,
+                plan.desired_capacity if plan else 3, subnet_ids,
+                load_balancer_names, {"deploy-name": self.name},
+                min_size=plan.min_size if plan else 3,
+                max_size=plan.max_size if plan else 3)
+        if plan:
+            memory.cloud.put_scaling_policy(self.name,
+                                            "%s-target-tracking" % self.name,
+                                            plan.scaling_policy())
+
+    def memory_discover(self):
+        """
+        Shaped like describe_auto_scaling_groups.
+        """
+        cloud = memory.cloud
+        return {"AutoScalingGroups": [
+            {"AutoScalingGroupName": group["name"],
+             "LaunchConfigurationName": group["launch_configuration"],
+             "MinSize": group["min"],
+             "MaxSize": group["max"],
+             "DesiredCapacity": group["desired"],
+             "VPCZoneIdentifier": ",".join(group["subnets"]),
+             "LoadBalancerNames": list(group["load_balancers"]),
+             "Instances": [
+                 {"InstanceId": instance_id,
+                  "AvailabilityZone": cloud.instances[instance_id]["zone"],
+                  "HealthStatus": cloud.instances[instance_id]["health"],
+                  "LaunchConfigurationName":
+                  cloud.instances[instance_id]["launch_configuration"]}
+                 for instance_id in group["instances"]]}
+            for group in cloud.describe_auto_scaling_groups(
+                tags={"deploy-name": self.name})]}
+
     def provision(self, colocated_service=None):
         if self.provider == "aws":
             self.aws_provision(colocated_service)
+        elif self.provider == "memory":
+            self.memory_provision(colocated_service)
         else:
             raise NotImplemented
 
     def discover(self):
         if self.provider == "aws":
             return self.aws_discover()
+        elif self.provider == "memory":
+            return self.memory_discover()
         else:
             raise NotImplemented
 
-    def destroy(self):
-        autoscaling = boto3.client("autoscaling")
+    def delete_auto_scaling_group(self, launch_configuration=None):
+        """
+        After a rollout, the group's launch configuration isn't named after
+        the service anymore, so if I'm not told which one it is I ask.
+        """
+        autoscaling = clients.client("autoscaling")
+        if launch_configuration is None:
+            groups = autoscaling.describe_auto_scaling_groups(
+                    AutoScalingGroupNames=[self.name])["AutoScalingGroups"]
+            launch_configuration = (groups[0]["LaunchConfigurationName"]
+                                    if groups else self.name)
         autoscaling.delete_auto_scaling_group(AutoScalingGroupName=self.name)
-        autoscaling.delete_launch_configuration(LaunchConfigurationName=self.name)
-        net = Network()
+        autoscaling.delete_launch_configuration(LaunchConfigurationName=launch_configuration)
+
+    def aws_destroy(self):
+        self.delete_auto_scaling_group()
+        net = Network(deployment_name=self.deployment_name)
+        net.destroy(network_name=self.name)
+
+    def memory_destroy(self):
+        # A group that's already gone (a half finished provision, or a
+        # second destroy) just leaves the network to clean up
+        group = memory.cloud.auto_scaling_groups.get(self.name)
+        if group is not None:
+            memory.cloud.delete_auto_scaling_group(self.name)
+            memory.cloud.delete_launch_configuration(
+                    group["launch_configuration"])
+        net = Network(provider="memory")
         net.destroy(network_name=self.name)
+
+    def destroy(self):
+        if self.provider == "aws":
+            self.aws_destroy()
+        elif self.provider == "memory":
+            self.memory_destroy()
+        else:
+            raise NotImplemented
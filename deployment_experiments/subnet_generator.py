@@ -7,14 +7,180 @@ given prefix, but skips subnets that overlap the existing CIDR blocks.
 """
 
 import ipaddress
+from bisect import bisect_left
+
+import attr
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class NotEnoughIPSpaceException(Exception):
+    pass
+
+
+def ip_network(cidr):
+    """
+    ipaddress.ip_network, except that it also takes plain strings, which is
+    what boto hands back on python 2.
+    """
+    return ipaddress.ip_network(text_type(cidr))
+
 
 def generate_subnets(parent_cidr, existing_cidrs, prefix):
-    parent_network = ipaddress.ip_network(unicode(parent_cidr))
-    candidate_subnets = parent_network.subnets(new_prefix=prefix)
-    for candidate_subnet in candidate_subnets:
-        overlap = False
-        for existing_cidr in existing_cidrs:
-            if ipaddress.ip_network(unicode(existing_cidr)).overlaps(candidate_subnet):
-                overlap = True
-        if not overlap:
-            yield candidate_subnet
+    """
+    Every subnet of the parent with the given prefix that doesn't overlap an
+    existing block, in address order.  Checking every candidate against every
+    existing block is quadratic, so the existing blocks get sorted and merged
+    once, and a SubnetAllocator finds each gap.
+    """
+    parent_network = ip_network(parent_cidr)
+    if prefix < parent_network.prefixlen:
+        raise ValueError("new prefix must be longer")
+    first = int(parent_network.network_address)
+    last = int(parent_network.broadcast_address)
+    blocks = []
+    for existing_cidr in existing_cidrs:
+        network = ip_network(existing_cidr)
+        start = max(first, int(network.network_address))
+        end = min(last, int(network.broadcast_address))
+        if start <= end:
+            blocks.append((start, end))
+    starts = []
+    ends = []
+    for start, end in sorted(blocks):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    allocator = SubnetAllocator(parent_network, starts=starts, ends=ends)
+    while True:
+        try:
+            yield ip_network(allocator.allocate(prefix))
+        except NotEnoughIPSpaceException:
+            return
+
+
+def collapse_cidrs(cidrs):
+    """
+    Collapses a list of CIDR blocks into the fewest blocks that cover exactly
+    the same addresses, so adjacent subnets come back as their supernet.
+    """
+    networks = [ip_network(cidr) for cidr in cidrs]
+    return [str(network) for network in ipaddress.collapse_addresses(networks)]
+
+
+@attr.s
+class SubnetAllocator(object):
+    """
+    Hands out the same subnets generate_subnets would, first fit in address
+    order, but without rechecking every existing block for every candidate.
+
+    Allocated blocks are kept as sorted parallel lists of start and end
+    addresses, so finding the first gap that fits is a bisect plus a short
+    walk.  hints remembers, per prefix, the lowest address that could still
+    be free, so allocating over and over from a filling range doesn't keep
+    walking past the same blocks.  Releasing a block moves the hints back.
+    """
+    parent = attr.ib(converter=ip_network)
+    starts = attr.ib(default=attr.Factory(list))
+    ends = attr.ib(default=attr.Factory(list))
+    hints = attr.ib(default=attr.Factory(dict))
+
+    @property
+    def first(self):
+        return int(self.parent.network_address)
+
+    @property
+    def last(self):
+        return int(self.parent.broadcast_address)
+
+    def claim(self, cidr):
+        """
+        Marks a block as taken.  Blocks that only partly overlap the parent
+        get clipped to it, and ones entirely outside it are ignored.
+        """
+        network = ip_network(cidr)
+        start = max(self.first, int(network.network_address))
+        end = min(self.last, int(network.broadcast_address))
+        if start > end:
+            return
+        index = bisect_left(self.ends, start)
+        if index < len(self.starts) and self.starts[index] <= end:
+            raise ValueError("%s overlaps a block that's already allocated "
+                             "in %s" % (cidr, self.parent))
+        self.starts.insert(index, start)
+        self.ends.insert(index, end)
+
+    def release(self, cidr):
+        network = ip_network(cidr)
+        start = max(self.first, int(network.network_address))
+        index = bisect_left(self.starts, start)
+        if index == len(self.starts) or self.starts[index] != start:
+            raise ValueError("%s isn't allocated in %s" % (cidr, self.parent))
+        del self.starts[index]
+        del self.ends[index]
+        # The freed space can be part of a bigger block that's now free, so
+        # each hint goes back to the start of the block containing it.
+        for prefix in self.hints:
+            size = 1 << (self.parent.max_prefixlen - prefix)
+            self.hints[prefix] = min(self.hints[prefix], start // size * size)
+
+    def find(self, prefix):
+        """
+        The first free block with the given prefix, as (start, insert index),
+        or None if there isn't one.
+        """
+        size = 1 << (self.parent.max_prefixlen - prefix)
+        candidate = max(self.first, self.hints.get(prefix, self.first))
+        candidate = -(-candidate // size) * size
+        index = bisect_left(self.ends, candidate)
+        while (index < len(self.starts) and
+               self.starts[index] <= candidate + size - 1):
+            if self.ends[index] >= candidate:
+                candidate = -(-(self.ends[index] + 1) // size) * size
+            index += 1
+        if candidate + size - 1 > self.last:
+            return None
+        return candidate, index
+
+    def allocate(self, prefix):
+        """
+        Claims the first free block with the given prefix and returns it as a
+        CIDR string.
+        """
+        found = self.find(prefix)
+        if found is None:
+            raise NotEnoughIPSpaceException("No room for a /%s in %s" %
+                                            (prefix, self.parent))
+        start, index = found
+        size = 1 << (self.parent.max_prefixlen - prefix)
+        self.starts.insert(index, start)
+        self.ends.insert(index, start + size - 1)
+        self.hints[prefix] = start + size
+        return str(ipaddress.ip_network((start, prefix)))
+
+    def free_blocks(self):
+        """
+        Everything that's free, as the fewest aligned blocks that cover it,
+        in address order.  Each one is (start, prefix), and is the biggest
+        subnet that could be allocated at that spot.
+        """
+        bits = self.parent.max_prefixlen
+        blocks = []
+        position = self.first
+        for start, end in zip(self.starts + [self.last + 1],
+                              self.ends + [self.last]):
+            while position < start:
+                # The biggest block that's aligned where it starts and
+                # still ends before the next allocated one
+                size = position & -position or 1 << bits
+                while size > start - position:
+                    size >>= 1
+                blocks.append((position, bits - size.bit_length() + 1))
+                position += size
+            position = max(position, end + 1)
+        return blocks
@@ -0,0 +1,294 @@
+"""
+Nested timing spans, for seeing where the time goes in a slow deploy.
+
+The provisioning code wraps each phase in a span:
+
+    with span("elb create"):
+        ...
+
+which costs nothing unless a Tracer is active.  Turn one on around whatever
+you want to look at, and then save it for a flame chart:
+
+    with Tracer() as tracer:
+        LoadBalancer("web-lb", "web.example.com").provision()
+    tracer.save("deploy.json")               # chrome://tracing or Perfetto
+    tracer.save("deploy.speedscope.json", format="speedscope")
+
+Spans nest per thread.  To keep a span's children together when the work
+fans out to other threads, wrap the function that runs there with wrap(), and
+its spans get parented to the span that was open when it was wrapped.
+
+Tracer(profile=True) also runs cProfile for every top level span (or pass a
+list of span names to pick which ones), and dump_profiles writes them out as
+.prof files for pstats or snakeviz.
+"""
+
+import cProfile
+import functools
+import itertools
+import json
+import os
+import threading
+import timeit
+from contextlib import contextmanager
+
+import attr
+
+_active = [None]
+_local = threading.local()
+
+
+def current_tracer():
+    return _active[0]
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@attr.s
+class Span(object):
+    name = attr.ib()
+    span_id = attr.ib()
+    parent_id = attr.ib(default=None)
+    thread = attr.ib(default=None)
+    start = attr.ib(default=0.0)
+    end = attr.ib(default=None)
+    attributes = attr.ib(default=attr.Factory(dict))
+    profile = attr.ib(default=None, repr=False)
+
+    @property
+    def seconds(self):
+        return (self.end if self.end is not None else
+                timeit.default_timer()) - self.start
+
+
+@attr.s
+class Tracer(object):
+    """
+    Collects spans from every thread while it's active.  Only one tracer is
+    active at a time; activating another one replaces it until it's done.
+    """
+    profile = attr.ib(default=False)
+    spans = attr.ib(default=attr.Factory(list))
+    origin = attr.ib(default=attr.Factory(timeit.default_timer))
+    _ids = attr.ib(default=attr.Factory(itertools.count))
+    _lock = attr.ib(default=attr.Factory(threading.Lock))
+    _previous = attr.ib(default=None)
+
+    def __enter__(self):
+        self._previous = _active[0]
+        _active[0] = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _active[0] = self._previous
+        self._previous = None
+
+    def should_profile(self, name, parent_id):
+        if not self.profile:
+            return False
+        if self.profile is True:
+            return parent_id is None
+        return name in self.profile
+
+    def open(self, name, parent_id, attributes):
+        with self._lock:
+            span = Span(name=name, span_id=next(self._ids),
+                        parent_id=parent_id,
+                        thread=threading.current_thread().name,
+                        attributes=attributes)
+            self.spans.append(span)
+        # cProfile can only have one profiler running per thread, so nested
+        # spans inside a profiled one show up in its profile instead.
+        if (self.should_profile(name, parent_id) and
+                not getattr(_local, "profiling", False)):
+            span.profile = cProfile.Profile()
+            _local.profiling = True
+            span.profile.enable()
+        span.start = timeit.default_timer()
+        return span
+
+    def close(self, span):
+        span.end = timeit.default_timer()
+        if span.profile is not None:
+            span.profile.disable()
+            _local.profiling = False
+
+    def children(self):
+        children = {}
+        for span in self.spans:
+            children.setdefault(span.parent_id, []).append(span)
+        return children
+
+    def summary(self):
+        """
+        Total seconds and count per span name, slowest first.
+        """
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, {"name": span.name,
+                                                  "count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += span.seconds
+        return sorted(totals.values(), key=lambda total: -total["seconds"])
+
+    def chrome_trace(self):
+        """
+        The Chrome trace event format, which chrome://tracing, Perfetto and
+        speedscope can all open.  Timestamps are microseconds since the tracer
+        started.
+        """
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            args = dict(span.attributes)
+            args["span_id"] = span.span_id
+            if span.parent_id is not None:
+                args["parent_id"] = span.parent_id
+            events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": (span.start - self.origin) * 1e6,
+                "dur": span.seconds * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args
+                })
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M",
+                           "pid": os.getpid(), "tid": tid,
+                           "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def speedscope(self):
+        """
+        speedscope's own format, with one evented profile per thread.  Spans
+        whose parent is in another thread (from wrap) start a new root there.
+        """
+        frames = []
+        frame_ids = {}
+        children = self.children()
+        by_id = dict((span.span_id, span) for span in self.spans)
+        profiles = []
+        threads = []
+        for span in self.spans:
+            if span.thread not in threads:
+                threads.append(span.thread)
+
+        def walk(span, events):
+            frame = frame_ids.get(span.name)
+            if frame is None:
+                frame = frame_ids[span.name] = len(frames)
+                frames.append({"name": span.name})
+            events.append({"type": "O", "frame": frame,
+                           "at": span.start - self.origin})
+            for child in sorted(children.get(span.span_id, []),
+                                key=lambda child: child.start):
+                if child.thread == span.thread:
+                    walk(child, events)
+            events.append({"type": "C", "frame": frame,
+                           "at": span.start + span.seconds - self.origin})
+
+        for thread in threads:
+            roots = [span for span in self.spans if span.thread == thread and
+                     (span.parent_id is None or
+                      by_id[span.parent_id].thread != thread)]
+            events = []
+            for root in sorted(roots, key=lambda root: root.start):
+                walk(root, events)
+            profiles.append({
+                "type": "evented",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": events[0]["at"] if events else 0,
+                "endValue": events[-1]["at"] if events else 0,
+                "events": events
+                })
+        return {
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "shared": {"frames": frames},
+                "profiles": profiles
+                }
+
+    def save(self, path, format="chrome"):
+        if format == "chrome":
+            trace = self.chrome_trace()
+        elif format == "speedscope":
+            trace = self.speedscope()
+        else:
+            raise ValueError("Unknown trace format %s, use chrome or "
+                             "speedscope" % format)
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+
+    def dump_profiles(self, directory):
+        """
+        Writes each profiled span to <directory>/<span id>-<name>.prof, and
+        returns the paths.
+        """
+        paths = []
+        for span in self.spans:
+            if span.profile is None:
+                continue
+            path = os.path.join(directory, "%d-%s.prof" % (
+                span.span_id, span.name.replace(" ", "-").replace("/", "-")))
+            span.profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a child of whatever span is open in this thread.
+    Yields the Span, or None when no tracer is active.
+    """
+    tracer = _active[0]
+    if tracer is None:
+        yield None
+        return
+    stack = _stack()
+    opened = tracer.open(name, stack[-1].span_id if stack else None,
+                         attributes)
+    stack.append(opened)
+    try:
+        yield opened
+    finally:
+        stack.pop()
+        tracer.close(opened)
+
+
+def traced(name):
+    """
+    Decorator version of span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(function):
+    """
+    Carries the span open right now over to whatever thread ends up calling
+    function, so spans there nest under it.
+    """
+    stack = _stack()
+    parent = stack[-1] if stack else None
+
+    def wrapper(*args, **kwargs):
+        local_stack = _stack()
+        saved = list(local_stack)
+        local_stack[:] = [parent] if parent is not None else []
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local_stack[:] = saved
+    return wrapper
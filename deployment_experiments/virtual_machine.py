@@ -26,7 +26,6 @@ everything is open source).
 """
 
 import attr
-import boto3
 
 @attr.s
 class VirtualMachineBuilderInterface(object):
@@ -96,6 +95,7 @@ class VirtualMachine(object):
     """
     plugins = attr.ib(type=list)
     provider = attr.ib(default="aws")
+    ami = attr.ib(default=None)
 
     def build_cloud_init(self):
         runtime_scripts = []
@@ -110,6 +110,8 @@ class VirtualMachine(object):
         return PackerImageBuilder(build_scripts).build_image()
 
     def get(self):
-        # TODO: Maybe I should not rebuild the AMI every time this is called?
-        # Who should cache that/search for it?
-        return self.build()
+        # Built once per object.  Anything that wants to skip the build across
+        # runs (like the daemon) just keeps the object around.
+        if self.ami is None:
+            self.ami = self.build()
+        return self.ami
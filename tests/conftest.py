@@ -0,0 +1,4 @@
+import sys
+
+# aio uses async/await, so it's python 3 only
+collect_ignore = ["test_aio.py"] if sys.version_info < (3, 5) else []
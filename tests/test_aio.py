@@ -0,0 +1,115 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import boto3
+from moto import mock_ec2
+
+from deployment_experiments.aio import AsyncDatacenterInventory, AsyncNetwork
+from deployment_experiments.aio import Runner
+from deployment_experiments.subnet_generator import ip_network
+
+
+def overlapping(cidrs):
+    return [(first, second)
+            for first, second in itertools.combinations(cidrs, 2)
+            if ip_network(first).overlaps(ip_network(second))]
+
+
+@mock_ec2
+def test_concurrent_provision():
+    runner = Runner(max_concurrency=4)
+
+    async def provision():
+        roots = await asyncio.gather(*[
+            AsyncNetwork(runner=runner).provision(network_name="net%d" % i)
+            for i in range(6)])
+        colocated = await asyncio.gather(*[
+            AsyncNetwork(runner=runner).provision(network_name="app%d" % i,
+                                                  colocated_network="net0")
+            for i in range(4)])
+        return roots + colocated
+
+    async def main():
+        # The loop should keep running while the calls are in flight
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.001)
+        ticker = asyncio.ensure_future(tick())
+        subnet_ids = await provision()
+        ticker.cancel()
+        datacenters = await AsyncDatacenterInventory(runner=runner).discover()
+        return subnet_ids, datacenters, ticks
+
+    subnet_ids, datacenters, ticks = asyncio.run(main())
+    assert len(ticks) > 1
+    assert len(runner.executor._threads) <= 4
+    runner.shutdown()
+
+    # Every datacenter and every subnet in the same datacenter got its own
+    # block, even though they were all allocated at once
+    assert len(datacenters) == 6
+    ec2 = boto3.client("ec2")
+    vpcs = ec2.describe_vpcs(VpcIds=datacenters)["Vpcs"]
+    assert overlapping([vpc["CidrBlock"] for vpc in vpcs]) == []
+    subnets = ec2.describe_subnets(
+            SubnetIds=[subnet_id for ids in subnet_ids
+                       for subnet_id in ids])["Subnets"]
+    assert len(subnets) == 30
+    by_vpc = {}
+    for subnet in subnets:
+        by_vpc.setdefault(subnet["VpcId"], []).append(subnet["CidrBlock"])
+    for cidrs in by_vpc.values():
+        assert overlapping(cidrs) == []
+
+
+@mock_ec2
+def test_creates_overlap():
+    """
+    The allocation lock only covers picking blocks, so the creates
+    themselves run side by side.
+    """
+    boto3.setup_default_session()
+    events = boto3.DEFAULT_SESSION.events
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def before(**kwargs):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.05)
+
+    def after(**kwargs):
+        with lock:
+            in_flight[0] -= 1
+
+    for operation in ["CreateVpc", "CreateSubnet"]:
+        events.register("before-call.ec2.%s" % operation, before,
+                        unique_id="overlap-before-%s" % operation)
+        events.register("after-call.ec2.%s" % operation, after,
+                        unique_id="overlap-after-%s" % operation)
+    runner = Runner(max_concurrency=4)
+
+    async def provision():
+        await asyncio.gather(*[
+            AsyncNetwork(runner=runner).provision(network_name="net%d" % i)
+            for i in range(4)])
+    try:
+        asyncio.run(provision())
+    finally:
+        runner.shutdown()
+        for operation in ["CreateVpc", "CreateSubnet"]:
+            events.unregister("before-call.ec2.%s" % operation,
+                              unique_id="overlap-before-%s" % operation)
+            events.unregister("after-call.ec2.%s" % operation,
+                              unique_id="overlap-after-%s" % operation)
+    assert in_flight[1] > 1
+
+    vpcs = boto3.client("ec2").describe_vpcs()["Vpcs"]
+    assert overlapping([vpc["CidrBlock"] for vpc in vpcs
+                        if not vpc["IsDefault"]]) == []
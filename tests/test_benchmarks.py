@@ -0,0 +1,64 @@
+from benchmarks import harness
+from benchmarks import synthetic
+from deployment_experiments import netgraph
+from deployment_experiments import routegraph
+
+
+def test_synthetic_inputs():
+    net = synthetic.synthetic_net(20)
+    assert len(net) == 21
+    assert "external" in net
+    assert netgraph.net_to_firewalls(net)
+
+    paths = synthetic.synthetic_paths(20)
+    assert len(paths) == 20
+    assert routegraph.net_to_routes(paths)
+
+    parent, existing, prefix = synthetic.crowded_space(5, prefix=24)
+    assert parent == "10.0.0.0/8"
+    assert existing == ["10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24",
+                        "10.0.3.0/24", "10.0.4.0/24"]
+    assert prefix == 24
+
+
+def test_run():
+    results = harness.run([("noop", lambda scale: lambda: None)], [1, 2])
+    assert sorted(results) == ["noop@1", "noop@2"]
+    assert results["noop@1"]["seconds"] >= 0
+
+
+def test_run_skips_over_budget():
+    def setup(scale):
+        return lambda: sum(range(scale))
+    results = harness.run([("sum", setup)], [1, 10 ** 9], budget=0)
+    assert results["sum@1000000000"] == {"skipped": True}
+
+
+def test_compare():
+    baseline = {
+            "a@10": {"seconds": 1.0, "peak_bytes": 10 << 20},
+            "b@10": {"seconds": 1.0, "peak_bytes": 10 << 20},
+            "c@10": {"skipped": True}
+            }
+    results = {
+            "a@10": {"seconds": 1.1, "peak_bytes": 20 << 20},
+            "b@10": {"seconds": 2.0, "peak_bytes": 10 << 20},
+            "c@10": {"seconds": 5.0, "peak_bytes": 10 << 20},
+            "d@10": {"seconds": 5.0, "peak_bytes": 10 << 20}
+            }
+    assert harness.compare(results, baseline, threshold=0.25) == [
+            ("a@10", "peak_bytes", 10 << 20, 20 << 20),
+            ("b@10", "seconds", 1.0, 2.0)
+            ]
+
+
+def test_compare_counts():
+    baseline = {"cycle@1": {"api_calls": {"ec2.DescribeVpcs": 2,
+                                          "ec2.CreateVpc": 1}}}
+    results = {"cycle@1": {"api_calls": {"ec2.DescribeVpcs": 3,
+                                         "ec2.CreateVpc": 1,
+                                         "ec2.CreateTags": 1}}}
+    assert harness.compare_counts(results, baseline, "api_calls") == [
+            ("cycle@1", "api_calls ec2.CreateTags", 0, 1),
+            ("cycle@1", "api_calls ec2.DescribeVpcs", 2, 3)
+            ]
@@ -0,0 +1,65 @@
+import pytest
+
+from deployment_experiments import memory
+from deployment_experiments.capacity import CapacityException, CapacityModel
+from deployment_experiments.service import LoadBalancer, Service
+from deployment_experiments.virtual_machine import VirtualMachine
+
+
+def model(**kwargs):
+    return CapacityModel(**dict(dict(throughput=200, latency=0.05,
+                                     load=1500, peak_load=4000, cpus=2,
+                                     memory=4), **kwargs))
+
+
+def test_plan():
+    plan = model().plan(zones=3)
+    assert plan.instance_type == "t2.medium"
+    # The latency target allows 90%, but headroom caps it at 70%
+    assert plan.utilization == 0.7
+    assert abs(plan.instance_throughput - 140) < 1e-9
+    # With a zone down, the other two zones cover the load
+    assert plan.per_zone == {"min": 1, "desired": 6, "max": 15}
+    assert (plan.min_size, plan.desired_capacity, plan.max_size) == (3, 18,
+                                                                     45)
+    assert 2 * plan.per_zone["desired"] * plan.instance_throughput >= 1500
+    assert 2 * plan.per_zone["max"] * plan.instance_throughput >= 4000
+    assert plan.scaling_policy()["TargetValue"] == 70.0
+
+    assert plan.capacity_for(3000) == 33
+    assert plan.capacity_for(0) == 3
+    assert plan.capacity_for(10 ** 6) == 45
+
+
+def test_plan_latency():
+    # 50 requests a second is 20ms each, so a 25ms target only leaves 20%
+    plan = model(throughput=50, latency=0.025).plan()
+    assert abs(plan.utilization - 0.2) < 1e-9
+    assert plan.per_zone["desired"] == 75
+    with pytest.raises(CapacityException):
+        model(throughput=10, latency=0.1).plan()
+
+
+def test_plan_single_zone():
+    with pytest.raises(CapacityException):
+        model().plan(zones=1)
+    # Two zones means each one has to take everything
+    assert model().plan(zones=2).per_zone["desired"] == 11
+
+
+def test_service_capacity():
+    memory.reset()
+    lb = LoadBalancer("web-lb", "web.example.com", provider="memory")
+    lb.provision()
+    web = Service("web", VirtualMachine(plugins=[]), lb, provider="memory",
+                  capacity=model())
+    web.provision(colocated_service=lb.name)
+    group = web.discover()["AutoScalingGroups"][0]
+    assert (group["MinSize"], group["DesiredCapacity"], group["MaxSize"]) == (
+        3, 18, 45)
+    zones = [instance["AvailabilityZone"] for instance in group["Instances"]]
+    assert all(zones.count(zone) == 6 for zone in memory.ZONES)
+    assert memory.cloud.launch_configurations["web"]["instance_type"] == (
+        "t2.medium")
+    policies = memory.cloud.auto_scaling_groups["web"]["policies"]
+    assert policies["web-target-tracking"]["TargetValue"] == 70.0
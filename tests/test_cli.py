@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+from deployment_experiments import cli
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_offline_modules_skip_boto3():
+    # A fresh interpreter, since this one has probably imported boto3 already
+    check = ("import sys\n"
+             "import deployment_experiments.cli\n"
+             "import deployment_experiments.netgraph\n"
+             "import deployment_experiments.routegraph\n"
+             "import deployment_experiments.subnet_generator\n"
+             "import deployment_experiments.reachability\n"
+             "import deployment_experiments.forwarding\n"
+             "import deployment_experiments.netdelta\n"
+             "import deployment_experiments.plan\n"
+             "assert 'boto3' not in sys.modules\n"
+             "assert 'botocore' not in sys.modules\n")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [path for path in [
+        env.get("PYTHONPATH")] if path])
+    subprocess.check_call([sys.executable, "-c", check], cwd=root, env=env)
+
+
+def run(tmpdir, argv):
+    output_path = str(tmpdir.join("output.json"))
+    with open(output_path, "w") as output:
+        assert cli.main(argv, output=output) == 0
+    with open(output_path) as output:
+        return json.load(output)
+
+
+def test_offline_commands(tmpdir):
+    net_path = str(tmpdir.join("net.json"))
+    with open(net_path, "w") as net_file:
+        json.dump({"web": {"db": [{"protocol": "tcp", "port": "5432"}]}},
+                  net_file)
+    firewalls = run(tmpdir, ["firewalls", net_path])
+    assert firewalls["db"] == [{"source": "web", "protocol": "tcp",
+                                "port": "5432", "type": "ingress"}]
+
+    paths_path = str(tmpdir.join("paths.json"))
+    with open(paths_path, "w") as paths_file:
+        json.dump([["web", "nat", "external"]], paths_file)
+    routes = run(tmpdir, ["routes", paths_path])
+    assert routes["web"] == [{"destination": "external", "target": "nat"}]
+
+    assert run(tmpdir, ["subnets", "10.0.0.0/16", "--prefix", "24",
+                        "--count", "2"]) == ["10.0.0.0/24", "10.0.1.0/24"]
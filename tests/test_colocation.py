@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from deployment_experiments.colocation import Colocator, ColocationException
+from deployment_experiments.colocation import traffic_edges
+from deployment_experiments.plan import network_order
+
+
+def rule(traffic=None):
+    rule = {"protocol": "tcp", "port": "443"}
+    if traffic is not None:
+        rule["traffic"] = traffic
+    return rule
+
+
+net = {
+        "external": {"web": [rule(5000)]},
+        "web": {"api": [rule(900)], "auth": [rule(50)]},
+        "api": {"db": [rule(800)], "cache": [rule(700)], "auth": [rule(10)]},
+        "auth": {"users": [rule(400)]},
+        "batch": {"db": [rule(20)]},
+        }
+
+
+def test_traffic_edges():
+    edges = traffic_edges({"a": {"b": [rule(3), rule()]},
+                           "b": {"a": [rule(2)]},
+                           "external": {"a": [rule(10)]}},
+                          external=["external"])
+    assert edges == {("a", "b"): 6}
+
+
+def test_optimize():
+    # Room for three services per VPC
+    colocation = Colocator(max_subnets=9).optimize(net)
+    # web and api merge first, then db joins them and that one's full.
+    # batch has nothing left to go with, so it gets packed in with auth.
+    assert colocation.datacenters == [["api", "db", "web"],
+                                      ["auth", "batch", "users"],
+                                      ["cache"]]
+    assert colocation.total_traffic == 2880
+    # api to cache, web to auth, api to auth and batch to db
+    assert colocation.cross_vpc_traffic == 700 + 50 + 10 + 20
+    assert colocation.colocated_with["api"] is None
+    assert colocation.colocated_with["db"] == "api"
+
+    # With room for everything, nothing crosses
+    colocation = Colocator().optimize(net)
+    assert colocation.datacenters == [["api", "auth", "batch", "cache", "db",
+                                       "users", "web"]]
+    assert colocation.cross_vpc_traffic == 0
+
+    # The output works as the planner's networks, without loops
+    networks = dict((name, network["colocated_with"]) for name, network
+                    in Colocator(max_subnets=9).optimize(net).networks()
+                    .items())
+    assert len(network_order(networks)) == 7
+
+
+def test_together():
+    colocation = Colocator(max_subnets=9,
+                           together=[["web", "web-lb"]]).optimize(net)
+    web = [datacenter for datacenter in colocation.datacenters
+           if "web" in datacenter][0]
+    assert "web-lb" in web
+    with pytest.raises(ColocationException):
+        Colocator(max_subnets=6,
+                  together=[["web", "api", "db"]]).optimize(net)
+
+
+def test_too_big():
+    with pytest.raises(ColocationException):
+        Colocator(vpc_prefix=24, prefixes={"db": 25}).optimize(net)
+
+
+def test_refine():
+    # Room for two, so b can't follow a
+    colocator = Colocator(max_subnets=6)
+    clusters = {"a": "a", "b": "a", "c": "c"}
+    edges = {("a", "b"): 1, ("a", "c"): 5}
+    colocator.refine(clusters, edges, ["a", "b", "c"])
+    assert clusters["a"] == "c"
+    assert clusters["b"] == "a"
+
+
+def test_many_services():
+    random.seed(4)
+    services = ["svc%d" % i for i in range(2000)]
+    big_net = {}
+    for i, service in enumerate(services):
+        # Mostly talks to its neighbours, sometimes to anything
+        targets = set(services[(i + offset) % len(services)]
+                      for offset in (1, 2, 3))
+        targets.add(random.choice(services))
+        big_net[service] = dict((target, [rule(random.randint(1, 100))])
+                                for target in targets if target != service)
+    colocation = Colocator().optimize(big_net)
+    assert all(len(datacenter) * 3 <= 200
+               for datacenter in colocation.datacenters)
+    assert sum(len(datacenter) for datacenter in colocation.datacenters) == (
+        2000)
+    # A quarter of the edges go anywhere at random, so those mostly cross no
+    # matter what.  Splitting at random would have nearly all of it cross.
+    assert colocation.cross_vpc_traffic < colocation.total_traffic / 3
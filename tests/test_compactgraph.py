@@ -0,0 +1,40 @@
+from deployment_experiments.compactgraph import CompactPaths
+from deployment_experiments.compactgraph import format_ports, parse_ports
+
+paths = [["0", "1", "external"], ["2", "1", "external"]]
+
+
+def test_paths_round_trip():
+    compact = CompactPaths.from_paths(paths)
+    assert compact.to_paths() == paths
+
+
+def test_compile_routes():
+    routes = CompactPaths.from_paths(paths).compile_routes().to_routes()
+    assert "external" not in routes
+    assert routes["1"] == [{
+        "destination": "0",
+        "target": "0"
+        },
+        {
+        "destination": "external",
+        "target": "external"
+        },
+        {
+        "destination": "2",
+        "target": "2"
+        },
+        {
+        "destination": "external",
+        "target": "external"
+        }]
+
+
+def test_parse_ports():
+    assert parse_ports("443") == (443, 443)
+    assert parse_ports(443) == (443, 443)
+    assert parse_ports("8000-8080") == (8000, 8080)
+    # AWS's all ports
+    assert parse_ports("-1") == (-1, -1)
+    assert parse_ports(-1) == (-1, -1)
+    assert format_ports(*parse_ports("-1")) == "-1"
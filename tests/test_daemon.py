@@ -0,0 +1,236 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+from moto import mock_autoscaling, mock_ec2, mock_elb
+
+from deployment_experiments import clients
+from deployment_experiments import memory
+from deployment_experiments.daemon import Daemon, DaemonException, request
+from deployment_experiments.network import Network, NetworkExistsException
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    memory.reset()
+    daemon = Daemon(provider="memory", deployment_name="prod",
+                    max_concurrency=4)
+    socket_path = str(tmpdir.join("deployer.sock"))
+    server = threading.Thread(target=daemon.serve, args=(socket_path,))
+    server.start()
+    while daemon.server is None:
+        time.sleep(0.01)
+    yield daemon, socket_path
+    daemon.stop()
+    server.join()
+    clients.keep_warm(False)
+
+
+def test_requests(daemon):
+    daemon, socket_path = daemon
+    assert request(socket_path, "ping") == "pong"
+
+    web = request(socket_path, "provision", kind="network", name="web")
+    assert len(web) == 3
+    db = request(socket_path, "provision", kind="network", name="db",
+                 colocated_with="web")
+    assert request(socket_path, "discover", kind="network", name="db") == db
+
+    request(socket_path, "provision", kind="load_balancer", name="web-lb",
+            dns="web.example.com")
+    request(socket_path, "provision", kind="service", name="api",
+            load_balancer={"name": "web-lb", "dns": "web.example.com"},
+            plugins=[["build", "run"]], colocated_with="web-lb",
+            capacity={"throughput": 200, "latency": 0.05, "load": 500})
+    groups = request(socket_path, "discover", kind="service", name="api",
+                     load_balancer={"name": "web-lb",
+                                    "dns": "web.example.com"},
+                     plugins=[["build", "run"]])["AutoScalingGroups"]
+    assert groups[0]["DesiredCapacity"] == 6
+    # The image got built once and kept
+    assert len(daemon.images) == 1
+
+    request(socket_path, "destroy", kind="network", name="db")
+    assert request(socket_path, "discover", kind="network", name="db") == []
+    with pytest.raises(DaemonException) as raised:
+        request(socket_path, "provision", kind="network", name="web")
+    assert "NetworkExistsException" in str(raised.value)
+    with pytest.raises(DaemonException):
+        request(socket_path, "nothing")
+
+    status = request(socket_path, "status")
+    assert status["provider"] == "memory"
+    assert status["served"] == 12
+
+
+def test_pipelined_requests(daemon):
+    """
+    Lots of requests down one connection, and more from other connections at
+    the same time, all answered by id.
+    """
+    daemon, socket_path = daemon
+    results = {}
+
+    def send(prefix):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+        lines = "".join(json.dumps({"id": "%s%d" % (prefix, i),
+                                    "method": "provision",
+                                    "params": {"kind": "network",
+                                               "name": "%s%d" % (prefix, i)}
+                                    }) + "\n" for i in range(10))
+        connection.sendall(lines.encode("utf-8"))
+        connection.shutdown(socket.SHUT_WR)
+        for line in connection.makefile("rb"):
+            response = json.loads(line.decode("utf-8"))
+            results[response["id"]] = response["result"]
+        connection.close()
+
+    senders = [threading.Thread(target=send, args=(prefix,))
+               for prefix in "abc"]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    assert len(results) == 30
+    subnet_ids = [subnet_id for result in results.values()
+                  for subnet_id in result]
+    assert len(set(subnet_ids)) == 90
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+def test_snapshot_cache():
+    """
+    Snapshots get reused until something changes the deployment.
+    """
+    daemon = Daemon(deployment_name="prod")
+    first = daemon.snapshot({})
+    assert first["networks"] == {}
+    assert daemon.snapshot({}) is first
+    refreshed = daemon.snapshot({"refresh": True})
+    assert refreshed is not first and refreshed == first
+
+    daemon.provision({"kind": "network", "name": "web"})
+    assert daemon.snapshots["prod"]["stale"]
+    assert "web" in daemon.snapshot({})["networks"]
+    assert daemon.handle({"id": 7, "method": "status"})["result"][
+        "snapshots"]["prod"]["stale"] is False
+
+    # A failed provision still marks it stale
+    with pytest.raises(NetworkExistsException):
+        daemon.provision({"kind": "network", "name": "web"})
+    assert daemon.snapshots["prod"]["stale"]
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+def test_refresh_loop():
+    """
+    The background refresh picks up changes the daemon didn't make.
+    """
+    daemon = Daemon(deployment_name="prod", refresh_interval=0.01)
+    assert daemon.snapshot({})["networks"] == {}
+    Network(deployment_name="prod").provision(network_name="web")
+    refresher = threading.Thread(target=daemon.refresh_loop)
+    refresher.start()
+    try:
+        for _ in range(500):
+            if "web" in daemon.snapshots["prod"]["snapshot"]["networks"]:
+                break
+            time.sleep(0.01)
+    finally:
+        daemon.stop()
+        refresher.join()
+    assert "web" in daemon.snapshot({})["networks"]
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+def test_refresh_history():
+    """
+    Every refresh records each datacenter's usage, for fragmentation.
+    """
+    from deployment_experiments.fragmentation import analyze
+    times = iter(range(100))
+    daemon = Daemon(deployment_name="prod", clock=lambda: next(times),
+                    history_length=2)
+    network = Network(deployment_name="prod")
+    network.provision(network_name="web")
+    daemon.refresh("prod")
+    network.provision(network_name="db", colocated_network="web")
+    daemon.refresh("prod")
+    network.provision(network_name="cache", colocated_network="web")
+    snapshot = daemon.refresh("prod")
+
+    history = daemon.history["prod"]
+    assert len(history) == 1
+    samples = list(history.values())[0]
+    assert [used for _, used in samples] == [6 * 16, 9 * 16]
+    assert samples[0][0] < samples[1][0]
+    report = list(analyze(snapshot, history).values())[0]
+    assert report["exhaustion"] is not None
+
+
+def test_memory_rejects():
+    daemon = Daemon(provider="memory", deployment_name="prod")
+    for method in ("snapshot", "plan"):
+        response = daemon.handle({"id": 1, "method": method,
+                                  "params": {"desired": {}}})
+        assert response["error"]["type"] == "DaemonException"
+    # Services go wherever they're colocated, so they can't take one
+    with pytest.raises(DaemonException):
+        daemon.resource({"kind": "service", "name": "api",
+                         "deployment": "staging",
+                         "load_balancer": {"name": "web-lb",
+                                           "dns": "web.example.com"}})
+
+
+def test_image_built_once(monkeypatch):
+    from deployment_experiments.virtual_machine import VirtualMachine
+    builds = []
+
+    def build(self):
+        builds.append(self)
+        time.sleep(0.05)
+        return "ami-%d" % len(builds)
+    monkeypatch.setattr(VirtualMachine, "build", build)
+
+    daemon = Daemon(provider="memory")
+    threads = [threading.Thread(target=daemon.image,
+                                args=([["build", "run"]], True))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert daemon.image([["build", "run"]]).ami == "ami-1"
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+def test_invalidate_during_refresh(monkeypatch):
+    """
+    A change that lands while a snapshot is being taken leaves it stale.
+    """
+    from deployment_experiments.plan import Planner
+    daemon = Daemon(deployment_name="prod")
+    snapshot = Planner.snapshot
+
+    def changed_during(self, desired=None):
+        taken = snapshot(self, desired)
+        daemon.provision({"kind": "network", "name": "web"})
+        return taken
+    monkeypatch.setattr(Planner, "snapshot", changed_during)
+    assert daemon.refresh("prod")["networks"] == {}
+    assert daemon.snapshots["prod"]["stale"]
+
+    monkeypatch.setattr(Planner, "snapshot", snapshot)
+    assert "web" in daemon.snapshot({})["networks"]
@@ -2,7 +2,7 @@ import boto3
 from moto import mock_ec2
 
 from deployment_experiments.datacenter import Datacenter, DatacenterInventory
-import ipaddress
+from deployment_experiments.subnet_generator import ip_network
 
 
 @mock_ec2
@@ -33,8 +33,8 @@ def test_datacenter():
     def get_cidr(dc_id):
         dc = Datacenter()
         return dc.discover(dc_id)["Vpcs"][0]["CidrBlock"]
-    dc1_cidr = ipaddress.ip_network(unicode(get_cidr(dc1_id)))
-    dc2_cidr = ipaddress.ip_network(unicode(get_cidr(dc2_id)))
+    dc1_cidr = ip_network(get_cidr(dc1_id))
+    dc2_cidr = ip_network(get_cidr(dc2_id))
     assert not dc1_cidr.overlaps(dc2_cidr)
 
     # Try to get them from the DC inventory
@@ -42,7 +42,7 @@ def test_datacenter():
     dc_ids = dc_inventory.discover()
     assert len(dc_ids) == 2
     dc = Datacenter()
-    dc_cidrs = [ipaddress.ip_network(unicode(get_cidr(dc_id)))
+    dc_cidrs = [ip_network(get_cidr(dc_id))
                 for dc_id in dc_ids]
     assert len(dc_cidrs) == 2
     assert not dc_cidrs[0].overlaps(dc_cidrs[1])
@@ -1,8 +1,149 @@
 #!/usr/bin/env python
 
+import boto3
+from moto import mock_ec2
+
+from deployment_experiments import netgraph
 from deployment_experiments.firewall_compiler import FirewallCompiler
+from deployment_experiments.instrumentation import ApiRecorder
+from deployment_experiments.network import Network
+
+net = {
+        "web": {
+            "db": [{
+                "protocol": "tcp",
+                "port": "5432"
+                }]
+            },
+        "external": {
+            "web": [{
+                "protocol": "tcp",
+                "port": "443"
+                }]
+            }
+        }
+
+
+def test_generate_rules():
+    firewall_compiler = FirewallCompiler()
+    cidrs = {
+            "web": ["10.0.0.0/27"],
+            "db": ["10.0.0.32/28"],
+            "external": ["0.0.0.0/0"]
+            }
+    rules = firewall_compiler.generate_rules(netgraph.net_to_firewalls(net),
+                                             cidrs)
+    assert rules["web"]["ingress"] == set([("tcp", 443, 443, "0.0.0.0/0")])
+    assert rules["web"]["egress"] == set([("tcp", 5432, 5432,
+                                           "10.0.0.32/28")])
+    assert rules["db"]["ingress"] == set([("tcp", 5432, 5432,
+                                           "10.0.0.0/27")])
+    assert rules["db"]["egress"] == set()
 
 
+@mock_ec2
 def test_firewall_compiler():
+    network = Network()
+    network.provision(network_name="web")
+    network.provision(network_name="db", colocated_network="web")
+
     firewall_compiler = FirewallCompiler()
-    assert firewall_compiler.generate_rules() == ["0.0.0.0/0"]
+    changes = firewall_compiler.apply(netgraph.net_to_firewalls(net))
+    assert sorted(changes) == ["db", "web"]
+
+    ec2 = boto3.client("ec2")
+    name_filter = {'Name': "tag:cloud-deployer-network", 'Values': ["db"]}
+    groups = ec2.describe_security_groups(Filters=[name_filter])
+    assert len(groups["SecurityGroups"]) == 1
+    ingress = groups["SecurityGroups"][0]["IpPermissions"]
+    assert len(ingress) == 1
+    assert ingress[0]["FromPort"] == 5432
+    assert len(ingress[0]["IpRanges"]) >= 1
+
+    # Applying the same thing again should be a no-op
+    assert firewall_compiler.apply(netgraph.net_to_firewalls(net)) == {}
+
+
+@mock_ec2
+def test_default_egress_revoked():
+    """
+    AWS gives every new group an allow-all egress rule, which isn't in the
+    net, so it goes.
+    """
+    network = Network()
+    network.provision(network_name="web")
+    network.provision(network_name="db", colocated_network="web")
+    changes = FirewallCompiler().apply(netgraph.net_to_firewalls(net))
+    assert changes["db"]["revoke_egress"] == set([("-1", -1, -1,
+                                                   "0.0.0.0/0")])
+
+    ec2 = boto3.client("ec2")
+    egress = dict(
+        ([tag["Value"] for tag in group["Tags"]
+          if tag["Key"] == "cloud-deployer-network"][0],
+         group["IpPermissionsEgress"])
+        for group in ec2.describe_security_groups(Filters=[{
+            'Name': "tag:cloud-deployer-deployment",
+            'Values': ["default"]}])["SecurityGroups"])
+    assert egress["db"] == []
+    assert [permission["FromPort"] for permission in egress["web"]] == [5432]
+
+
+def db_port(port):
+    return {"web": {"db": [{"protocol": "tcp", "port": port}]}}
+
+
+def group_calls(recorder):
+    return [call.name for call in recorder.calls
+            if call.name.split(".")[1].startswith(("Authorize", "Revoke"))]
+
+
+@mock_ec2
+def test_authorize_before_revoke():
+    network = Network()
+    network.provision(network_name="web")
+    network.provision(network_name="db", colocated_network="web")
+    FirewallCompiler().apply(netgraph.net_to_firewalls(db_port("5432")))
+
+    with ApiRecorder(warn=False) as recorder:
+        FirewallCompiler().apply(netgraph.net_to_firewalls(db_port("5433")))
+    assert group_calls(recorder) == [
+            "ec2.AuthorizeSecurityGroupIngress",
+            "ec2.RevokeSecurityGroupIngress",
+            "ec2.AuthorizeSecurityGroupEgress",
+            "ec2.RevokeSecurityGroupEgress"]
+
+    # Holding both would go over the limit, so the old rules go first
+    with ApiRecorder(warn=False) as recorder:
+        FirewallCompiler(max_rules=1).apply(
+            netgraph.net_to_firewalls(db_port("5434")))
+    assert group_calls(recorder) == [
+            "ec2.RevokeSecurityGroupIngress",
+            "ec2.AuthorizeSecurityGroupIngress",
+            "ec2.RevokeSecurityGroupEgress",
+            "ec2.AuthorizeSecurityGroupEgress"]
+
+
+@mock_ec2
+def test_destroy_deletes_groups():
+    network = Network()
+    network.provision(network_name="web")
+    network.provision(network_name="db", colocated_network="web")
+    FirewallCompiler().apply(netgraph.net_to_firewalls(net))
+
+    ec2 = boto3.client("ec2")
+    deployment_filter = {'Name': "tag:cloud-deployer-deployment",
+                         'Values': ["default"]}
+
+    def groups():
+        return sorted(
+            [tag["Value"] for tag in group["Tags"]
+             if tag["Key"] == "cloud-deployer-network"][0]
+            for group in ec2.describe_security_groups(
+                Filters=[deployment_filter])["SecurityGroups"])
+    assert groups() == ["db", "web"]
+    network.destroy("db")
+    assert groups() == ["web"]
+    network.destroy("web")
+    assert groups() == []
+    assert ec2.describe_vpcs(Filters=[deployment_filter])["Vpcs"] == []
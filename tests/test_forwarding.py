@@ -0,0 +1,47 @@
+from deployment_experiments import routegraph
+from deployment_experiments.forwarding import ForwardingSimulator, summarize
+
+cidrs = {
+        "0": ["10.0.0.0/28"],
+        "1": ["10.0.0.16/28"],
+        "gw": ["10.0.1.0/28"]
+        }
+
+paths = [["0", "gw", "external"], ["1", "gw", "external"], ["0", "gw", "1"]]
+
+
+def test_trace():
+    routes, _ = routegraph.compress_routes(routegraph.net_to_routes(paths),
+                                           cidrs)
+    simulator = ForwardingSimulator.from_routes(routes, cidrs)
+    results = simulator.trace([("0", "10.0.0.20"),
+                               ("0", "8.8.8.8"),
+                               ("gw", "10.0.0.5"),
+                               ("1", "10.0.0.5")])
+    assert results == [
+            {"status": "delivered", "path": ["0", "gw", "1"]},
+            {"status": "delivered", "path": ["0", "gw", "external"]},
+            {"status": "delivered", "path": ["gw", "0"]},
+            {"status": "delivered", "path": ["1", "gw", "0"]}
+            ]
+
+
+def test_blackhole_and_loop():
+    routes = {
+            "0": [{
+                "destination": "10.0.0.16/28",
+                "target": "gw"
+                }],
+            "gw": [{
+                "destination": "10.0.0.16/28",
+                "target": "0"
+                }]
+            }
+    simulator = ForwardingSimulator.from_routes(routes, cidrs)
+    results = simulator.trace([("0", "10.0.0.20"),
+                               ("0", "8.8.8.8"),
+                               ("1", "10.0.0.5")])
+    assert results[0] == {"status": "loop", "path": ["0", "gw", "0"]}
+    assert results[1] == {"status": "blackhole", "path": ["0"]}
+    assert results[2] == {"status": "blackhole", "path": ["1"]}
+    assert summarize(results) == {"delivered": 0, "blackhole": 2, "loop": 1}
@@ -0,0 +1,139 @@
+import ipaddress
+import random
+import timeit
+
+import pytest
+
+from deployment_experiments.fragmentation import AddressSpace
+from deployment_experiments.fragmentation import CompactionException
+from deployment_experiments.fragmentation import analyze, time_to_exhaustion
+from deployment_experiments.fragmentation import usage
+from deployment_experiments.subnet_generator import ip_network
+
+
+def snapshot(subnets, cidr="10.0.0.0/24"):
+    """
+    One datacenter with a network per subnet, named after it.
+    """
+    return {"datacenters": ["vpc-1"],
+            "datacenter_cidrs": {"vpc-1": cidr},
+            "networks": dict((subnet, {"datacenter": "vpc-1",
+                                       "subnets": {"subnet-%s" % subnet: {
+                                           "cidr": subnet,
+                                           "zone": "us-east-1a"}}})
+                             for subnet in subnets)}
+
+
+# Every other /28 is taken
+holes = snapshot(["10.0.0.%d/28" % (32 * i) for i in range(8)])
+
+
+def test_analyze():
+    report = analyze(holes)["vpc-1"]
+    assert report["used"] == 128
+    assert report["free"] == 128
+    assert report["free_blocks"] == {28: 8}
+    assert report["largest_free_prefix"] == 28
+    assert report["allocatable"] == {28: 8}
+    assert report["fragmentation"] == 0.875
+    assert report["exhaustion"] is None
+    assert usage(holes) == {"vpc-1": 128}
+
+    report = analyze(snapshot(["10.0.0.0/28", "10.0.0.32/28"]))["vpc-1"]
+    assert report["free_blocks"] == {25: 1, 26: 1, 28: 2}
+    assert report["allocatable"] == {25: 1, 26: 3, 27: 6, 28: 14}
+    assert analyze(snapshot([]))["vpc-1"]["fragmentation"] == 0.0
+    with pytest.raises(KeyError):
+        analyze({"datacenters": [], "networks": {}})
+
+
+def test_time_to_exhaustion():
+    # 10 addresses a day
+    history = [(0, 100), (1, 110), (2, 120)]
+    assert abs(time_to_exhaustion(history, 50) - 5) < 1e-9
+    assert time_to_exhaustion([(0, 100), (1, 90)], 50) is None
+    assert time_to_exhaustion([(0, 100)], 50) is None
+    report = analyze(holes, {"vpc-1": history})["vpc-1"]
+    assert abs(report["exhaustion"] - 12.8) < 1e-9
+
+
+def test_compaction():
+    space = AddressSpace.from_snapshot(holes)["vpc-1"]
+    assert space.compaction(28).moves == []
+    assert space.compaction(28).block == "10.0.0.16/28"
+
+    # Every /27 has one /28 in it, and the first one's goes to the first
+    # free /28 outside it
+    compaction = space.compaction(27)
+    assert compaction.block == "10.0.0.0/27"
+    assert compaction.moves == [{"subnet": "subnet-10.0.0.0/28",
+                                 "network": "10.0.0.0/28",
+                                 "zone": "us-east-1a",
+                                 "from": "10.0.0.0/28",
+                                 "to": "10.0.0.48/28"}]
+    assert compaction.steps() == [
+        {"action": "create_subnet", "datacenter": "vpc-1",
+         "network": "10.0.0.0/28", "zone": "us-east-1a",
+         "cidr": "10.0.0.48/28", "replaces": "subnet-10.0.0.0/28"},
+        {"action": "migrate_network", "network": "10.0.0.0/28",
+         "subnets": {"subnet-10.0.0.0/28": "10.0.0.48/28"}},
+        {"action": "delete_subnet", "subnet_id": "subnet-10.0.0.0/28"}]
+
+    compaction = space.compaction(26)
+    assert [(move["from"], move["to"]) for move in compaction.moves] == [
+        ("10.0.0.0/28", "10.0.0.80/28"), ("10.0.0.32/28", "10.0.0.112/28")]
+
+    # Only half of it is free
+    with pytest.raises(CompactionException):
+        space.compaction(24)
+    with pytest.raises(CompactionException):
+        space.compaction(23)
+
+
+def test_compaction_moves_biggest_first():
+    # The second half has the fewest subnets to move.  The /27 only fits in
+    # the hole at 32 if it goes in before the /28 takes part of it.
+    space = AddressSpace.from_snapshot(snapshot(
+        ["10.0.0.0/27", "10.0.0.64/28", "10.0.0.96/27",
+         "10.0.0.128/27", "10.0.0.160/28"]))["vpc-1"]
+    compaction = space.compaction(25)
+    assert compaction.block == "10.0.0.128/25"
+    assert sorted((move["from"], move["to"])
+                  for move in compaction.moves) == [
+        ("10.0.0.128/27", "10.0.0.32/27"), ("10.0.0.160/28", "10.0.0.80/28")]
+
+
+def test_many_subnets():
+    random.seed(1)
+    cidrs = {}
+    subnets = []
+    for vpc in range(3):
+        parent = ip_network(u"10.%d.0.0/16" % vpc)
+        cidrs["vpc-%d" % vpc] = str(parent)
+        # Fill it with /28s to /26s, then destroy a third of them
+        position = int(parent.network_address)
+        while position < int(parent.broadcast_address):
+            size = random.choice([16, 32, 64])
+            position = -(-position // size) * size
+            if position + size > int(parent.broadcast_address) + 1:
+                break
+            if random.random() > 0.33:
+                subnets.append(("vpc-%d" % vpc, str(ipaddress.ip_network(
+                    (position, 32 - size.bit_length() + 1)))))
+            position += size
+    big = {"datacenters": sorted(cidrs), "datacenter_cidrs": cidrs,
+           "networks": dict(("net-%d" % i, {"datacenter": vpc, "subnets": {
+               "subnet-%d" % i: {"cidr": cidr, "zone": "us-east-1a"}}})
+               for i, (vpc, cidr) in enumerate(subnets))}
+    assert len(subnets) > 2500
+
+    started = timeit.default_timer()
+    reports = analyze(big)
+    compaction = AddressSpace.from_snapshot(big)["vpc-0"].compaction(22)
+    assert timeit.default_timer() - started < 1.0
+
+    assert all(report["fragmentation"] > 0.9 for report in reports.values())
+    assert compaction.moves
+    block = ip_network(compaction.block)
+    assert not any(ip_network(move["to"]).overlaps(block)
+                   for move in compaction.moves)
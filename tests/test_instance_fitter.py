@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import pytest
+
 from deployment_experiments.instance_fitter import InstanceFitter
+from deployment_experiments.instance_fitter import NoFittingInstanceException
 
 
 def test_datacenter():
@@ -8,3 +11,16 @@ def test_datacenter():
 
     # If no memory, cpu, or storage is passed in, find the cheapest.
     assert instance_fitter.get_fitting_instance() == "t2.micro"
+
+
+def test_fitting_instance():
+    instance_fitter = InstanceFitter()
+    assert instance_fitter.get_fitting_instance(memory=3) == "t2.medium"
+    assert instance_fitter.get_fitting_instance(cpus=4) == "c5.xlarge"
+    assert instance_fitter.get_fitting_instance(cpus=4, memory=16) == (
+        "m5.xlarge")
+    assert instance_fitter.get_fitting_instance(memory=64, cpus=8) == (
+        "r5.2xlarge")
+    assert instance_fitter.get_fitting_instance(storage=100) == "m5d.xlarge"
+    with pytest.raises(NoFittingInstanceException):
+        instance_fitter.get_fitting_instance(memory=1024)
@@ -0,0 +1,38 @@
+import warnings
+
+import boto3
+from moto import mock_ec2
+
+from deployment_experiments.instrumentation import ApiRecorder
+from deployment_experiments.instrumentation import RepeatedCallWarning
+from deployment_experiments.network import Network
+
+
+@mock_ec2
+def test_api_recorder():
+    finished = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        with ApiRecorder(callbacks=[finished.append]) as recorder:
+            Network().provision(network_name="web")
+    report = recorder.report()
+
+    assert report["calls"] == len(finished) > 0
+    assert report["operations"]["ec2.CreateVpc"]["calls"] == 1
+    assert report["operations"]["ec2.CreateSubnet"]["calls"] == 3
+    assert report["callers"]["Datacenter.aws_create"]["ec2.CreateVpc"] == 1
+    assert report["retries"] == 0
+    assert report["throttles"] == 0
+
+    # Provision discovers the network, and then carve_subnets describes the
+    # subnets again
+    repeats = dict((repeat["operation"], repeat)
+                   for repeat in report["repeats"])
+    assert repeats["ec2.DescribeSubnets"]["scope"] == "Network.provision"
+    assert "Network.carve_subnets" in repeats["ec2.DescribeSubnets"]["callers"]
+    assert any(issubclass(warning.category, RepeatedCallWarning)
+               for warning in caught)
+
+    # Once uninstalled, nothing else gets recorded
+    boto3.client("ec2").describe_vpcs()
+    assert recorder.report()["calls"] == report["calls"]
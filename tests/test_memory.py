@@ -0,0 +1,184 @@
+import pytest
+
+from deployment_experiments import memory
+from deployment_experiments.datacenter import Datacenter, DatacenterInventory
+from deployment_experiments.network import Network, NetworkExistsException
+from deployment_experiments.service import LoadBalancer, Service, ServiceDns
+from deployment_experiments.subnet_generator import ip_network
+from deployment_experiments.virtual_machine import VirtualMachine
+from deployment_experiments.virtual_machine import VirtualMachinePlugin
+
+
+def image():
+    nginx = VirtualMachinePlugin(
+            "https://github.com/cloud-deployer/plugins/nginx-build",
+            "https://github.com/cloud-deployer/plugins/nginx-runtime")
+    return VirtualMachine(plugins=[nginx])
+
+
+def overlapping(cidrs):
+    networks = sorted(ip_network(cidr) for cidr in cidrs)
+    return [(first, second) for first, second in zip(networks, networks[1:])
+            if first.overlaps(second)]
+
+
+def test_tag_index():
+    index = memory.TagIndex()
+    index.add("a", {"deployment": "prod", "network": "web"})
+    index.add("b", {"deployment": "prod", "network": "db"})
+    index.add("c", {"deployment": "dev", "network": "web"})
+    assert index.find({"deployment": "prod"}) == set(["a", "b"])
+    assert index.find({"deployment": "prod", "network": "web"}) == set(["a"])
+    assert index.find({"deployment": "test"}) == set()
+    index.add("a", {"network": "api"})
+    assert index.find({"network": "web"}) == set(["c"])
+    index.remove("c")
+    assert index.find({"network": "web"}) == set()
+
+
+def test_datacenter():
+    memory.reset()
+    prod = Datacenter(provider="memory", deployment_name="prod")
+    dev = Datacenter(provider="memory", deployment_name="dev")
+    prod_ids = [prod.create(), prod.create()]
+    dev_id = dev.create()
+    inventory = DatacenterInventory(provider="memory", deployment_name="prod")
+    assert sorted(inventory.discover()) == sorted(prod_ids)
+    cidrs = [prod.discover(dc_id)["Vpcs"][0]["CidrBlock"]
+             for dc_id in prod_ids]
+    assert cidrs == ["10.0.0.0/16", "10.1.0.0/16"]
+    # Datacenters only avoid the other datacenters in their deployment
+    assert dev.discover(dev_id)["Vpcs"][0]["CidrBlock"] == "10.0.0.0/16"
+
+    # Freed blocks get reused
+    prod.destroy(prod_ids[0])
+    assert inventory.discover() == [prod_ids[1]]
+    new_id = prod.create()
+    assert prod.discover(new_id)["Vpcs"][0]["CidrBlock"] == "10.0.0.0/16"
+
+
+def test_network():
+    memory.reset()
+    net = Network(provider="memory", deployment_name="prod")
+    web_ids = net.provision("web")
+    db_ids = net.provision("db", colocated_network="web")
+    assert len(web_ids) == 3
+    assert net.discover("web") == web_ids
+    assert net.discover("db") == db_ids
+    assert Network(provider="memory", deployment_name="dev").discover(
+        "web") == []
+    with pytest.raises(NetworkExistsException):
+        net.provision("web")
+
+    placement = net.placement("web")
+    assert sorted(placement) == memory.ZONES
+    assert placement["us-east-1a"] == ["10.0.0.0/28"]
+    cidrs = [cidr for network in ("web", "db")
+             for cidrs in net.placement(network).values() for cidr in cidrs]
+    assert overlapping(cidrs) == []
+    inventory = DatacenterInventory(provider="memory", deployment_name="prod")
+    assert len(inventory.discover()) == 1
+
+    # The datacenter goes away with the last network in it
+    net.destroy("web")
+    assert net.discover("web") == []
+    assert len(inventory.discover()) == 1
+    net.destroy("db")
+    assert inventory.discover() == []
+
+
+def test_service():
+    memory.reset()
+    lb = LoadBalancer("web-lb", "foo.example.com", provider="memory")
+    web = Service("web", image(), lb, provider="memory")
+    lb.provision()
+    web.provision(colocated_service=lb.name)
+
+    dc_inventory = DatacenterInventory(provider="memory")
+    assert len(dc_inventory.discover()) == 1
+    assert memory.cloud.describe_subnets(tags={
+        "cloud-deployer-deployment": "default"}) != []
+
+    groups = web.discover()["AutoScalingGroups"]
+    assert len(groups) == 1
+    assert groups[0]["AutoScalingGroupName"] == "web"
+    assert groups[0]["LaunchConfigurationName"] == "web"
+    assert groups[0]["LoadBalancerNames"] == ["web-lb"]
+    assert groups[0]["DesiredCapacity"] == 3
+    # Instances spread across the service's zones, and register with the
+    # load balancer
+    instances = groups[0]["Instances"]
+    assert sorted(instance["AvailabilityZone"]
+                  for instance in instances) == memory.ZONES
+    load_balancers = lb.discover()["LoadBalancerDescriptions"]
+    assert len(load_balancers) == 1
+    assert (sorted(instance["InstanceId"]
+                   for instance in load_balancers[0]["Instances"]) ==
+            sorted(instance["InstanceId"] for instance in instances))
+
+    dns = ServiceDns("foo.example.com", "dummy", provider="memory")
+    zone_ids = dns.discover()
+    assert len(zone_ids) == 1
+    records = memory.cloud.hosted_zones[zone_ids[0]]["records"]
+    assert records == {"foo.example.com":
+                       load_balancers[0]["DNSName"]}
+
+    web.destroy()
+    lb.destroy()
+    assert web.discover() == {"AutoScalingGroups": []}
+    assert lb.discover() == {"LoadBalancerDescriptions": []}
+    assert dns.discover() == []
+    assert dc_inventory.discover() == []
+    assert memory.cloud.instances == {}
+
+
+def test_destroy_missing_service():
+    memory.reset()
+    lb = LoadBalancer("web-lb", "foo.example.com", provider="memory")
+    web = Service("web", image(), lb, provider="memory")
+    lb.provision()
+    web.provision(colocated_service=lb.name)
+    memory.cloud.delete_auto_scaling_group("web")
+    web.destroy()
+    assert web.discover() == {"AutoScalingGroups": []}
+    # And destroying again is fine too
+    web.destroy()
+    lb.destroy()
+    assert DatacenterInventory(provider="memory").discover() == []
+
+
+def test_many_services():
+    """
+    A deployment far too big to run through moto.
+    """
+    memory.reset()
+    vm = image()
+    load_balancers = [LoadBalancer("lb%d" % i, "lb%d.example.com" % i,
+                                   provider="memory")
+                      for i in range(20)]
+    services = [Service("svc%d-%d" % (i, j), vm, load_balancers[i],
+                        provider="memory")
+                for i in range(20) for j in range(50)]
+    for load_balancer in load_balancers:
+        load_balancer.provision()
+    for service in services:
+        service.provision(colocated_service=service.load_balancer.name)
+
+    # Each load balancer's VPC is a /16, which fits 50 services' worth of
+    # /28s with plenty of room
+    assert len(DatacenterInventory(provider="memory").discover()) == 20
+    assert len(memory.cloud.subnets) == 20 * 51 * 3
+    assert len(memory.cloud.instances) == 1000 * 3
+    for vpc in memory.cloud.vpcs.values():
+        cidrs = [memory.cloud.subnets[subnet_id]["cidr"]
+                 for subnet_id in vpc["subnets"]]
+        assert overlapping(cidrs) == []
+    assert all(len(load_balancer.discover()["LoadBalancerDescriptions"][0][
+        "Instances"]) == 150 for load_balancer in load_balancers)
+
+    for service in services:
+        service.destroy()
+    for load_balancer in load_balancers:
+        load_balancer.destroy()
+    assert memory.cloud.vpcs == {}
+    assert memory.cloud.subnets == {}
@@ -0,0 +1,88 @@
+import pytest
+
+from deployment_experiments import netdelta
+from deployment_experiments import netgraph
+
+net = {
+        "0": {
+            "1": [{
+                "protocol": "tcp",
+                "port": "443"
+                }]
+            },
+        "external": {
+            "1": [{
+                "protocol": "tcp",
+                "port": "443"
+                }]
+            }
+        }
+
+new_edge = {
+        "1": {
+            "2": [{
+                "protocol": "tcp",
+                "port": "5432"
+                }]
+            }
+        }
+
+
+def test_from_net_matches_net_to_firewalls():
+    firewalls = netdelta.IncrementalFirewalls.from_net(net)
+    compiled = netgraph.net_to_firewalls(net)
+    assert sorted(firewalls.firewalls()) == sorted(compiled)
+    for node, rules in compiled.items():
+        for rule in rules:
+            assert rule in firewalls.firewalls()[node]
+        assert len(firewalls.firewalls()[node]) == len(rules)
+
+
+def test_add_and_remove_edge():
+    firewalls = netdelta.IncrementalFirewalls.from_net(net)
+    delta = firewalls.apply(added=new_edge)
+    assert delta == {
+            "add": {
+                "1": [{
+                    "source": "2",
+                    "protocol": "tcp",
+                    "port": "5432",
+                    "type": "egress"
+                    }],
+                "2": [{
+                    "source": "1",
+                    "protocol": "tcp",
+                    "port": "5432",
+                    "type": "ingress"
+                    }]
+                },
+            "remove": {}
+            }
+    assert netdelta.call_count(delta) == 2
+
+    delta = firewalls.apply(removed=new_edge)
+    assert delta["add"] == {}
+    assert sorted(delta["remove"]) == ["1", "2"]
+    assert "2" not in firewalls.firewalls()
+
+
+def test_shared_rules_are_reference_counted():
+    firewalls = netdelta.IncrementalFirewalls.from_net(net)
+    firewalls.apply(added=new_edge)
+    assert firewalls.apply(added=new_edge) == {"add": {}, "remove": {}}
+    assert firewalls.apply(removed=new_edge) == {"add": {}, "remove": {}}
+    assert netdelta.call_count(firewalls.apply(removed=new_edge)) == 2
+
+
+def test_add_and_remove_cancel_out():
+    firewalls = netdelta.IncrementalFirewalls.from_net(net)
+    delta = firewalls.apply(added=new_edge, removed=new_edge)
+    assert delta == {"add": {}, "remove": {}}
+
+
+def test_remove_missing_edge():
+    firewalls = netdelta.IncrementalFirewalls.from_net(net)
+    with pytest.raises(ValueError):
+        firewalls.apply(removed=new_edge)
+    assert firewalls.firewalls() == \
+        netdelta.IncrementalFirewalls.from_net(net).firewalls()
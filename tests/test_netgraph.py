@@ -43,3 +43,83 @@ def test_net_to_firewalls():
 
 def test_firewalls_to_net():
     assert net == netgraph.firewalls_to_net(firewalls)
+
+
+busy_net = {
+        "0": {
+            "2": [{
+                "protocol": "tcp",
+                "port": "80"
+                },
+                {
+                "protocol": "tcp",
+                "port": "81"
+                },
+                {
+                "protocol": "tcp",
+                "port": "80"
+                }]
+            },
+        "1": {
+            "2": [{
+                "protocol": "tcp",
+                "port": "80-81"
+                },
+                {
+                "protocol": "udp",
+                "port": "53"
+                }]
+            }
+        }
+
+minimized_firewalls = {
+        "0": [{
+            "source": "2",
+            "protocol": "tcp",
+            "port": "80-81",
+            "type": "egress"
+            }],
+        "1": [{
+            "source": "2",
+            "protocol": "tcp",
+            "port": "80-81",
+            "type": "egress"
+            },
+            {
+            "source": "2",
+            "protocol": "udp",
+            "port": "53",
+            "type": "egress"
+            }],
+        "2": [{
+            "source": "0,1",
+            "protocol": "tcp",
+            "port": "80-81",
+            "type": "ingress"
+            },
+            {
+            "source": "1",
+            "protocol": "udp",
+            "port": "53",
+            "type": "ingress"
+            }]
+        }
+
+
+def test_minimize_firewalls():
+    minimized, report = netgraph.minimize_firewalls(
+            netgraph.net_to_firewalls(busy_net))
+    assert minimized == minimized_firewalls
+    assert report == {"before": 10, "after": 5}
+
+
+def test_minimize_firewalls_groups_external():
+    minimized, report = netgraph.minimize_firewalls(firewalls)
+    assert minimized["0"] == firewalls["0"]
+    assert minimized["1"] == [{
+        "source": "0,external",
+        "protocol": "tcp",
+        "port": "443",
+        "type": "ingress"
+        }]
+    assert report == {"before": 3, "after": 2}
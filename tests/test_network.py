@@ -3,6 +3,7 @@ from moto import mock_ec2
 
 from deployment_experiments.network import Network
 from deployment_experiments.datacenter import Datacenter
+from deployment_experiments.tracing import Tracer
 
 
 @mock_ec2
@@ -33,6 +34,12 @@ def test_networks():
         assert subnet["VpcId"] == dc_id
     net.colocated(public_subnets + private_subnets)
 
+    # Make sure the subnets are spread across availability zones
+    placement = net.placement("public")
+    assert len(placement) == 3
+    for cidrs in placement.values():
+        assert len(cidrs) == 1
+
     # Make sure I can discover them based on tags with EC2 directly
     name_filter = {'Name': "tag:cloud-deployer-network", 'Values': ["public"]}
     public_subnets = ec2.describe_subnets(Filters=[name_filter])
@@ -54,3 +61,15 @@ def test_networks():
     private_subnets = net.discover("private")
     assert len(private_subnets) == 0
     assert len(dc.discover(dc_id)["Vpcs"]) == 0
+
+
+@mock_ec2
+def test_destroy_spans():
+    net = Network()
+    net.provision(network_name="public")
+    with Tracer() as tracer:
+        net.destroy("public")
+    names = [span.name for span in tracer.spans]
+    assert names == ["Network.aws_destroy", "subnet discover",
+                     "subnet delete", "security group delete",
+                     "datacenter destroy"]
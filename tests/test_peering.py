@@ -0,0 +1,148 @@
+import random
+
+import boto3
+import pytest
+from moto import mock_ec2
+
+from deployment_experiments.network import Network
+from deployment_experiments.peering import HUB, PeeringCompiler
+from deployment_experiments.peering import PeeringException
+from deployment_experiments.peering import datacenter_traffic
+from deployment_experiments.subnet_generator import ip_network
+
+
+def rule(traffic):
+    return {"protocol": "tcp", "port": "443", "traffic": traffic}
+
+
+cidrs = {"a": "10.0.0.0/16", "b": "10.1.0.0/16", "c": "10.2.0.0/16",
+         "d": "10.3.0.0/16"}
+
+
+def lookup(routes, address):
+    """
+    Longest prefix match on one datacenter's routes.
+    """
+    address = ip_network(address).network_address
+    matches = [route for route in routes
+               if address in ip_network(route["destination"])]
+    if not matches:
+        return None
+    return max(matches, key=lambda route: ip_network(
+        route["destination"]).prefixlen)["target"]
+
+
+def test_datacenter_traffic():
+    net = {"web": {"api": [rule(10)], "db": [rule(3)]},
+           "api": {"db": [rule(5)], "web": [rule(1)]},
+           "external": {"web": [rule(100)]}}
+    traffic = datacenter_traffic(net, {"web": "a", "api": "b", "db": "b"})
+    assert traffic == {("a", "b"): 14}
+    with pytest.raises(KeyError):
+        datacenter_traffic(net, {"web": "a"})
+
+
+def test_compile_direct():
+    traffic = {("a", "b"): 10, ("a", "c"): 5, ("b", "c"): 1}
+    plan = PeeringCompiler().compile(traffic, cidrs)
+    assert plan.peerings == [("a", "b"), ("a", "c"), ("b", "c")]
+    assert plan.attachments == []
+    assert plan.routes["a"] == [{"destination": "10.1.0.0/16", "target": "b"},
+                                {"destination": "10.2.0.0/16", "target": "c"}]
+    assert "d" not in plan.routes
+
+
+def test_compile_hub():
+    traffic = {("a", "b"): 10, ("a", "c"): 5, ("a", "d"): 4, ("b", "c"): 1,
+               ("c", "d"): 2}
+    plan = PeeringCompiler(max_peerings=1).compile(traffic, cidrs)
+    # The heaviest pair that still has room on both ends gets peered
+    assert plan.peerings == [("a", "b"), ("c", "d")]
+    assert plan.attachments == ["a", "b", "c", "d"]
+    assert plan.direct_traffic == 12
+    assert plan.hub_traffic == 10
+    # c and d are siblings, so they squash into one route to the hub
+    assert plan.routes["a"] == [{"destination": "10.1.0.0/16", "target": "b"},
+                                {"destination": "10.2.0.0/15", "target": HUB}]
+    assert lookup(plan.routes["c"], "10.0.0.0/16") == HUB
+    assert lookup(plan.routes["c"], "10.3.0.0/16") == "d"
+
+    # Too light to be worth a peering
+    plan = PeeringCompiler(direct_threshold=5).compile(traffic, cidrs)
+    assert plan.peerings == [("a", "b"), ("a", "c")]
+    assert plan.attachments == ["a", "b", "c", "d"]
+
+
+def test_compile_overlap():
+    with pytest.raises(PeeringException):
+        PeeringCompiler().compile({("a", "b"): 1},
+                                  {"a": "10.0.0.0/16", "b": "10.0.0.0/8"})
+    with pytest.raises(PeeringException):
+        PeeringCompiler(max_routes=2).compile({}, cidrs)
+
+
+def test_compile_many():
+    random.seed(3)
+    datacenters = dict(("dc%d" % i, "10.%d.0.0/16" % i) for i in range(250))
+    names = sorted(datacenters)
+    traffic = {}
+    for first in names:
+        for second in random.sample(names, 20):
+            if first != second:
+                pair = tuple(sorted([first, second]))
+                traffic[pair] = random.randint(1, 1000)
+    compiler = PeeringCompiler()
+    plan = compiler.compile(traffic, datacenters)
+    report = plan.report()
+    assert report["peerings"] <= len(names) * compiler.max_peerings // 2
+    assert report["largest_table"] <= (compiler.max_routes -
+                                       compiler.reserved_routes)
+    # A full mesh would be a route per pair on both sides
+    assert report["routes"] < len(traffic)
+    assert plan.direct_traffic > plan.hub_traffic / 2
+    attached = set(plan.attachments)
+    for first, second in traffic:
+        for source, destination in [(first, second), (second, first)]:
+            target = lookup(plan.routes[source], datacenters[destination])
+            assert target in (destination, HUB)
+            if target == HUB:
+                assert source in attached and destination in attached
+
+
+@mock_ec2
+def test_apply():
+    network = Network(deployment_name="prod")
+    for name in ["web", "api", "db"]:
+        network.provision(network_name=name)
+    net = {"web": {"api": [rule(10)], "db": [rule(5)]},
+           "api": {"db": [rule(1)]}}
+
+    compiler = PeeringCompiler(deployment_name="prod", max_peerings=1)
+    changes = compiler.apply(net)
+    assert len(changes["peer"]) == 1
+    assert len(changes["attach"]) == 3
+    assert len(changes["routes"]) == 3
+
+    ec2 = boto3.client("ec2")
+    peerings = ec2.describe_vpc_peering_connections(
+        Filters=[{"Name": "status-code", "Values": ["active"]}])[
+            "VpcPeeringConnections"]
+    assert len(peerings) == 1
+    hubs = ec2.describe_transit_gateways()["TransitGateways"]
+    assert len(hubs) == 1
+
+    # Applying the same thing again should be a no-op
+    assert compiler.apply(net) == {}
+
+    # With room for everything, it all gets peered and the hub goes away
+    changes = PeeringCompiler(deployment_name="prod").apply(net)
+    assert len(changes["peer"]) == 2
+    assert len(changes["detach"]) == 3
+    assert changes["delete_hub"] == hubs[0]["TransitGatewayId"]
+    assert [hub for hub in ec2.describe_transit_gateways()["TransitGateways"]
+            if hub["State"] != "deleted"] == []
+    tables = ec2.describe_route_tables(
+        Filters=[{"Name": "association.main", "Values": ["true"]}])[
+            "RouteTables"]
+    assert not [route for table in tables for route in table["Routes"]
+                if "TransitGatewayId" in route]
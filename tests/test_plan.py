@@ -0,0 +1,220 @@
+import boto3
+import pytest
+from moto import mock_ec2, mock_autoscaling, mock_elb, mock_route53
+
+from deployment_experiments.capacity import CapacityModel
+from deployment_experiments.instrumentation import ApiRecorder
+from deployment_experiments.instrumentation import READ_PREFIXES
+from deployment_experiments.plan import Planner, PlanException
+from deployment_experiments.virtual_machine import VirtualMachine
+from deployment_experiments.virtual_machine import VirtualMachinePlugin
+
+image = VirtualMachine(plugins=[VirtualMachinePlugin(
+    "https://github.com/cloud-deployer/plugins/nginx-build",
+    "https://github.com/cloud-deployer/plugins/nginx-runtime")])
+
+desired = {
+        "load_balancers": {"web-lb": {"dns": "web.example.com"}},
+        "services": {"web": {"image": image, "load_balancer": "web-lb"}},
+        "networks": {"db": {"colocated_with": "web-lb"}},
+        "net": {
+            "web": {"db": [{"protocol": "tcp", "port": "5432"}]},
+            "external": {"web": [{"protocol": "tcp", "port": "443"}]}
+            }
+        }
+
+empty = {"datacenters": [], "datacenter_cidrs": {}, "networks": {},
+         "security_groups": {}, "load_balancers": {}, "services": {},
+         "zones": {}}
+
+
+def subnets(first):
+    return dict(("subnet-%s%d" % (first, index),
+                 {"cidr": "10.0.%d.0/28" % index,
+                  "zone": "us-east-1a"}) for index in range(3))
+
+
+existing = {
+        "datacenters": ["vpc-1"],
+        "datacenter_cidrs": {"vpc-1": "10.0.0.0/16"},
+        "networks": {
+            "web-lb": {"datacenter": "vpc-1", "subnets": subnets("l")},
+            "web": {"datacenter": "vpc-1", "subnets": subnets("w")},
+            "db": {"datacenter": "vpc-1", "subnets": subnets("d")},
+            },
+        "security_groups": {
+            "web": {"id": "sg-web",
+                    "ingress": [["tcp", 443, 443, "0.0.0.0/0"]],
+                    "egress": [["tcp", 5432, 5432, "10.0.0.0/28"],
+                               ["tcp", 5432, 5432, "10.0.1.0/28"],
+                               ["tcp", 5432, 5432, "10.0.2.0/28"]]},
+            "db": {"id": "sg-db", "ingress": [], "egress": []}
+            },
+        "load_balancers": {"web-lb": {"dns_name": "web-lb.elb.amazonaws.com",
+                                      "subnets": sorted(subnets("l"))}},
+        "services": {"web": {"launch_configuration": "web",
+                             "load_balancers": ["web-lb"],
+                             "subnets": sorted(subnets("w"))}},
+        "zones": {"example.com": {"id": "Z1", "records": {
+            "web.example.com": "web-lb.elb.amazonaws.com",
+            "www.example.com": "someone-else.elb.amazonaws.com"}}}
+        }
+
+
+def test_plan_from_nothing():
+    changes = Planner().plan(desired, empty)
+    assert [(change["action"], change.get("name")) for change in changes] == [
+            ("create_network", "web-lb"),
+            ("create_network", "db"),
+            ("create_network", "web"),
+            ("create_load_balancer", "web-lb"),
+            ("create_dns", "web.example.com"),
+            ("create_service", "web"),
+            ("apply_firewalls", None)
+            ]
+    assert changes[1]["colocated_with"] == "web-lb"
+
+
+def test_plan_offline():
+    planner = Planner()
+    changes = planner.plan(desired, existing)
+    # Everything exists, only db's ingress is missing
+    assert changes == [{
+        "action": "update_firewall",
+        "name": "db",
+        "group_id": "sg-db",
+        "rule_counts": {"ingress": 0, "egress": 0},
+        "changes": {"authorize_ingress": [["tcp", 5432, 5432,
+                                           "10.0.0.0/28"],
+                                          ["tcp", 5432, 5432,
+                                           "10.0.1.0/28"],
+                                          ["tcp", 5432, 5432,
+                                           "10.0.2.0/28"]]}
+        }]
+
+    smaller = dict(desired, services={}, net={})
+    changes = planner.plan(smaller, existing)
+    assert [(change["action"], change["name"]) for change in changes] == [
+            ("delete_security_group", "db"),
+            ("delete_security_group", "web"),
+            ("delete_service", "web"),
+            ("delete_network", "web")
+            ]
+    assert planner.plan(smaller, existing, prune=False) == []
+
+    # The record someone else pointed somewhere else stays
+    changes = planner.plan({}, existing)
+    assert [(change["action"], change["name"]) for change in changes] == [
+            ("delete_security_group", "db"),
+            ("delete_security_group", "web"),
+            ("delete_service", "web"),
+            ("delete_dns", "web.example.com"),
+            ("delete_load_balancer", "web-lb"),
+            ("delete_network", "db"),
+            ("delete_network", "web"),
+            ("delete_network", "web-lb")
+            ]
+
+    moved = dict(existing, networks=dict(existing["networks"], db={
+        "datacenter": "vpc-2", "subnets": {}}))
+    with pytest.raises(PlanException):
+        planner.plan(desired, moved)
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+@mock_route53
+def test_apply():
+    planner = Planner()
+    snapshot = planner.snapshot(desired)
+    assert snapshot == empty
+    planner.apply(planner.plan(desired, snapshot), desired, snapshot)
+
+    snapshot = planner.snapshot(desired)
+    assert sorted(snapshot["networks"]) == ["db", "web", "web-lb"]
+    assert sorted(snapshot["load_balancers"]) == ["web-lb"]
+    assert sorted(snapshot["services"]) == ["web"]
+    assert sorted(snapshot["security_groups"]) == ["db", "web"]
+    # The instances are in the security group the firewalls went into
+    launch_configuration = boto3.client(
+        "autoscaling").describe_launch_configurations(
+            LaunchConfigurationNames=["web"])["LaunchConfigurations"][0]
+    assert launch_configuration["SecurityGroups"] == [
+            snapshot["security_groups"]["web"]["id"]]
+    assert snapshot["zones"]["example.com"]["records"]["web.example.com"] == (
+            snapshot["load_balancers"]["web-lb"]["dns_name"])
+
+    # Running it again is all reads, and a fixed number of them
+    with ApiRecorder(warn=False) as recorder:
+        snapshot = planner.snapshot(desired)
+        changes = planner.plan(desired, snapshot)
+        planner.apply(changes, desired, snapshot)
+    assert changes == []
+    operations = recorder.report()["operations"]
+    assert all(name.split(".")[1].startswith(READ_PREFIXES)
+               for name in operations)
+    assert sum(operation["calls"] for operation in operations.values()) <= 8
+
+    # Dropping the service takes out its autoscaling group and network
+    smaller = dict(desired, services={})
+    changes = planner.plan(smaller, snapshot)
+    planner.apply(changes, smaller, snapshot)
+    snapshot = planner.snapshot(smaller)
+    assert snapshot["services"] == {}
+    assert sorted(snapshot["networks"]) == ["db", "web-lb"]
+
+    # Tearing everything down takes the DNS record, its zone and the
+    # security groups too
+    snapshot = planner.snapshot(desired)
+    planner.apply(planner.plan({}, snapshot), {}, snapshot)
+    assert planner.snapshot(desired) == empty
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+@mock_route53
+def test_prune_other_zone():
+    """
+    A load balancer that's no longer wanted takes its record and zone with
+    it, even when no desired load balancer uses that zone.
+    """
+    planner = Planner()
+    snapshot = planner.snapshot(desired)
+    planner.apply(planner.plan(desired, snapshot), desired, snapshot)
+
+    other = {"load_balancers": {"api-lb": {"dns": "api.example.org"}}}
+    snapshot = planner.snapshot(other)
+    assert sorted(snapshot["zones"]) == ["example.com"]
+    changes = planner.plan(other, snapshot)
+    assert [(change["action"], change["name"]) for change in changes
+            if "dns" in change["action"]] == [
+            ("create_dns", "api.example.org"),
+            ("delete_dns", "web.example.com"),
+            ("delete_dns_zone", "example.com")]
+    planner.apply(changes, other, snapshot)
+    assert sorted(planner.snapshot(other)["zones"]) == ["example.org"]
+
+
+@mock_ec2
+@mock_elb
+@mock_autoscaling
+def test_apply_services_only():
+    """
+    Services don't need a load balancer, and get sized by their capacity.
+    """
+    capacity = {"throughput": 200, "latency": 0.05, "load": 500}
+    only_services = {"services": {"api": {"image": image,
+                                          "load_balancer": None,
+                                          "capacity": capacity}}}
+    planner = Planner()
+    snapshot = planner.snapshot(only_services)
+    planner.apply(planner.plan(only_services, snapshot), only_services,
+                  snapshot)
+    group = boto3.client("autoscaling").describe_auto_scaling_groups(
+        AutoScalingGroupNames=["api"])["AutoScalingGroups"][0]
+    plan = CapacityModel(**capacity).plan(3)
+    assert group["DesiredCapacity"] == plan.desired_capacity
+    assert group["MaxSize"] == plan.max_size
+    assert group["LoadBalancerNames"] == []
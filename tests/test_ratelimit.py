@@ -0,0 +1,84 @@
+import boto3
+from moto import mock_ec2
+
+from deployment_experiments import clients
+from deployment_experiments.ratelimit import RateLimiter, TokenBucket
+from deployment_experiments.ratelimit import idempotent, retryable
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeHttp(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(max_rate=10.0, capacity=2, clock=clock,
+                         sleep=clock.sleep)
+    # The burst goes straight through, then it's one every 1/rate seconds
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert abs(bucket.acquire() - 0.1) < 1e-9
+
+    # Throttling halves the rate, and successes slowly bring it back
+    bucket.throttled()
+    assert bucket.rate == 5.0
+    assert abs(bucket.acquire() - 0.2) < 1e-9
+    for _ in range(1000):
+        bucket.succeeded()
+    assert bucket.rate == 10.0
+
+    for _ in range(100):
+        bucket.throttled()
+    assert bucket.rate == bucket.min_rate
+
+
+def test_retryable():
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    route53 = boto3.client("route53", region_name="us-east-1")
+    describe = ec2.meta.service_model.operation_model("DescribeVpcs")
+    create_vpc = ec2.meta.service_model.operation_model("CreateVpc")
+    run_instances = ec2.meta.service_model.operation_model("RunInstances")
+    create_zone = route53.meta.service_model.operation_model(
+        "CreateHostedZone")
+    assert idempotent(describe)
+    assert not idempotent(create_vpc)
+    assert idempotent(run_instances)
+    assert idempotent(create_zone)
+
+    throttled = (FakeHttp(400), {"Error": {"Code": "RequestLimitExceeded"}})
+    server_error = (FakeHttp(503), {"Error": {"Code": "Unavailable"}})
+    bad_request = (FakeHttp(400), {"Error": {"Code": "InvalidParameter"}})
+    assert retryable(create_vpc, throttled, None) == (True, True)
+    assert retryable(create_vpc, server_error, None) == (False, False)
+    assert retryable(describe, server_error, None) == (True, False)
+    assert retryable(describe, bad_request, None) == (False, False)
+    assert retryable(describe, None, IOError()) == (True, False)
+
+
+def test_jitter():
+    limiter = RateLimiter(base_delay=1.0, max_delay=5.0)
+    for attempts in range(1, 10):
+        assert 0 <= limiter.delay(attempts) <= min(5.0, 2 ** attempts)
+
+
+@mock_ec2
+def test_shared_client():
+    ec2 = clients.client("ec2")
+    ec2.describe_vpcs()
+    assert clients.client("ec2") is not ec2
+    assert "ec2" in clients.limiter.buckets
+    assert clients.limiter.buckets["ec2"].tokens < 100
@@ -0,0 +1,58 @@
+from deployment_experiments import netgraph
+from deployment_experiments import routegraph
+from deployment_experiments.reachability import ReachabilityIndex
+
+net = {
+        "web": {
+            "db": [{
+                "protocol": "tcp",
+                "port": "5432"
+                },
+                {
+                "protocol": "tcp",
+                "port": "8000-8080"
+                }]
+            },
+        "external": {
+            "web": [{
+                "protocol": "tcp",
+                "port": "443"
+                }]
+            }
+        }
+
+
+def test_can_reach():
+    index = ReachabilityIndex.from_firewalls(netgraph.net_to_firewalls(net))
+    assert index.can_reach("web", "db", "tcp", 5432)
+    assert index.can_reach("web", "db", "tcp", "8042")
+    assert index.can_reach("external", "web", "tcp", 443)
+    assert not index.can_reach("db", "web", "tcp", 5432)
+    assert not index.can_reach("web", "db", "tcp", 5433)
+    assert not index.can_reach("web", "db", "udp", 5432)
+    assert not index.can_reach("external", "db", "tcp", 5432)
+    assert not index.can_reach("nobody", "db", "tcp", 5432)
+    assert index.reachable("web", "tcp", 8000) == ["db"]
+
+
+def test_routes_limit_reachability():
+    firewalls = netgraph.net_to_firewalls(net)
+    routes = routegraph.net_to_routes([["web", "external"]])
+    index = ReachabilityIndex.from_firewalls(firewalls, routes)
+    assert index.can_reach("external", "web", "tcp", 443)
+    # The firewall allows it, but there's no route from web to db
+    assert not index.can_reach("web", "db", "tcp", 5432)
+
+    routes = routegraph.net_to_routes([["db", "web", "external"]])
+    index = ReachabilityIndex.from_firewalls(firewalls, routes)
+    assert index.can_reach("web", "db", "tcp", 5432)
+
+
+def test_check():
+    index = ReachabilityIndex.from_firewalls(netgraph.net_to_firewalls(net))
+    policy = [
+            ("external", "web", "tcp", 443, True),
+            ("external", "db", "tcp", 5432, False),
+            ("db", "web", "tcp", 5432, True)
+            ]
+    assert index.check(policy) == [("db", "web", "tcp", 5432, True)]
@@ -0,0 +1,111 @@
+from deployment_experiments import memory
+from deployment_experiments.rollout import RollingUpdate, roll_out, summarize
+from deployment_experiments.service import LoadBalancer, Service
+from deployment_experiments.virtual_machine import VirtualMachine
+from deployment_experiments.virtual_machine import VirtualMachinePlugin
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def image(name):
+    plugin = VirtualMachinePlugin(
+            "https://github.com/cloud-deployer/plugins/%s-build" % name,
+            "https://github.com/cloud-deployer/plugins/%s-runtime" % name)
+    return VirtualMachine(plugins=[plugin])
+
+
+def provision(count, **kwargs):
+    memory.reset()
+    memory.cloud = memory.MemoryCloud(**kwargs)
+    lb = LoadBalancer("web-lb", "web.example.com", provider="memory")
+    lb.provision()
+    services = [Service("web%d" % i, image("nginx"), lb, provider="memory")
+                for i in range(count)]
+    for service in services:
+        service.provision(colocated_service=lb.name)
+    return services
+
+
+def test_rollout():
+    clock = FakeClock()
+    web, = provision(1, clock=clock, boot_seconds=30)
+    clock.now = 100.0
+    old_ids = set(instance["InstanceId"] for instance
+                  in web.discover()["AutoScalingGroups"][0]["Instances"])
+
+    update = RollingUpdate(web, image("apache"), batch_size=2,
+                           poll_interval=10, clock=clock, sleep=clock.sleep)
+    report = update.run()
+    assert report.error is None
+    assert report.batches == 2
+    assert report.replaced == 3
+    # Each batch waits 30 seconds for its instances to boot
+    assert report.seconds == 60.0
+    # Nothing stopped serving until its replacement was in service
+    assert report.served_capacity == 1.0
+
+    group = web.discover()["AutoScalingGroups"][0]
+    assert group["DesiredCapacity"] == 3
+    assert group["MaxSize"] == 3
+    assert group["LaunchConfigurationName"] == report.launch_configuration
+    assert all(instance["LaunchConfigurationName"] ==
+               report.launch_configuration
+               for instance in group["Instances"])
+    assert old_ids.isdisjoint(instance["InstanceId"]
+                              for instance in group["Instances"])
+    assert sorted(memory.cloud.launch_configurations) == [
+        report.launch_configuration]
+    assert set(web.load_balancer.instance_health()) == set(
+        instance["InstanceId"] for instance in group["Instances"])
+
+    # Destroying afterwards cleans up the new launch configuration
+    web.destroy()
+    assert memory.cloud.launch_configurations == {}
+
+
+def test_rollout_health_timeout():
+    clock = FakeClock()
+    web, = provision(1, clock=clock, boot_seconds=1000)
+    clock.now = 1000.0
+    update = RollingUpdate(web, image("apache"), health_timeout=60,
+                           poll_interval=10, clock=clock, sleep=clock.sleep)
+    report = update.run()
+    assert "passed their health check" in report.error
+    assert report.replaced == 0
+    # The old instances are all still there, and still serving
+    assert report.served_capacity == 1.0
+    group = web.discover()["AutoScalingGroups"][0]
+    assert sum(1 for instance in group["Instances"]
+               if instance["LaunchConfigurationName"] == "web0") == 3
+    # The group is back how it was: no surge instances, the old launch
+    # configuration and sizes, and the new launch configuration is gone
+    assert len(group["Instances"]) == 3
+    assert group["LaunchConfigurationName"] == "web0"
+    assert group["DesiredCapacity"] == 3
+    assert group["MaxSize"] == 3
+    assert sorted(memory.cloud.launch_configurations) == ["web0"]
+
+
+def test_roll_out_parallel():
+    services = provision(40)
+    updates = [RollingUpdate(service, image("apache"), poll_interval=0)
+               for service in services]
+    reports = roll_out(updates, max_concurrency=8)
+    assert [report.service for report in reports] == [
+        service.name for service in services]
+    summary = summarize(reports)
+    assert summary["services"] == 40
+    assert summary["failed"] == []
+    assert summary["replaced"] == 120
+    assert summary["served_capacity"] == 1.0
+    assert len(memory.cloud.instances) == 120
+    assert len(memory.cloud.launch_configurations) == 40
@@ -1,11 +1,11 @@
+import pytest
+
 from deployment_experiments import routegraph
 
 # TODO: Do the next steps of this.
 #
-# This is the simplest case, but I also want to make this availability zone
-# aware.  I suppose I won't be able to round trip as well.  Do I have to make
-# it availability zone aware though?  It's worth playing around with to figure
-# out what interface would be nice.
+# This is the simplest case.  The availability zone aware version is
+# net_to_zonal_routes, which doesn't round trip.
 #
 # Also, adding protocol information to these connections would allow for
 # combining the firewall and routing rules.  Is that actually a good idea?
@@ -37,3 +37,166 @@ def test_net_to_routes():
 
 def test_routes_to_net():
     assert net == routegraph.routes_to_net(routes)
+
+
+def test_routes_to_net_multiple_paths():
+    paths = [["0", "1", "external"], ["2", "1", "external"], ["0", "3", "2"]]
+    recovered = routegraph.routes_to_net(routegraph.net_to_routes(paths))
+    # Which direction each path comes back in depends on dict order
+    undirected = lambda path: min(path, list(reversed(path)))
+    assert (sorted(undirected(path) for path in recovered) ==
+            sorted(undirected(path) for path in paths))
+
+
+def test_routes_to_net_shared_hop():
+    # 1 is in the middle of the first path and an end of the second, which
+    # used to bring back 1 -> 0 and 1 -> external as paths of their own
+    paths = [["0", "1", "external"], ["1", "2"]]
+    routes = routegraph.net_to_routes(paths)
+    recovered = routegraph.routes_to_net(routes)
+    undirected = lambda path: min(path, list(reversed(path)))
+    assert (sorted(undirected(path) for path in recovered) ==
+            sorted(undirected(path) for path in paths))
+    table = lambda routes: dict((node, sorted((rule["destination"],
+                                               rule["target"])
+                                              for rule in route))
+                                for node, route in routes.items())
+    assert table(routegraph.net_to_routes(recovered)) == table(routes)
+
+
+def test_routes_to_net_external():
+    # external has no route table, so nothing ever routes back to the start
+    # of these, and they have to be walked from the other end
+    assert routegraph.routes_to_net(routegraph.net_to_routes(
+        [["web", "external"]])) == [["web", "external"]]
+    paths = [["a", "b", "external"], ["c", "external"]]
+    assert sorted(routegraph.routes_to_net(
+        routegraph.net_to_routes(paths))) == paths
+
+
+def test_routes_to_net_loop():
+    looped = {
+            "0": [{
+                "destination": "external",
+                "target": "1"
+                }],
+            "1": [{
+                "destination": "0",
+                "target": "0"
+                },
+                {
+                "destination": "external",
+                "target": "0"
+                }]
+            }
+    with pytest.raises(routegraph.RoutingLoopException):
+        routegraph.routes_to_net(looped)
+
+
+def test_compress_routes():
+    paths = [["0", "gw", "external"], ["1", "gw", "external"],
+             ["2", "gw", "external"], ["3", "gw", "external"],
+             ["admin", "gw", "0"], ["admin", "gw", "1"],
+             ["admin", "gw", "2"], ["admin", "gw", "3"]]
+    cidrs = {
+            "0": ["10.0.0.0/28"],
+            "1": ["10.0.0.16/28"],
+            "2": ["10.0.0.32/28"],
+            "3": ["10.0.0.48/28"],
+            "gw": ["10.0.1.0/28"],
+            "admin": ["10.0.2.0/28"]
+            }
+    compressed, report = routegraph.compress_routes(
+            routegraph.net_to_routes(paths), cidrs)
+    # Four routes through the same gateway turn into one aggregate
+    assert compressed["admin"] == [{
+        "destination": "10.0.0.0/26",
+        "target": "gw"
+        }]
+    # The default route already covers admin, so that one is redundant
+    assert compressed["0"] == [{
+        "destination": "0.0.0.0/0",
+        "target": "gw"
+        }]
+    assert len(compressed["gw"]) == 6
+    assert report == {"before": 28, "after": 11}
+
+
+def test_compress_routes_keeps_more_specific_routes():
+    routes = {
+            "0": [{
+                "destination": "a",
+                "target": "1"
+                },
+                {
+                "destination": "b",
+                "target": "1"
+                },
+                {
+                "destination": "c",
+                "target": "2"
+                }]
+            }
+    cidrs = {
+            "a": ["10.0.0.0/25"],
+            "b": ["10.0.0.128/25"],
+            "c": ["10.0.0.0/24"]
+            }
+    compressed, _ = routegraph.compress_routes(routes, cidrs)
+    # Merging a and b would collide with c, so everything has to stay
+    assert len(compressed["0"]) == 3
+
+
+def test_net_to_zonal_routes():
+    zones = {
+            "web": {
+                "us-east-1a": ["10.0.0.0/28"],
+                "us-east-1b": ["10.0.0.16/28"]
+                },
+            "nat": {
+                "us-east-1a": ["10.0.1.0/28"],
+                "us-east-1c": ["10.0.1.16/28"]
+                }
+            }
+    zonal = routegraph.net_to_zonal_routes([["web", "nat", "external"]],
+                                           zones)
+    assert sorted(zonal["web"]) == ["us-east-1a", "us-east-1b"]
+    # In zone a, the nat in zone a is preferred
+    assert zonal["web"]["us-east-1a"] == [{
+        "destination": "external",
+        "target": "nat",
+        "zone": "us-east-1a",
+        "preferred": True
+        },
+        {
+        "destination": "external",
+        "target": "nat",
+        "zone": "us-east-1c",
+        "preferred": False
+        }]
+    # There's no nat in zone b, so it has to cross zones
+    assert zonal["web"]["us-east-1b"][0]["zone"] == "us-east-1a"
+    assert zonal["web"]["us-east-1b"][0]["preferred"]
+    # External isn't zonal
+    assert zonal["nat"]["us-east-1c"][-1] == {
+        "destination": "external",
+        "target": "external",
+        "zone": None,
+        "preferred": True
+        }
+
+
+def test_zonal_routes_multiple_targets():
+    routes = {"web": [{"destination": "external", "target": "nat1"},
+                      {"destination": "external", "target": "nat2"}]}
+    zones = {"web": {"us-east-1a": [], "us-east-1b": []},
+             "nat1": {"us-east-1a": []},
+             "nat2": {"us-east-1b": []}}
+    zonal = routegraph.zonal_routes(routes, zones)
+    for zone, target in [("us-east-1a", "nat1"), ("us-east-1b", "nat2")]:
+        preferred = [entry for entry in zonal["web"][zone]
+                     if entry["preferred"]]
+        assert len(preferred) == 1
+        assert preferred[0]["target"] == target
+        assert zonal["web"][zone][0] is preferred[0]
+        assert len(zonal["web"][zone]) == 2
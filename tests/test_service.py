@@ -4,7 +4,7 @@ from deployment_experiments.service import LoadBalancer, Service
 from deployment_experiments.datacenter import DatacenterInventory
 from deployment_experiments.virtual_machine import VirtualMachine
 from deployment_experiments.virtual_machine import VirtualMachinePlugin
-import ipaddress
+from deployment_experiments.subnet_generator import ip_network
 
 
 @mock_ec2
@@ -99,10 +99,10 @@ def test_service():
     assert len(load_balancer_subnets["Subnets"]) == 3
 
     for asg_subnet in asg_subnets["Subnets"]:
-        asg_cidr = ipaddress.ip_network(unicode(asg_subnet["CidrBlock"]))
+        asg_cidr = ip_network(asg_subnet["CidrBlock"])
         for load_balancer_subnet in load_balancer_subnets["Subnets"]:
-            load_balancer_cidr = ipaddress.ip_network(
-                    unicode(load_balancer_subnet["CidrBlock"]))
+            load_balancer_cidr = ip_network(
+                    load_balancer_subnet["CidrBlock"])
             assert not asg_cidr.overlaps(load_balancer_cidr)
 
     # Make sure they got allocated in the same VPC
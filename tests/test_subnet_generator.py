@@ -2,9 +2,43 @@
 
 import ipaddress
 from deployment_experiments.subnet_generator import generate_subnets
+from deployment_experiments.subnet_generator import collapse_cidrs
+from deployment_experiments.subnet_generator import SubnetAllocator
+from deployment_experiments.subnet_generator import ip_network
 
 
 def test_generate_subnets():
     subnets = generate_subnets("10.0.0.0/8",
                                ["10.0.0.0/9", "10.128.0.0/10"], 10)
     assert list(subnets) == [ipaddress.ip_network(u"10.192.0.0/10")]
+
+
+def test_generate_subnets_messy_existing():
+    # Overlapping, unsorted, and partly or entirely outside the parent
+    subnets = generate_subnets("10.0.0.0/24",
+                               ["10.0.0.64/26", "10.0.0.0/27", "10.0.0.0/28",
+                                "9.0.0.0/8", "10.0.0.192/26"], 27)
+    assert [str(subnet) for subnet in subnets] == ["10.0.0.32/27",
+                                                   "10.0.0.128/27",
+                                                   "10.0.0.160/27"]
+    assert list(generate_subnets("10.0.0.0/24", ["10.0.0.0/8"], 28)) == []
+
+
+def test_collapse_cidrs():
+    assert collapse_cidrs(["10.0.0.16/28", "10.0.0.0/28", "10.0.0.32/28",
+                           "10.0.0.0/28"]) == ["10.0.0.0/27", "10.0.0.32/28"]
+
+
+def test_free_blocks():
+    allocator = SubnetAllocator("10.0.0.0/16")
+    assert allocator.free_blocks() == [(int(allocator.parent.network_address),
+                                        16)]
+    allocator.claim("10.0.0.16/28")
+    allocator.claim("10.0.1.0/24")
+    free = [str(ipaddress.ip_network(block))
+            for block in allocator.free_blocks()]
+    assert free[:5] == ["10.0.0.0/28", "10.0.0.32/27", "10.0.0.64/26",
+                        "10.0.0.128/25", "10.0.2.0/23"]
+    assert free[-1] == "10.0.128.0/17"
+    assert sum(ip_network(block).num_addresses
+               for block in free) == 65536 - 16 - 256
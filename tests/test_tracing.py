@@ -0,0 +1,66 @@
+import json
+import threading
+
+from deployment_experiments import tracing
+from deployment_experiments.tracing import Tracer, span, wrap
+
+
+def test_spans_nest():
+    with span("ignored") as nothing:
+        assert nothing is None
+
+    with Tracer() as tracer:
+        with span("deploy", service="web"):
+            with span("network carve"):
+                pass
+            with span("elb create"):
+                pass
+    assert tracing.current_tracer() is None
+
+    spans = dict((span.name, span) for span in tracer.spans)
+    assert spans["deploy"].parent_id is None
+    assert spans["deploy"].attributes == {"service": "web"}
+    assert spans["network carve"].parent_id == spans["deploy"].span_id
+    assert spans["elb create"].parent_id == spans["deploy"].span_id
+    assert spans["deploy"].seconds >= spans["elb create"].seconds
+    assert [total["name"] for total in tracer.summary()][0] == "deploy"
+
+
+def test_wrap_across_threads():
+    def work():
+        with span("worker"):
+            pass
+
+    with Tracer() as tracer:
+        with span("fan out"):
+            thread = threading.Thread(target=wrap(work))
+            thread.start()
+            thread.join()
+    spans = dict((span.name, span) for span in tracer.spans)
+    assert spans["worker"].parent_id == spans["fan out"].span_id
+    assert spans["worker"].thread != spans["fan out"].thread
+
+    chrome = tracer.chrome_trace()
+    assert set(event["name"] for event in chrome["traceEvents"]
+               if event["ph"] == "X") == set(["fan out", "worker"])
+
+    speedscope = tracer.speedscope()
+    assert len(speedscope["profiles"]) == 2
+    for profile in speedscope["profiles"]:
+        assert [event["type"] for event in profile["events"]] == ["O", "C"]
+
+
+def test_save_and_profile(tmpdir):
+    with Tracer(profile=True) as tracer:
+        with span("deploy"):
+            with span("inner"):
+                sum(range(1000))
+    path = str(tmpdir.join("trace.json"))
+    tracer.save(path, format="speedscope")
+    with open(path) as trace_file:
+        frames = json.load(trace_file)["shared"]["frames"]
+    assert [frame["name"] for frame in frames] == ["deploy", "inner"]
+
+    profiles = tracer.dump_profiles(str(tmpdir))
+    assert len(profiles) == 1
+    assert profiles[0].endswith("deploy.prof")